@@ -82,6 +82,16 @@ class User(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = "username"
     REQUIRED_FIELDS = ["email", "user_type"]
 
+    class Meta:
+        # Only users with a pending verification have a token.
+        indexes = [
+            models.Index(
+                fields=["email_verification_token"],
+                name="accounts_user_verif_token_idx",
+                condition=models.Q(email_verification_token__isnull=False),
+            )
+        ]
+
     def __str__(self):
         """Return a string representation of the account."""
         return self.username
@@ -1,3 +1,146 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache, caches
+from django.db import OperationalError
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from rest_framework.response import Response
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from Accounts.models import User
+from voxlyne.db import middleware, routers
+from voxlyne.db.middleware import ReplicaRoutingMiddleware
+from voxlyne.db.retry import RetryBudget, retry_on_db_lock, retry_stats
+from voxlyne.db.testing import QueryPlanMixin
+
+
+class UserQueryPlanTests(QueryPlanMixin, TestCase):
+    """Verification tokens are looked up through their partial index."""
+
+    def test_verification_token_lookup(self):
+        self.assertIndexed(
+            User.objects.filter(email_verification_token="123456"),
+            "accounts_user_verif_token_idx",
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class ReplicaPinningTests(TestCase):
+    """Clients read their own writes, whichever identity they use next."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="ada", email="ada@example.com", password="secret"
+        )
+        self.access = str(RefreshToken.for_user(self.user).access_token)
+        patcher = mock.patch.object(middleware, "REPLICAS", ["replica"])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, request, response=None):
+        """Run a request through the middleware; return whether it may use a replica."""
+        seen = {}
+
+        def get_response(request):
+            seen["replicas"] = routers._read_state.get().replicas_allowed
+            return response or Response({})
+
+        ReplicaRoutingMiddleware(get_response)(request)
+        return seen["replicas"]
+
+    def test_reads_use_the_replica(self):
+        self.assertTrue(self.call(self.factory.get("/api/documents/")))
+
+    def test_login_pins_the_returned_token(self):
+        self.call(
+            self.factory.post("/api/login/", REMOTE_ADDR="10.0.0.1"),
+            Response({"token": self.access}),
+        )
+        # Same client, now with its token and from another address.
+        request = self.factory.get(
+            "/api/profile/",
+            HTTP_AUTHORIZATION=f"Bearer {self.access}",
+            REMOTE_ADDR="10.0.0.2",
+        )
+        self.assertFalse(self.call(request))
+
+    def test_write_pins_the_user_of_other_tokens(self):
+        self.call(
+            self.factory.post(
+                "/api/documents/",
+                HTTP_AUTHORIZATION=f"Bearer {self.access}",
+                REMOTE_ADDR="10.0.0.1",
+            )
+        )
+        refreshed = str(RefreshToken.for_user(self.user).access_token)
+        request = self.factory.get(
+            "/api/documents/",
+            HTTP_AUTHORIZATION=f"Bearer {refreshed}",
+            REMOTE_ADDR="10.0.0.2",
+        )
+        self.assertFalse(self.call(request))
+
+    def test_unreachable_pins_read_the_primary(self):
+        with mock.patch.object(
+            type(caches["default"]), "available", False, create=True
+        ):
+            self.assertFalse(self.call(self.factory.get("/api/documents/")))
+
+
+class DatabaseLockRetryTests(TransactionTestCase):
+    """Work safe to repeat is retried when SQLite is locked, within a budget."""
+
+    def setUp(self):
+        patcher = mock.patch("voxlyne.db.retry.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_budget_gives_up_after_max_retries(self):
+        attempts = RetryBudget("test.retries", max_retries=2)
+        with self.assertLogs("voxlyne.db.retry", "WARNING"):
+            self.assertTrue(attempts.failed())
+            self.assertTrue(attempts.failed())
+            self.assertFalse(attempts.failed())
+        self.assertEqual(self.sleep.call_count, 2)
+        stats = retry_stats()["test.retries"]
+        self.assertEqual((stats["retries"], stats["exhausted"]), (2, 1))
+
+    def test_budget_gives_up_once_time_is_spent(self):
+        attempts = RetryBudget("test.budget", max_retries=5, budget=0)
+        with self.assertLogs("voxlyne.db.retry", "ERROR"):
+            self.assertFalse(attempts.failed())
+        self.sleep.assert_not_called()
+
+    def test_decorated_function_is_retried(self):
+        calls = []
+
+        @retry_on_db_lock(max_retries=3, delay=0.001)
+        def work():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError("database is locked")
+            return "done"
+
+        with self.assertLogs("voxlyne.db.retry", "WARNING"):
+            self.assertEqual(work(), "done")
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        @retry_on_db_lock()
+        def work():
+            calls.append(1)
+            raise OperationalError("no such table: missing")
+
+        with self.assertRaises(OperationalError):
+            work()
+        self.assertEqual(len(calls), 1)
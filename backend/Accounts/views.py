@@ -28,7 +28,8 @@ from django.utils import timezone
 import logging
 import requests
 import pytz
-from .middleware import retry_on_db_lock
+from voxlyne.db.retry import is_lock_error, retry_on_db_lock
+from voxlyne.db.routers import use_primary
 
 # Configurar el logger
 logger = logging.getLogger(__name__)
@@ -541,9 +542,10 @@ def verify_recaptcha(token):
         logger.error(f"Error verifying reCAPTCHA: {e}")
         return False
 
+@use_primary
+@retry_on_db_lock(max_retries=3, delay=0.2)
 @api_view(["GET"])
 @permission_classes([AllowAny])
-@retry_on_db_lock(max_retries=3, delay=0.2)
 def verify_email_view(request):
     """Verify email with token."""
     try:
@@ -677,6 +679,9 @@ def verify_email_view(request):
             )
 
     except Exception as e:
+        if is_lock_error(e):
+            # DatabaseRetryMiddleware vuelve a ejecutar la solicitud
+            raise
         logger.error(f"Error en la verificación: {str(e)}")
         logger.error("Traceback completo:", exc_info=True)
         return Response(
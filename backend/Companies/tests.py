@@ -1,3 +1,251 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.db import OperationalError, connection
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django_redis.cache import RedisCache
+
+from Companies.models import Company
+from Companies.views import CompanyViewSet
+from voxlyne.cache_backends import ResilientRedisCache
+from voxlyne.caching import RECOMPUTE_LOCK_KEY, get_or_compute
+
+LOCAL_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "tiered": {
+        "BACKEND": "voxlyne.cache_backends.TieredCache",
+        "OPTIONS": {"L2": "default"},
+    },
+}
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CompanyListCacheTests(TestCase):
+    """The company list is cached until a company write commits."""
+
+    url = "/api/companies/"
+
+    def setUp(self):
+        for number in range(3):
+            self.create_company(number)
+
+    def create_company(self, number):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Company.objects.create(
+                name=f"Company {number}",
+                address="Main St",
+                phone="1",
+                email=f"company{number}@example.com",
+                nit=str(number),
+            )
+
+    def count(self):
+        return self.client.get(self.url).json()["count"]
+
+    def test_cached_list_reads_no_rows(self):
+        first = self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(self.url)
+        self.assertEqual(second.content, first.content)
+        # Only the savepoint of ATOMIC_REQUESTS is left.
+        self.assertFalse(
+            [q["sql"] for q in queries.captured_queries if "SELECT" in q["sql"]]
+        )
+
+    def test_write_invalidates_once_committed(self):
+        self.assertEqual(self.count(), 3)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Company.objects.create(
+                name="Late",
+                address="Main St",
+                phone="1",
+                email="late@example.com",
+                nit="9",
+            )
+            # Not committed yet: the cached list stands.
+            self.assertEqual(self.count(), 3)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.count(), 4)
+
+    def test_delete_invalidates(self):
+        self.assertEqual(self.count(), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            Company.objects.first().delete()
+        self.assertEqual(self.count(), 2)
+
+    def test_etag_answers_304(self):
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(self.url)["ETag"], etag)
+
+        not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b"")
+        other = self.client.get(self.url, HTTP_IF_NONE_MATCH='"another"')
+        self.assertEqual(other.status_code, 200)
+
+        self.create_company(3)
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], etag)
+
+    def test_browsable_api_is_not_cached(self):
+        response = self.client.get(self.url, HTTP_ACCEPT="text/html")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class GetOrComputeTests(SimpleTestCase):
+    """Expensive values are computed by one request at a time."""
+
+    def setUp(self):
+        caches["default"].clear()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        time.sleep(0.2)
+        return self.calls
+
+    def test_single_flight(self):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(get_or_compute("key", self.compute, 60))
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [1] * 8)
+
+    def test_stale_value_served_while_refreshing(self):
+        cache = caches["default"]
+        get_or_compute("key", self.compute, 60)
+        envelope = cache.get("key")
+        cache.set("key", {**envelope, "expires": time.time() - 1}, 60)
+        # Another request holds the lock and is refreshing the value.
+        cache.add(RECOMPUTE_LOCK_KEY.format("key"), 1)
+        self.assertEqual(get_or_compute("key", self.compute, 60), 1)
+        cache.delete(RECOMPUTE_LOCK_KEY.format("key"))
+        self.assertEqual(get_or_compute("key", self.compute, 60), 2)
+
+    def test_failed_store_still_returns_the_value(self):
+        cache = caches["default"]
+        with self.assertLogs("voxlyne.caching", "WARNING"):
+            with mock.patch.object(cache, "set", side_effect=ConnectionError("down")):
+                self.assertEqual(get_or_compute("key", self.compute, 60), 1)
+        self.assertIsNone(cache.get(RECOMPUTE_LOCK_KEY.format("key")))
+
+    def test_none_is_not_cached(self):
+        self.assertIsNone(get_or_compute("key", lambda: None, 60))
+        self.assertIsNone(caches["default"].get("key"))
+
+
+class RedisCircuitBreakerTests(SimpleTestCase):
+    """The Redis cache falls back to local memory and back again."""
+
+    def setUp(self):
+        # Nothing listens on this port; each test gets its own breaker.
+        self.cache = ResilientRedisCache(
+            f"redis://127.0.0.1:1/{self._testMethodName}",
+            {
+                "OPTIONS": {
+                    "SOCKET_CONNECT_TIMEOUT": 0.1,
+                    "FAILURE_THRESHOLD": 3,
+                    "PROBE_INTERVAL": 3600,
+                }
+            },
+        )
+
+    def open_circuit(self):
+        with self.assertLogs("voxlyne.cache_backends", "WARNING"):
+            for _ in range(3):
+                self.assertIsNone(self.cache.get("missing"))
+        self.assertFalse(self.cache.available)
+
+    def test_falls_back_to_local_memory(self):
+        self.open_circuit()
+        with mock.patch.object(RedisCache, "get") as redis_get:
+            self.cache.set("key", 1)
+            self.assertEqual(self.cache.get("key"), 1)
+            self.assertEqual(self.cache.incr("key"), 2)
+        redis_get.assert_not_called()
+        self.assertEqual(self.cache.stats()["trips"], 1)
+
+    def test_recovery_drops_keys_written_meanwhile(self):
+        self.open_circuit()
+        self.cache.set("written", 1)
+        deleted = []
+        self.cache.probe_interval = 0
+        with mock.patch.object(
+            self.cache.client, "get_client"
+        ), mock.patch.object(
+            RedisCache,
+            "delete_many",
+            lambda cache, keys, version=None: deleted.extend(keys),
+        ), self.assertLogs("voxlyne.cache_backends", "WARNING"):
+            # A probe that reaches Redis.
+            self.cache._probe()
+        self.assertTrue(self.cache.available)
+        self.assertEqual(deleted, ["written"])
+        # The local copy is gone with the outage.
+        self.assertIsNone(self.cache._fallback.get("written"))
+
+    def test_publish_is_skipped_while_open(self):
+        self.open_circuit()
+        with mock.patch.object(self.cache.client, "get_client") as get_client:
+            self.assertFalse(self.cache.publish("channel", "message"))
+        get_client.assert_not_called()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class LockedRequestTests(TransactionTestCase):
+    """Requests failing on a locked database are retried when safe."""
+
+    url = "/api/companies/"
+
+    def setUp(self):
+        patcher = mock.patch("voxlyne.db.retry.time.sleep")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_is_retried(self):
+        calls = []
+        get_queryset = CompanyViewSet.get_queryset
+
+        def locked_twice(view):
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError("database is locked")
+            return get_queryset(view)
+
+        with mock.patch.object(CompanyViewSet, "get_queryset", locked_twice):
+            with self.assertLogs("voxlyne.db.retry", "WARNING"):
+                response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 3)
+
+    def test_write_is_not_retried(self):
+        with mock.patch.object(
+            CompanyViewSet,
+            "create",
+            side_effect=OperationalError("database is locked"),
+        ) as create:
+            response = self.client.post(self.url, {"name": "Acme"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(create.call_count, 1)
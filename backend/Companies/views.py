@@ -5,7 +5,7 @@ from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from .models import Company
 from .serializers import CompanySerializer
 from rest_framework.response import Response
-from django.core.cache import cache
+from voxlyne.caching import CachedListMixin
 
 
 # Create your views here.
@@ -50,27 +50,10 @@ class CompanyDetailView(generics.RetrieveUpdateDestroyAPIView):
         return [IsAuthenticated()]
 
 
-class CompanyViewSet(viewsets.ModelViewSet):
+class CompanyViewSet(CachedListMixin, viewsets.ModelViewSet):
     """API endpoint to manage companies."""
 
     queryset = Company.objects.select_related('user').all().order_by('id')
     serializer_class = CompanySerializer
     renderer_classes = [JSONRenderer, BrowsableAPIRenderer]
     permission_classes = [AllowAny]
-
-    def list(self, request, *args, **kwargs):
-        """Handle GET list requests, checking cache first."""
-        cache_key = 'Companies:cache:viewset_list'
-        cached_data = cache.get(cache_key)
-
-        if cached_data:
-            print(f"Cache hit for {cache_key}")
-            return Response(cached_data)
-
-        print(f"Cache miss for {cache_key}")
-        response = super().list(request, *args, **kwargs)
-
-        if response.status_code == 200:
-            cache.set(cache_key, response.data, timeout=300)
-
-        return response
@@ -0,0 +1,236 @@
+"""Batch generation of employment certificates.
+
+Certificates are rendered in a pool of worker processes and written to a
+ZIP archive as they finish. The archive is produced as a stream of chunks,
+so a batch of any size is never held in memory at once. Requests share one
+pool of ``DOCUMENT_CERTIFICATE_WORKERS`` processes, so concurrent batches
+queue for it instead of each forking their own.
+"""
+
+import json
+import logging
+import os
+import threading
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .workers import init_worker, render_certificate
+
+logger = logging.getLogger(__name__)
+
+BATCH_PROGRESS_CACHE_KEY = "Documents:certificate_batch:{}"
+BATCH_PROGRESS_TIMEOUT = 60 * 60
+
+
+def certificate_spec(document, employee, company, duration, position):
+    """Describe one certificate with plain values a worker can receive.
+
+    Args:
+        document (Document): Document the certificate is written on.
+        employee (Employee): Employee the certificate is about.
+        company (Company): Issuing company.
+        duration (str): How long the employee worked at the company.
+        position (str): Position held by the employee.
+
+    Returns:
+        dict: The certificate specification.
+    """
+    return {
+        "filename": f"certificate_{document.pk}_{employee.employee_id}.pdf",
+        "document_pdf": document.document_pdf.name,
+        "company_name": str(company),
+        "employee_name": str(employee),
+        "employee_id": str(employee.employee_id),
+        "duration": duration,
+        "position": position,
+        "company_logo": company.logo.name if company.logo else None,
+    }
+
+
+class BatchProgress:
+    """Progress of a certificate batch, shared through the cache.
+
+    Attributes:
+        batch_id (str): Identifier of the batch.
+        total (int): Number of certificates in the batch.
+        done (int): Number of certificates rendered.
+        failed (list): File names of the certificates that failed.
+    """
+
+    def __init__(self, total, batch_id=None):
+        self.batch_id = batch_id or uuid.uuid4().hex
+        self.total = total
+        self.done = 0
+        self.failed = []
+
+    def as_dict(self, status):
+        return {
+            "batch_id": self.batch_id,
+            "status": status,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+        }
+
+    def save(self, status="running"):
+        try:
+            cache.set(
+                BATCH_PROGRESS_CACHE_KEY.format(self.batch_id),
+                self.as_dict(status),
+                timeout=BATCH_PROGRESS_TIMEOUT,
+            )
+        except Exception as e:
+            # Progress is informational; never fail the batch over it.
+            logger.warning(
+                "Could not store progress of batch %s: %s", self.batch_id, e
+            )
+
+    @staticmethod
+    def get(batch_id):
+        """Return the stored progress of a batch, or None if unknown."""
+        return cache.get(BATCH_PROGRESS_CACHE_KEY.format(batch_id))
+
+
+_shared_pool = None
+_shared_pool_pid = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    """Return the process pool shared by the certificate batches of this process.
+
+    Returns:
+        tuple: ``(pool, workers)``.
+    """
+    global _shared_pool, _shared_pool_pid
+    workers = settings.DOCUMENT_CERTIFICATE_WORKERS or os.cpu_count()
+    with _shared_pool_lock:
+        if (
+            _shared_pool is None
+            or _shared_pool_pid != os.getpid()
+            or getattr(_shared_pool, "_broken", False)
+        ):
+            # Not created yet, inherited from a forked parent, or broken by
+            # a worker that died.
+            _shared_pool = ProcessPoolExecutor(
+                max_workers=workers, initializer=init_worker
+            )
+            _shared_pool_pid = os.getpid()
+        return _shared_pool, workers
+
+
+@contextmanager
+def _certificate_pool(workers):
+    if workers is None:
+        yield shared_pool()
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        yield pool, workers
+
+
+def render_certificates(specs, workers=None):
+    """Render certificates in a process pool, yielding them as they finish.
+
+    At most twice as many certificates as workers are in flight, so the
+    results waiting to be consumed stay bounded.
+
+    Args:
+        specs (iterable): Specifications from :func:`certificate_spec`.
+        workers (int, optional): Number of processes of a pool of this
+            batch's own. Defaults to the pool shared by all batches.
+
+    Yields:
+        tuple: ``(spec, data, error)`` with the PDF bytes or the error message.
+    """
+    specs = iter(specs)
+    with _certificate_pool(workers) as (pool, workers):
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < workers * 2:
+                spec = next(specs, None)
+                if spec is None:
+                    exhausted = True
+                    break
+                pending[pool.submit(render_certificate, spec)] = spec
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                spec = pending.pop(future)
+                try:
+                    data, error = future.result(), None
+                except Exception as e:
+                    logger.warning("Certificate %s failed: %s", spec["filename"], e)
+                    data, error = None, str(e)
+                try:
+                    yield spec, data, error
+                except GeneratorExit:
+                    # The consumer went away; don't render the rest.
+                    for future in pending:
+                        future.cancel()
+                    raise
+
+
+class _ZipStream:
+    """Unseekable file object collecting what ``zipfile`` writes."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_certificate_zip(specs, progress, workers=None):
+    """Generate a ZIP archive of certificates chunk by chunk.
+
+    ``zipfile`` writes to an unseekable stream with data descriptors, so
+    each certificate can be sent as soon as it is rendered. Failed
+    certificates are listed in an ``errors.json`` entry at the end.
+
+    Args:
+        specs (list): Specifications from :func:`certificate_spec`.
+        progress (BatchProgress): Progress updated after every certificate.
+        workers (int, optional): Number of worker processes.
+
+    Yields:
+        bytes: Consecutive chunks of the archive.
+    """
+    stream = _ZipStream()
+    errors = {}
+    names = set()
+    progress.save()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for spec, data, error in render_certificates(specs, workers):
+            if error is None:
+                name, n = spec["filename"], 1
+                while name in names:
+                    n += 1
+                    name = spec["filename"].replace(".pdf", f"_{n}.pdf")
+                names.add(name)
+                archive.writestr(name, data)
+                progress.done += 1
+            else:
+                errors[spec["filename"]] = error
+                progress.failed.append(spec["filename"])
+            progress.save()
+            yield stream.drain()
+        if errors:
+            archive.writestr("errors.json", json.dumps(errors, indent=2))
+    progress.save("done")
+    yield stream.drain()
@@ -0,0 +1,373 @@
+"""Duplicate detection of document hashes with a Bloom filter.
+
+Every document saved with ``Document.save`` has its ``document_hash``
+added to a Bloom filter once the insert commits. A hash the filter may
+have seen is confirmed with one query on the unique ``document_hash``
+index; a hash it has never seen is most likely new. "Most likely", since
+the filter misses hashes stored in the last few seconds by other
+processes, through ``bulk_create()`` or ``update()``, or while Redis was
+unreachable: use it to reject duplicates early, and keep the unique
+constraint, or a query, wherever a duplicate must never get through.
+``Document.generate_unique_document_hash`` checks uploads with it, and the
+``import_documents`` command whole batches of files with one query.
+
+The bits are kept in a Redis bitmap shared by all workers when
+``DOCUMENT_HASH_FILTER_SHARED`` is set, and in memory otherwise. Either
+filter is built from the database on first use; ``rebuild_hash_filter``
+builds it again, at deploy or e.g. after many documents were deleted.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Number of hashes the filter is sized for, and the false positive rate
+# expected at that size.
+HASH_FILTER_CAPACITY = getattr(settings, "DOCUMENT_HASH_FILTER_CAPACITY", 1_000_000)
+HASH_FILTER_ERROR_RATE = getattr(settings, "DOCUMENT_HASH_FILTER_ERROR_RATE", 0.001)
+# Seconds a process-local filter may lag behind documents stored by others.
+HASH_FILTER_REFRESH = getattr(settings, "DOCUMENT_HASH_FILTER_REFRESH", 5)
+# Seconds to wait before trying Redis again after an error.
+HASH_FILTER_RETRY_AFTER = 60
+
+HASH_FILTER_KEY = "Documents:hash_filter"
+HASH_FILTER_READY_KEY = "Documents:hash_filter:ready"
+HASH_FILTER_BUILD_LOCK_KEY = "Documents:hash_filter:building:lock"
+# Seconds a worker may hold the build lock before another one takes over.
+HASH_FILTER_BUILD_TIMEOUT = 300
+LOAD_BATCH_SIZE = 5000
+
+
+def filter_size(capacity, error_rate):
+    """Return the number of bits and of hash functions for a Bloom filter.
+
+    Args:
+        capacity (int): Number of items the filter is sized for.
+        error_rate (float): False positive rate wanted at that size.
+
+    Returns:
+        tuple: ``(bits, hashes)``.
+    """
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def bit_positions(value, bits, hashes):
+    """Return the filter positions of a value, by double hashing."""
+    digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], "big")
+    second = int.from_bytes(digest[8:], "big") | 1
+    return [(first + i * second) % bits for i in range(hashes)]
+
+
+def _stored_hashes(after_id=0):
+    """Yield ``(id, document_hash)`` of the stored documents, in ID order."""
+    from .models import Document
+
+    while True:
+        batch = list(
+            Document.objects.filter(pk__gt=after_id)
+            .order_by("pk")
+            .values_list("id", "document_hash")[:LOAD_BATCH_SIZE]
+        )
+        yield from batch
+        if len(batch) < LOAD_BATCH_SIZE:
+            return
+        after_id = batch[-1][0]
+
+
+class LocalBitArray:
+    """Filter bits kept in the memory of the current process."""
+
+    def __init__(self, bits):
+        self.bits = bytearray((bits + 7) // 8)
+        self.count = 0
+        self.last_id = 0
+        self.loaded_at = None
+
+    def set(self, positions):
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def test(self, positions):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in positions
+        )
+
+
+class RedisBitArray:
+    """Filter bits kept in a Redis bitmap shared by all processes."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def set(self, positions, key=HASH_FILTER_KEY):
+        pipeline = self.client.pipeline(transaction=False)
+        for position in positions:
+            pipeline.setbit(key, position, 1)
+        pipeline.execute()
+
+    def test(self, positions):
+        """Return the ready marker of the bitmap and whether all bits are set."""
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(HASH_FILTER_READY_KEY)
+        for position in positions:
+            pipeline.getbit(HASH_FILTER_KEY, position)
+        ready, *found = pipeline.execute()
+        return ready, all(found)
+
+
+class DocumentHashFilter:
+    """Bloom filter of the stored document hashes.
+
+    Attributes:
+        bits (int): Size of the filter in bits.
+        hashes (int): Number of positions set per hash.
+        shared (bool): Whether to keep the bits in Redis.
+    """
+
+    def __init__(self, capacity, error_rate, shared=False):
+        self.bits, self.hashes = filter_size(capacity, error_rate)
+        self.capacity = capacity
+        self.shared = shared
+        self._local = None
+        self._redis_failed_at = None
+        # Hashes added while Redis was unreachable, written once it is back;
+        # None once there were too many to keep, so the bitmap is rebuilt.
+        self._redis_pending = set()
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        """Return the shared bitmap, or None to use the local one."""
+        if not self.shared:
+            return None
+        if (
+            self._redis_failed_at is not None
+            and time.monotonic() - self._redis_failed_at < HASH_FILTER_RETRY_AFTER
+        ):
+            return None
+        try:
+            from django_redis import get_redis_connection
+
+            return RedisBitArray(get_redis_connection("default"))
+        except Exception as e:
+            self._redis_error(e)
+            return None
+
+    def _redis_error(self, error):
+        logger.warning("Document hash filter falling back to memory: %s", error)
+        self._redis_failed_at = time.monotonic()
+
+    def _keep_pending(self, document_hash):
+        with self._lock:
+            if self._redis_pending is None:
+                return
+            if len(self._redis_pending) >= LOAD_BATCH_SIZE:
+                self._redis_pending = None
+            else:
+                self._redis_pending.add(document_hash)
+
+    def _flush_pending(self, redis):
+        """Write the hashes added while Redis was unreachable to the bitmap."""
+        if self._redis_pending == set():
+            return
+        with self._lock:
+            pending, self._redis_pending = self._redis_pending, set()
+        if pending is None:
+            # Too many were missed: have the bitmap rebuilt from the database.
+            redis.client.delete(HASH_FILTER_READY_KEY)
+            return
+        try:
+            for document_hash in pending:
+                redis.set(self._positions(document_hash))
+        except Exception:
+            with self._lock:
+                if self._redis_pending is not None:
+                    self._redis_pending |= pending
+            raise
+
+    def _positions(self, document_hash):
+        return bit_positions(document_hash, self.bits, self.hashes)
+
+    def _load_local(self):
+        """Return the local filter, loading new documents when it is stale."""
+        with self._lock:
+            if self._local is None:
+                self._local = LocalBitArray(self.bits)
+            local = self._local
+            if (
+                local.loaded_at is None
+                or time.monotonic() - local.loaded_at >= HASH_FILTER_REFRESH
+            ):
+                for document_id, document_hash in _stored_hashes(local.last_id):
+                    local.set(self._positions(document_hash))
+                    local.count += 1
+                    local.last_id = document_id
+                local.loaded_at = time.monotonic()
+            return local
+
+    def _build_redis(self, redis):
+        """Fill the shared bitmap from the database.
+
+        The bits are written to a temporary key which then replaces the
+        filter, and documents stored meanwhile are added afterwards.
+        """
+        client = redis.client
+        temporary_key = f"{HASH_FILTER_KEY}:building"
+        client.delete(temporary_key)
+        client.setbit(temporary_key, self.bits - 1, 0)
+        count = last_id = 0
+        pipeline = client.pipeline(transaction=False)
+        for last_id, document_hash in _stored_hashes():
+            for position in self._positions(document_hash):
+                pipeline.setbit(temporary_key, position, 1)
+            count += 1
+            if count % LOAD_BATCH_SIZE == 0:
+                pipeline.execute()
+        pipeline.execute()
+        client.rename(temporary_key, HASH_FILTER_KEY)
+        client.set(HASH_FILTER_READY_KEY, f"{self.bits}:{self.hashes}")
+        for _, document_hash in _stored_hashes(last_id):
+            redis.set(self._positions(document_hash))
+            count += 1
+        with self._lock:
+            self._redis_pending = set()
+        return count
+
+    def _build_redis_once(self, redis):
+        """Build the shared bitmap unless another worker already is.
+
+        Returns:
+            bool: Whether this worker built it.
+        """
+        client = redis.client
+        if not client.set(
+            HASH_FILTER_BUILD_LOCK_KEY, 1, nx=True, ex=HASH_FILTER_BUILD_TIMEOUT
+        ):
+            return False
+        try:
+            self._build_redis(redis)
+        finally:
+            client.delete(HASH_FILTER_BUILD_LOCK_KEY)
+        return True
+
+    def rebuild(self):
+        """Build the filter again from the database.
+
+        Returns:
+            int: Number of hashes in the filter.
+        """
+        redis = self._redis()
+        if redis is not None:
+            try:
+                count = self._build_redis(redis)
+            except Exception as e:
+                self._redis_error(e)
+            else:
+                if count > self.capacity:
+                    logger.warning(
+                        "Document hash filter holds %d hashes, more than its "
+                        "capacity of %d; raise DOCUMENT_HASH_FILTER_CAPACITY.",
+                        count,
+                        self.capacity,
+                    )
+                return count
+        with self._lock:
+            self._local = None
+        return self._load_local().count
+
+    def add(self, document_hash):
+        """Add a stored hash to the filter."""
+        positions = self._positions(document_hash)
+        redis = self._redis()
+        if redis is not None:
+            try:
+                redis.set(positions)
+                self._flush_pending(redis)
+            except Exception as e:
+                self._redis_error(e)
+                redis = None
+        if redis is None and self.shared:
+            self._keep_pending(document_hash)
+        with self._lock:
+            if self._local is not None:
+                self._local.set(positions)
+
+    def might_contain(self, document_hash):
+        """Tell whether a hash may have been stored.
+
+        Returns:
+            bool: False if the filter has not seen this hash. See the module
+            documentation for the hashes it can miss.
+        """
+        positions = self._positions(document_hash)
+        redis = self._redis()
+        if redis is not None:
+            try:
+                self._flush_pending(redis)
+                ready, found = redis.test(positions)
+                if ready == f"{self.bits}:{self.hashes}".encode():
+                    return found
+                # Missing or built for another size. A single worker builds
+                # it; the others use their local filter meanwhile.
+                if self._build_redis_once(redis):
+                    return redis.test(positions)[1]
+            except Exception as e:
+                self._redis_error(e)
+        return self._load_local().test(positions)
+
+    def exists(self, document_hash):
+        """Tell whether a document with this hash is stored.
+
+        Hashes the filter has not seen are answered without a query, so a
+        hash stored very recently may be reported as missing.
+        """
+        from .models import Document
+
+        if not self.might_contain(document_hash):
+            return False
+        return Document.objects.filter(document_hash=document_hash).exists()
+
+    def existing(self, document_hashes):
+        """Return the hashes of a batch that are already stored.
+
+        Candidates are picked by the filter and confirmed with a single
+        query, however many hashes the batch holds. Like :meth:`exists`,
+        this may miss hashes stored very recently.
+
+        Args:
+            document_hashes (iterable): Hashes to look up.
+
+        Returns:
+            set: The hashes that belong to stored documents.
+        """
+        from .models import Document
+
+        candidates = {h for h in document_hashes if self.might_contain(h)}
+        if not candidates:
+            return set()
+        return set(
+            Document.objects.filter(document_hash__in=candidates).values_list(
+                "document_hash", flat=True
+            )
+        )
+
+    def add_on_commit(self, document_hash):
+        """Add a hash once the current transaction commits."""
+        transaction.on_commit(lambda: self.add(document_hash))
+
+
+document_hashes = DocumentHashFilter(
+    HASH_FILTER_CAPACITY,
+    HASH_FILTER_ERROR_RATE,
+    shared=getattr(settings, "DOCUMENT_HASH_FILTER_SHARED", False),
+)
@@ -0,0 +1,131 @@
+"""Integrity checks of stored document PDFs.
+
+``document_hash`` is the SHA-256 of the PDF as uploaded. Stamps written as
+incremental updates keep those bytes as a prefix of the stored file and
+record its length in the stamp marker, so the hash can be recomputed from
+the stored file alone, except for documents whose hash was randomized
+because their content was already stored. Files stamped by rewriting them
+can only be checked against their marker. Files in content-addressed
+storage must, in addition, hash to the digest in their name.
+"""
+
+import hashlib
+
+from PyPDF2 import PdfReader
+
+from .pdf_incremental import COPY_CHUNK_SIZE
+from .pdf_utils import (
+    STAMP_INFO_HASH,
+    STAMP_INFO_IDENTIFIER,
+    STAMP_INFO_SOURCE_SIZE,
+    read_stamp_marker,
+)
+from .storage import blob_digest
+
+# Results of verify_stored_file.
+FILE_OK = "ok"
+FILE_MISSING = "missing_file"
+FILE_UNREADABLE = "unreadable"
+FILE_NO_MARKER = "no_marker"
+FILE_MARKER_MISMATCH = "marker_mismatch"
+FILE_HASH_MISMATCH = "hash_mismatch"
+FILE_UNVERIFIABLE = "unverifiable"
+FILE_BLOB_MISMATCH = "blob_mismatch"
+
+
+def hash_prefix(file, length, whole=False):
+    """Return the SHA-256 of the first ``length`` bytes of a file.
+
+    Args:
+        file: Seekable binary file object.
+        length (int): Number of bytes to hash, or None for none.
+        whole (bool): Also hash the whole file in the same pass.
+
+    Returns:
+        tuple: ``(prefix digest, whole digest)``. The prefix digest is None
+        if the file is shorter than ``length``; the whole digest is None
+        unless requested.
+    """
+    prefix = hashlib.sha256()
+    full = hashlib.sha256() if whole else None
+    prefix_digest = None
+    position = 0
+    file.seek(0)
+    while True:
+        if full is None and length is not None and position >= length:
+            break
+        chunk = file.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        if full is not None:
+            full.update(chunk)
+        if length is not None and position < length:
+            prefix.update(chunk[: length - position])
+        position += len(chunk)
+    if length is not None and position >= length:
+        prefix_digest = prefix.hexdigest()
+    return prefix_digest, full.hexdigest() if full is not None else None
+
+
+def verify_stored_file(
+    storage, name, document_hash, unique_identifier, hash_randomized=False
+):
+    """Check a stored document PDF against its hash and identifier.
+
+    Files in content-addressed storage are also checked against the
+    SHA-256 their name was derived from, in the same pass over the file.
+
+    Args:
+        storage: Storage the file is kept in.
+        name (str): Storage name of the file.
+        document_hash (str): Expected hash of the original upload.
+        unique_identifier (str): Expected document identifier.
+        hash_randomized (bool): Whether ``document_hash`` is random rather
+            than the hash of the upload, which then can't be checked.
+
+    Returns:
+        tuple: ``(result, detail)`` where ``result`` is one of the ``FILE_*``
+        values and ``detail`` a message for anything but ``FILE_OK``.
+    """
+    expected_blob = blob_digest(name)
+    try:
+        file = storage.open(name, "rb")
+    except FileNotFoundError:
+        return FILE_MISSING, f"{name} does not exist"
+    except OSError as e:
+        # E.g. a directory, or a file this process may not read.
+        return FILE_UNREADABLE, f"{type(e).__name__}: {e}"
+    try:
+        with file:
+            marker = read_stamp_marker(PdfReader(file))
+            if marker is None:
+                return FILE_NO_MARKER, "file carries no stamp marker"
+            if (
+                marker[STAMP_INFO_HASH] != document_hash
+                or marker.get(STAMP_INFO_IDENTIFIER) != unique_identifier
+            ):
+                return FILE_MARKER_MISMATCH, (
+                    f"marker {marker[STAMP_INFO_HASH]} / "
+                    f"{marker.get(STAMP_INFO_IDENTIFIER)}"
+                )
+            source_size = marker.get(STAMP_INFO_SOURCE_SIZE)
+            if source_size is None and expected_blob is None:
+                return FILE_UNVERIFIABLE, "stamp was not written incrementally"
+            digest, blob = hash_prefix(
+                file,
+                int(source_size) if source_size is not None else None,
+                whole=expected_blob is not None,
+            )
+    except Exception as e:
+        # Malformed PDFs make PyPDF2 raise far more than PdfReadError, and
+        # reading may fail midway; neither may stop the other files.
+        return FILE_UNREADABLE, f"{type(e).__name__}: {e}"
+    if expected_blob is not None and blob != expected_blob:
+        return FILE_BLOB_MISMATCH, f"content hashes to {blob}"
+    if source_size is None:
+        return FILE_UNVERIFIABLE, "stamp was not written incrementally"
+    if hash_randomized:
+        return FILE_UNVERIFIABLE, "document hash was randomized"
+    if digest != document_hash:
+        return FILE_HASH_MISMATCH, f"original bytes hash to {digest}"
+    return FILE_OK, None
@@ -0,0 +1,165 @@
+"""Database-backed queue for processing document uploads in the background.
+
+Uploads are staged as ``DocumentJob`` rows by the API. Worker processes
+claim queued jobs with a conditional update, so several workers (or several
+``process_document_jobs`` commands) can share one table without handing out
+the same job twice.
+"""
+
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import OperationalError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Document, DocumentJob
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_document(validated_data, submitted_by=None):
+    """Stage an uploaded document for background processing.
+
+    Args:
+        validated_data (dict): Validated ``DocumentSerializer`` data.
+        submitted_by (User, optional): User uploading the document.
+
+    Returns:
+        DocumentJob: The queued job.
+    """
+    upload = validated_data["document_pdf"]
+    return DocumentJob.objects.create(
+        employee=validated_data["employee"],
+        company=validated_data["company"],
+        issued_date=validated_data["issued_date"],
+        is_signed=validated_data.get("is_signed", False),
+        staged_pdf=upload,
+        content_sha256=getattr(upload, "sha256", "") or "",
+        submitted_by=submitted_by,
+    )
+
+
+def claim_next_job():
+    """Mark the oldest queued job as running and return its ID.
+
+    Returns:
+        int: ID of the claimed job, or None when the queue is empty.
+    """
+    while True:
+        job_id = (
+            DocumentJob.objects.filter(status=DocumentJob.STATUS_QUEUED)
+            .order_by("id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if job_id is None:
+            return None
+        claimed = DocumentJob.objects.filter(
+            pk=job_id, status=DocumentJob.STATUS_QUEUED
+        ).update(
+            status=DocumentJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return job_id
+
+
+def requeue_stale_jobs(stale_after=None):
+    """Put back jobs left running by a worker that died.
+
+    Args:
+        stale_after (int, optional): Seconds after which a running job is
+            considered abandoned. Defaults to ``DOCUMENT_JOB_STALE_AFTER``.
+
+    Returns:
+        int: Number of jobs queued again.
+    """
+    if stale_after is None:
+        stale_after = settings.DOCUMENT_JOB_STALE_AFTER
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return DocumentJob.objects.filter(
+        status=DocumentJob.STATUS_RUNNING, started_at__lt=cutoff
+    ).update(status=DocumentJob.STATUS_QUEUED)
+
+
+def process_job(job_id):
+    """Stamp the staged PDF of a job and create its document.
+
+    The PDF is stamped and stored before any transaction is opened; only
+    the document row and the job status are written under the database
+    write lock. The staged file is deleted once that transaction commits.
+    Jobs that fail on a transient database error (e.g. a locked SQLite
+    database) are queued again until ``DOCUMENT_JOB_MAX_ATTEMPTS``.
+
+    Args:
+        job_id (int): ID of a job claimed with :func:`claim_next_job`.
+
+    Returns:
+        str: The resulting status of the job.
+    """
+    job = DocumentJob.objects.get(pk=job_id)
+    staged_name = job.staged_pdf.name
+    storage = job.staged_pdf.storage
+    document = Document(
+        employee_id=job.employee_id,
+        company_id=job.company_id,
+        issued_date=job.issued_date,
+        is_signed=job.is_signed,
+    )
+    stored_name = None
+    try:
+        with job.staged_pdf.open("rb") as staged:
+            upload = File(staged, name=os.path.basename(staged_name))
+            document.document_pdf = upload
+            document.document_hash = document.generate_unique_document_hash(
+                job.content_sha256 or None
+            )
+            document.unique_identifier = document.generate_unique_identifier()
+            document.add_metadata_to_pdf()
+        stamped = document.document_pdf
+        try:
+            stamped.save(stamped.name, stamped.file, save=False)
+        finally:
+            stamped.close()
+        stored_name = document.document_pdf.name
+
+        with transaction.atomic():
+            # Write first, so the transaction takes the write lock before it
+            # reads; a read-then-write transaction can't wait for the lock.
+            DocumentJob.objects.filter(pk=job_id).update(
+                status=DocumentJob.STATUS_DONE, error="", finished_at=timezone.now()
+            )
+            document.save()
+            DocumentJob.objects.filter(pk=job_id).update(document=document)
+            transaction.on_commit(lambda: storage.delete(staged_name))
+    except Exception as e:
+        if stored_name is not None:
+            document.document_pdf.storage.delete(stored_name)
+        if (
+            isinstance(e, OperationalError)
+            and job.attempts < settings.DOCUMENT_JOB_MAX_ATTEMPTS
+        ):
+            logger.warning("Document job %s will be retried: %s", job_id, e)
+            status = DocumentJob.STATUS_QUEUED
+        else:
+            logger.exception("Document job %s failed", job_id)
+            status = DocumentJob.STATUS_FAILED
+        try:
+            DocumentJob.objects.filter(pk=job_id).update(
+                status=status, error=str(e), finished_at=timezone.now()
+            )
+        except OperationalError as update_error:
+            # Left running; requeue_stale_jobs picks it up again later.
+            logger.error(
+                "Could not record the status of document job %s: %s",
+                job_id,
+                update_error,
+            )
+            return DocumentJob.STATUS_RUNNING
+        return status
+    return DocumentJob.STATUS_DONE
@@ -0,0 +1,132 @@
+"""In-process cache of company logos prepared for certificate rendering.
+
+A stored logo is decoded once, scaled to the size it is drawn at, flattened
+onto white and encoded as JPEG. reportlab embeds JPEG data as it is, so
+drawing a cached logo neither decodes the original image nor compresses
+its pixels again. Entries are keyed by storage name and modification time,
+so replacing a logo is picked up without explicit invalidation.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+
+from .pdf_utils import CERTIFICATE_LOGO_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Total size (bytes) of the encoded logos kept in memory per process.
+LOGO_CACHE_MAX_BYTES = getattr(
+    settings, "DOCUMENT_LOGO_CACHE_MAX_BYTES", 16 * 1024 * 1024
+)
+# Resolution the logos are scaled to, in pixels per inch of the certificate.
+LOGO_DPI = getattr(settings, "DOCUMENT_LOGO_DPI", 300)
+LOGO_JPEG_QUALITY = 90
+
+
+def prepare_logo(data):
+    """Scale and encode a logo image for the certificate header.
+
+    Args:
+        data (bytes): The original image file.
+
+    Returns:
+        bytes: JPEG data sized for ``CERTIFICATE_LOGO_SIZE`` at ``LOGO_DPI``.
+    """
+    width, height = (
+        round(points * LOGO_DPI / 72) for points in CERTIFICATE_LOGO_SIZE
+    )
+    with Image.open(BytesIO(data)) as image:
+        image.draft("RGB", (width, height))
+        image = image.convert("RGBA").resize((width, height), Image.LANCZOS)
+    flattened = Image.new("RGB", image.size, "white")
+    flattened.paste(image, mask=image.getchannel("A"))
+    output = BytesIO()
+    flattened.save(output, "JPEG", quality=LOGO_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+class LogoCache:
+    """Least recently used cache of prepared logos, bounded by size.
+
+    Attributes:
+        max_bytes (int): Maximum total size of the cached JPEG data.
+        size (int): Current total size of the cached JPEG data.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, storage=default_storage):
+        """Return the prepared logo stored under ``name``.
+
+        Args:
+            name (str): Storage name of the logo.
+            storage: Storage the logo is read from.
+
+        Returns:
+            bytes: The prepared JPEG data.
+        """
+        try:
+            modified = storage.get_modified_time(name).timestamp()
+        except NotImplementedError:
+            modified = None
+        key = (name, modified)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+
+        with storage.open(name, "rb") as f:
+            data = prepare_logo(f.read())
+
+        with self._lock:
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+logo_cache = LogoCache(LOGO_CACHE_MAX_BYTES)
+
+
+def logo_image(name, storage=default_storage):
+    """Return a stored logo ready to be passed to ``drawImage``.
+
+    Args:
+        name (str): Storage name of the logo.
+        storage: Storage the logo is read from.
+
+    Returns:
+        ImageReader: The prepared logo, or None if it cannot be read.
+    """
+    try:
+        return ImageReader(BytesIO(logo_cache.get(name, storage)))
+    except (OSError, ValueError) as e:
+        logger.warning("Could not load logo %s: %s", name, e)
+        return None
+
+
+def company_logo_image(company):
+    """Return the stored logo of a company, or None if it has none."""
+    if not company.logo:
+        return None
+    return logo_image(company.logo.name, company.logo.storage)
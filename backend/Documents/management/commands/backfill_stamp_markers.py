@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from PyPDF2 import PdfReader
+from Documents import verification
+from Documents.models import Document
+from Documents.pdf_utils import is_pdf_stamped
+from voxlyne.caching import bump_model_version
+
+
+class Command(BaseCommand):
+    """Record the stamp marker in stored document PDFs that lack it.
+
+    Files stamped before the marker existed get a marker-only revision;
+    files that were never stamped are stamped. Documents are walked in
+    primary key order, in batches, so the command can run against large
+    tables and be restarted with ``--start-after``.
+    """
+
+    help = "Backfill the machine-readable stamp marker on stored document PDFs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Number of documents loaded per query.",
+        )
+        parser.add_argument(
+            "--start-after",
+            type=int,
+            default=0,
+            help="Only process documents with a greater ID.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report which documents lack the marker.",
+        )
+
+    def handle(self, *args, **options):
+        last_id = options["start_after"]
+        checked = upgraded = failed = 0
+
+        while True:
+            batch = list(
+                Document.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .only("id", "document_pdf", "document_hash", "unique_identifier")[
+                    : options["batch_size"]
+                ]
+            )
+            if not batch:
+                break
+
+            for document in batch:
+                last_id = document.pk
+                checked += 1
+                try:
+                    if options["dry_run"]:
+                        with document.document_pdf.open("rb") as f:
+                            if not is_pdf_stamped(
+                                PdfReader(f),
+                                document.document_hash,
+                                document.unique_identifier,
+                            ):
+                                upgraded += 1
+                                self.stdout.write(f"Missing marker: {document.pk}")
+                        continue
+
+                    with transaction.atomic():
+                        replaced_name = document.add_metadata_to_pdf()
+                        if replaced_name is not None:
+                            Document.objects.filter(pk=document.pk).update(
+                                document_pdf=document.document_pdf.name
+                            )
+                            upgraded += 1
+                    if replaced_name is not None:
+                        verification.reindex([document.pk])
+                except Exception as e:
+                    # Malformed PDFs raise more than PdfReadError; log them
+                    # and go on with the next document.
+                    failed += 1
+                    self.stderr.write(
+                        f"Document {document.pk}: {type(e).__name__}: {e}"
+                    )
+                finally:
+                    document.document_pdf.close()
+
+            self.stdout.write(f"Processed up to document {last_id}")
+
+        if upgraded and not options["dry_run"]:
+            # Rows were changed with update(), which sends no signals.
+            bump_model_version(Document)
+        action = "missing the marker" if options["dry_run"] else "upgraded"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{checked} documents checked, {upgraded} {action}, {failed} failed."
+            )
+        )
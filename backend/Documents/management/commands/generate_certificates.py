@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Documents.certificates import BatchProgress, stream_certificate_zip
+from Documents.serializers import CertificateBatchSerializer
+
+
+class Command(BaseCommand):
+    """Generate a ZIP archive of employment certificates.
+
+    The input is a JSON file with a list of objects holding ``document``,
+    ``employee``, ``company``, ``duration`` and ``position``. Certificates
+    are rendered in a pool of worker processes and appended to the archive
+    as they finish.
+    """
+
+    help = "Generate employment certificates in bulk into a ZIP archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "input", help="JSON file with the certificates to generate."
+        )
+        parser.add_argument("output", help="Path of the ZIP archive to write.")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of worker processes (defaults to the number of CPUs).",
+        )
+
+    def handle(self, *args, **options):
+        with open(options["input"], encoding="utf-8") as f:
+            entries = json.load(f)
+        serializer = CertificateBatchSerializer(data={"certificates": entries})
+        if not serializer.is_valid():
+            raise CommandError(json.dumps(serializer.errors))
+        specs = serializer.certificate_specs()
+
+        progress = BatchProgress(len(specs))
+        self.stdout.write(f"Batch {progress.batch_id}: {progress.total} certificates")
+        with open(options["output"], "wb") as output:
+            for chunk in stream_certificate_zip(specs, progress, options["workers"]):
+                output.write(chunk)
+                finished = progress.done + len(progress.failed)
+                self.stdout.write(f"{finished}/{progress.total}", ending="\r")
+
+        self.stdout.write("")
+        for filename in progress.failed:
+            self.stderr.write(f"Failed: {filename}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{progress.done} certificates written to {options['output']}, "
+                f"{len(progress.failed)} failed."
+            )
+        )
@@ -0,0 +1,111 @@
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from django.utils.dateparse import parse_date
+
+from Companies.models import Company
+from Documents.duplicates import document_hashes
+from Documents.models import Document
+from Employees.models import Employee
+
+
+def file_sha256(path):
+    """Return the SHA-256 of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Command(BaseCommand):
+    """Import the PDF files of a directory as documents of one employee.
+
+    Files are read in batches. The hashes of a batch are looked up in the
+    duplicate filter (``Documents.duplicates``) and the candidates confirmed
+    with a single query, so files whose content is already stored are
+    skipped without a query per file. A duplicate the filter misses is
+    still rejected by the unique constraint, and skipped too.
+    """
+
+    help = "Import a directory of PDF files, skipping the ones already stored."
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Directory holding the PDF files.")
+        parser.add_argument("--employee", type=int, required=True)
+        parser.add_argument("--company", type=int, required=True)
+        parser.add_argument(
+            "--issued-date", required=True, help="Issue date, as YYYY-MM-DD."
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of files looked up in the duplicate filter at once.",
+        )
+
+    def handle(self, *args, **options):
+        issued_date = parse_date(options["issued_date"])
+        if issued_date is None:
+            raise CommandError(f"Invalid date: {options['issued_date']}")
+        try:
+            employee = Employee.objects.get(pk=options["employee"])
+            company = Company.objects.get(pk=options["company"])
+        except (Employee.DoesNotExist, Company.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        directory = options["directory"]
+        paths = sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.lower().endswith(".pdf")
+        )
+        imported = skipped = failed = 0
+        for start in range(0, len(paths), options["batch_size"]):
+            batch = {}
+            for path in paths[start : start + options["batch_size"]]:
+                try:
+                    document_hash = file_sha256(path)
+                except OSError as e:
+                    failed += 1
+                    self.stderr.write(f"{path}: {e}")
+                    continue
+                if document_hash in batch:
+                    # The same content twice in the directory.
+                    skipped += 1
+                else:
+                    batch[document_hash] = path
+            stored = document_hashes.existing(batch)
+            for document_hash, path in batch.items():
+                if document_hash in stored:
+                    skipped += 1
+                    continue
+                document = Document(
+                    employee=employee,
+                    company=company,
+                    issued_date=issued_date,
+                    document_hash=document_hash,
+                )
+                try:
+                    with open(path, "rb") as f:
+                        document.document_pdf = File(f, name=os.path.basename(path))
+                        document.save()
+                except IntegrityError:
+                    # Stored meanwhile, or missed by the filter.
+                    skipped += 1
+                    continue
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"{path}: {type(e).__name__}: {e}")
+                    continue
+                imported += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{imported} documents imported, {skipped} already stored, "
+                f"{failed} failed."
+            )
+        )
@@ -0,0 +1,168 @@
+import os
+from datetime import timedelta
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from Documents import verification
+from Documents.models import Document, DocumentBlob
+from Documents.storage import blob_digest, document_storage
+from voxlyne.caching import bump_model_version
+
+
+class Command(BaseCommand):
+    """Move document files into the content-addressed storage layout.
+
+    Every file stored under its upload name is copied into the blob layout
+    of the ``"documents"`` storage, the row is pointed at the blob and the
+    old file is removed once no row references it any more. Documents are
+    walked in primary key order, in batches, so the command can be
+    restarted with ``--start-after``.
+
+    With ``--gc`` the blob reference counts are recomputed from the
+    documents and blobs nobody references are deleted. Blobs referenced,
+    and files written, in the last ``--gc-grace`` seconds are left alone,
+    since they may belong to an upload whose transaction is still open.
+    Prefer running it off-peak, and never with a grace period shorter
+    than the longest upload.
+    """
+
+    help = "Move document files into content-addressed storage."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Number of documents loaded per query.",
+        )
+        parser.add_argument(
+            "--start-after",
+            type=int,
+            default=0,
+            help="Only process documents with a greater ID.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report which documents would be moved.",
+        )
+        parser.add_argument(
+            "--gc",
+            action="store_true",
+            help="Recompute reference counts and delete unreferenced blobs.",
+        )
+        parser.add_argument(
+            "--gc-grace",
+            type=int,
+            default=3600,
+            help="Seconds during which a newly referenced blob is kept by --gc.",
+        )
+
+    def handle(self, *args, **options):
+        storage = document_storage()
+        last_id = options["start_after"]
+        moved = failed = 0
+
+        while True:
+            batch = list(
+                Document.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("id", "document_pdf")[: options["batch_size"]]
+            )
+            if not batch:
+                break
+
+            for document_id, old_name in batch:
+                last_id = document_id
+                if blob_digest(old_name) is not None:
+                    continue
+                if options["dry_run"]:
+                    moved += 1
+                    self.stdout.write(f"Would move {document_id}: {old_name}")
+                    continue
+                try:
+                    with default_storage.open(old_name, "rb") as f:
+                        new_name = storage.save(old_name, File(f))
+                    with transaction.atomic():
+                        Document.objects.filter(pk=document_id).update(
+                            document_pdf=new_name
+                        )
+                    verification.reindex([document_id])
+                    if not Document.objects.filter(document_pdf=old_name).exists():
+                        default_storage.delete(old_name)
+                    moved += 1
+                except OSError as e:
+                    failed += 1
+                    self.stderr.write(f"Document {document_id}: {e}")
+
+            self.stdout.write(f"Processed up to document {last_id}")
+
+        if moved and not options["dry_run"]:
+            # Rows were changed with update(), which sends no signals.
+            bump_model_version(Document)
+        action = "to move" if options["dry_run"] else "moved"
+        self.stdout.write(
+            self.style.SUCCESS(f"{moved} documents {action}, {failed} failed.")
+        )
+        if options["gc"] and not options["dry_run"]:
+            self.collect_garbage(storage, options["gc_grace"])
+
+    def collect_garbage(self, storage, grace):
+        """Recompute blob reference counts and delete unreferenced blobs.
+
+        Rows are only changed if their reference count and last reference
+        are still the ones read, so a save committing meanwhile wins.
+        """
+        cutoff = timezone.now() - timedelta(seconds=grace)
+        self.stdout.write(
+            self.style.WARNING(
+                f"Collecting blobs not referenced since {cutoff:%Y-%m-%d %H:%M:%S}; "
+                "uploads running for longer than that would lose their file."
+            )
+        )
+        references = dict(
+            Document.objects.values("document_pdf")
+            .annotate(n=Count("id"))
+            .values_list("document_pdf", "n")
+        )
+        updated = deleted = 0
+        for blob in DocumentBlob.objects.filter(referenced_at__lt=cutoff).iterator():
+            unchanged = DocumentBlob.objects.filter(
+                pk=blob.pk, refcount=blob.refcount, referenced_at=blob.referenced_at
+            )
+            refcount = references.get(blob.name, 0)
+            if refcount:
+                if refcount != blob.refcount and unchanged.update(refcount=refcount):
+                    updated += 1
+                continue
+            if not unchanged.delete()[0]:
+                continue
+            if storage.exists(blob.name):
+                os.remove(storage.path(blob.name))
+            deleted += 1
+
+        # Files left without a row, e.g. by a rolled back upload.
+        known = set(DocumentBlob.objects.values_list("name", flat=True))
+        root = storage.path(storage.prefix)
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, "/")
+                if name in known or blob_digest(name) is None:
+                    continue
+                if os.path.getmtime(path) > cutoff.timestamp():
+                    continue
+                os.remove(path)
+                deleted += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Garbage collection: {updated} reference counts fixed, "
+                f"{deleted} blobs deleted."
+            )
+        )
@@ -0,0 +1,83 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from Documents.jobs import claim_next_job, requeue_stale_jobs
+from Documents.workers import init_worker, run_job
+
+
+class Command(BaseCommand):
+    """Process queued document uploads in a pool of worker processes.
+
+    This process only claims jobs and hands their IDs to the pool; parsing
+    and stamping the PDFs happens in the workers, each with its own
+    database connection.
+    """
+
+    help = "Stamp queued document uploads in a pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.DOCUMENT_JOB_WORKERS,
+            help="Number of worker processes (defaults to the number of CPUs).",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait before looking for new jobs when idle.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of waiting for jobs.",
+        )
+
+    def handle(self, *args, **options):
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} stale jobs")
+
+        # Workers must not inherit the connection of this process.
+        connections.close_all()
+        workers = options["workers"] or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            pending = set()
+            job_ids = {}
+            while True:
+                while len(pending) < workers:
+                    job_id = claim_next_job()
+                    if job_id is None:
+                        break
+                    future = pool.submit(run_job, job_id)
+                    job_ids[future] = job_id
+                    pending.add(future)
+
+                if not pending:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+                    continue
+
+                done, pending = wait(
+                    pending,
+                    timeout=options["poll_interval"],
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    job_id = job_ids.pop(future)
+                    try:
+                        _, status = future.result()
+                    except Exception as e:
+                        # Left running; requeued once stale.
+                        self.stderr.write(f"Job {job_id}: worker error: {e}")
+                        continue
+                    self.stdout.write(f"Job {job_id}: {status}")
+
+        self.stdout.write(self.style.SUCCESS("Document job queue drained."))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from Documents.duplicates import document_hashes
+
+
+class Command(BaseCommand):
+    """Rebuild the duplicate filter of document hashes from the database.
+
+    Bloom filters cannot forget a hash, so after many documents have been
+    deleted the filter answers "maybe" more often than it should. A rebuild
+    starts from the stored hashes only. Without a shared (Redis) filter
+    each process keeps its own, so only the shared one benefits.
+    """
+
+    help = "Rebuild the Bloom filter of stored document hashes."
+
+    def handle(self, *args, **options):
+        count = document_hashes.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Hash filter rebuilt with {count} hashes "
+                f"({document_hashes.bits} bits, "
+                f"{document_hashes.hashes} hash functions)."
+            )
+        )
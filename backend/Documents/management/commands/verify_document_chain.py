@@ -0,0 +1,207 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from Documents.integrity import FILE_OK, FILE_UNVERIFIABLE
+from Documents.models import CompanyChainHead, Document
+from Documents.workers import init_worker, verify_document_file
+
+
+class Command(BaseCommand):
+    """Verify stored document PDFs and the per-company hash chains.
+
+    Documents are read in primary key order, in keyset batches. For every
+    document the command checks that ``document_hash_previous`` is the hash
+    of the company's previous document, and a pool of worker processes
+    re-hashes the stored file (see ``Documents.integrity``). Problems are
+    written to a JSON-lines report, one object per line.
+
+    With ``--checkpoint`` the position, the chain state and the size of
+    the report are saved after every batch. A later run with the same
+    checkpoint cuts the report back to that size, dropping the lines of an
+    interrupted batch, and resumes there.
+    """
+
+    help = "Verify document files and hash chains, writing a JSON-lines report."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--report",
+            required=True,
+            help="File the JSON-lines report is appended to.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="File holding the progress, to resume an interrupted run.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of documents loaded per query.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of worker processes (defaults to the number of CPUs).",
+        )
+        parser.add_argument(
+            "--skip-files",
+            action="store_true",
+            help="Only check the hash chains, without reading any file.",
+        )
+
+    def load_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return {"last_id": 0, "heads": {}, "counts": {}}
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError as e:
+            raise CommandError(f"Unreadable checkpoint {path}: {e}")
+
+    def save_checkpoint(self, path, state):
+        if not path:
+            return
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_path, path)
+
+    def count(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def problem(self, kind, document_id, company_id, **details):
+        self.count(kind)
+        entry = {"type": kind, "document": document_id, "company": company_id}
+        self.report.write(json.dumps({**entry, **details}) + "\n")
+
+    def check_chain(self, batch):
+        """Check the links of a batch against the heads seen so far."""
+        for document in batch:
+            company_id = str(document["company_id"])
+            expected = self.heads.get(company_id)
+            if document["document_hash_previous"] != expected:
+                self.problem(
+                    "broken_link",
+                    document["id"],
+                    document["company_id"],
+                    expected=expected,
+                    found=document["document_hash_previous"],
+                )
+            self.heads[company_id] = document["document_hash"]
+            self.count("documents")
+
+    def check_files(self, pool, workers, batch):
+        """Re-hash the files of a batch in the worker processes."""
+        companies = {document["id"]: document["company_id"] for document in batch}
+        items = [
+            (
+                document["id"],
+                document["document_pdf"],
+                document["document_hash"],
+                document["unique_identifier"],
+                document["hash_randomized"],
+            )
+            for document in batch
+        ]
+        results = pool.map(
+            verify_document_file,
+            items,
+            chunksize=max(1, len(items) // (workers * 4)),
+        )
+        for document_id, result, detail in results:
+            if result == FILE_OK:
+                self.count("files_ok")
+            elif result == FILE_UNVERIFIABLE:
+                self.count(result)
+            else:
+                self.problem(
+                    result, document_id, companies[document_id], detail=detail
+                )
+
+    def check_heads(self):
+        """Compare the stored chain heads with the last hashes seen."""
+        heads = CompanyChainHead.objects.values_list("company_id", "head_hash")
+        for company_id, head_hash in heads:
+            expected = self.heads.get(str(company_id))
+            if head_hash != expected:
+                self.problem(
+                    "head_mismatch",
+                    None,
+                    company_id,
+                    expected=expected,
+                    found=head_hash,
+                )
+
+    def handle(self, *args, **options):
+        state = self.load_checkpoint(options["checkpoint"])
+        self.heads = state["heads"]
+        self.counts = state["counts"]
+        if state["last_id"]:
+            self.stdout.write(f"Resuming after document {state['last_id']}")
+
+        pool = None
+        workers = options["workers"] or os.cpu_count()
+        if not options["skip_files"]:
+            # Workers must not inherit the connection of this process.
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+
+        with open(options["report"], "a", encoding="utf-8") as self.report:
+            if state.get("report_size") is not None:
+                # Lines written after the checkpoint are written again below.
+                self.report.truncate(state["report_size"])
+            try:
+                while True:
+                    batch = list(
+                        Document.objects.filter(pk__gt=state["last_id"])
+                        .order_by("pk")
+                        .values(
+                            "id",
+                            "company_id",
+                            "document_hash",
+                            "document_hash_previous",
+                            "unique_identifier",
+                            "hash_randomized",
+                            "document_pdf",
+                        )[: options["batch_size"]]
+                    )
+                    if not batch:
+                        break
+                    self.check_chain(batch)
+                    if pool is not None:
+                        self.check_files(pool, workers, batch)
+
+                    state["last_id"] = batch[-1]["id"]
+                    self.report.flush()
+                    state["report_size"] = os.fstat(self.report.fileno()).st_size
+                    self.save_checkpoint(options["checkpoint"], state)
+                    self.stdout.write(
+                        f"Verified up to document {state['last_id']} "
+                        f"({self.counts['documents']} documents)"
+                    )
+            finally:
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
+
+            self.check_heads()
+            self.report.write(json.dumps({"type": "summary", **self.counts}) + "\n")
+
+        self.save_checkpoint(options["checkpoint"], state)
+        problems = sum(
+            value
+            for key, value in self.counts.items()
+            if key not in ("documents", "files_ok", FILE_UNVERIFIABLE)
+        )
+        style = self.style.SUCCESS if not problems else self.style.ERROR
+        self.stdout.write(
+            style(
+                f"{self.counts.get('documents', 0)} documents verified, "
+                f"{problems} problems written to {options['report']}."
+            )
+        )
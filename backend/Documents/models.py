@@ -1,11 +1,20 @@
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.utils import timezone
+from Accounts.models import User
 from Employees.models import Employee
 from Companies.models import Company
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from io import BytesIO
+from PyPDF2 import PdfReader
+from .pdf_utils import (
+    has_legacy_stamp,
+    is_pdf_stamped,
+    mark_pdf_stamped,
+    open_spooled_pdf,
+    stamp_pdf,
+)
+from .duplicates import document_hashes
+from .storage import document_storage
 import os
 import logging
 import hashlib
@@ -63,9 +72,11 @@ class Document(models.Model):
 
     Attributes:
         document_hash (str): Unique hash of the document content.
+        hash_randomized (bool): Whether ``document_hash`` is random, since
+            a document with the same content already had the content hash.
         employee (ForeignKey): Associated employee.
         company (ForeignKey): Associated company.
-        document_pdf (FileField): The actual PDF file.
+        document_pdf (FileField): The actual PDF file, stored by content.
         document_hash_previous (str): Hash of the previous version.
         issued_date (Date): Date when the document was issued.
         unique_identifier (str): Unique identifier for the document.
@@ -76,10 +87,15 @@ class Document(models.Model):
     document_hash = models.CharField(
         max_length=64, unique=True, null=False, editable=False
     )
+    hash_randomized = models.BooleanField(default=False, editable=False)
     employee = models.ForeignKey(Employee, on_delete=models.CASCADE)
-    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    # Indexed together with the ID, see Meta.indexes.
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, db_index=False)
     document_pdf = models.FileField(
-        upload_to="Documents/files/", validators=[validate_pdf], null=False
+        upload_to="Documents/files/",
+        storage=document_storage,
+        validators=[validate_pdf],
+        null=False,
     )
     document_hash_previous = models.CharField(
         max_length=64, null=True, blank=True, editable=False
@@ -93,6 +109,11 @@ class Document(models.Model):
         max_length=100, unique=True, null=True, blank=True, editable=False
     )
 
+    class Meta:
+        # The documents of a company in ID order, both ways: company pages
+        # (keyset on the ID) and the newest document of the hash chain.
+        indexes = [models.Index(fields=["company", "id"])]
+
     def save(self, *args, **kwargs):
         """Save the document record.
 
@@ -112,27 +133,52 @@ class Document(models.Model):
         if not self.copy_id:
             self.copy_id = self.generate_copy_id()
             logging.info(f"Generated copy ID: {self.copy_id}")
-        if not self.pk:
-            previous_document = (
-                Document.objects.filter(company=self.company).order_by("-id").first()
-            )
-            if previous_document:
-                self.document_hash_previous = previous_document.document_hash
-
-        self.add_metadata_to_pdf()
-        super(Document, self).save(*args, **kwargs)
+        is_insert = not self.pk
+
+        update_fields = kwargs.get("update_fields")
+        is_new_file = not self.document_pdf._committed
+        replaced_name = None
+        if update_fields is None or "document_pdf" in update_fields:
+            replaced_name = self.add_metadata_to_pdf()
+        stamped_pdf = self.document_pdf
+        try:
+            with transaction.atomic():
+                if is_insert:
+                    # Link to the company chain in the transaction of the insert.
+                    self.document_hash_previous = CompanyChainHead.advance(
+                        self.company_id, self.document_hash
+                    )
+                    document_hashes.add_on_commit(self.document_hash)
+                super(Document, self).save(*args, **kwargs)
+        except Exception:
+            # The reference to a fresh upload was taken in the savepoint and
+            # is gone with it; its file is left to garbage collection. The
+            # stamped replacement was stored before it, so release it here.
+            if replaced_name:
+                stamped_pdf.storage.delete(stamped_pdf.name)
+            raise
+        if is_new_file:
+            # Release the spooled upload; later reads go through storage.
+            stamped_pdf.close()
+            self.document_pdf = stamped_pdf.name
 
     @staticmethod
-    def get_documents_by_company(company_id):
-        """Retrieve all documents associated with a specific company.
+    def get_documents_by_company(company_id, after_id=None):
+        """Retrieve the documents associated with a specific company.
 
         Args:
             company_id: The ID of the company.
+            after_id (int, optional): Only return documents with a greater
+                ID, to read the documents page by page (keyset pagination).
 
         Returns:
-            QuerySet: A queryset of Document objects for the company.
+            QuerySet: A queryset of Document objects for the company, in ID
+            order.
         """
-        return Document.objects.filter(company_id=company_id).order_by("id")
+        documents = Document.objects.filter(company_id=company_id)
+        if after_id is not None:
+            documents = documents.filter(pk__gt=after_id)
+        return documents.order_by("id")
 
     @classmethod
     def find_by_identifier(cls, identifier):
@@ -152,23 +198,45 @@ class Document(models.Model):
     def generate_document_hash(self):
         """Generate a hash for the document content.
 
+        Uploads received through the hashing upload handlers already carry
+        their SHA-256 digest, which is reused as is. Otherwise the file is
+        hashed in chunks, without loading it into memory.
+
         Returns:
             str: The SHA-256 hash of the document content.
         """
-        self.document_pdf.seek(0)
-        return hashlib.sha256(self.document_pdf.read()).hexdigest()
-
-    def generate_unique_document_hash(self):
+        if not self.document_pdf._committed:
+            digest = getattr(self.document_pdf.file, "sha256", None)
+            if digest:
+                return digest
+        sha256 = hashlib.sha256()
+        for chunk in self.document_pdf.chunks():
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def generate_unique_document_hash(self, content_hash=None):
         """Generate a unique hash for the document.
 
-        Ensures the generated hash is unique in the system.
+        Ensures the generated hash is unique in the system. New content is
+        recognized by the duplicate filter without a query; a hash the
+        filter may have seen is confirmed with one indexed query. A hash
+        stored moments ago by another process can be missed, like one
+        stored by a concurrent upload of the same file: the unique
+        constraint then rejects the insert.
+
+        Args:
+            content_hash (str, optional): SHA-256 of the content, already
+                computed (e.g. by the upload handler). Computed from the
+                file if not given.
 
         Returns:
             str: A unique SHA-256 hash.
         """
-        document_hash = self.generate_document_hash()
-        while Document.objects.filter(document_hash=document_hash).exists():
+        document_hash = content_hash or self.generate_document_hash()
+        self.hash_randomized = False
+        while document_hashes.exists(document_hash):
             document_hash = hashlib.sha256(uuid.uuid4().bytes).hexdigest()
+            self.hash_randomized = True
         return document_hash
 
     def generate_unique_identifier(self):
@@ -193,47 +261,241 @@ class Document(models.Model):
         """Add metadata to the PDF document.
 
         This method adds the document hash and unique identifier to the
-        last page of the PDF document.
+        last page of the PDF document. The stamped copy is spooled to an
+        anonymous temporary buffer and written to the storage backend once.
+        With ``DOCUMENT_STAMP_MODE = "incremental"`` the stamp is appended
+        as a new PDF revision and the original bytes are kept as they are.
+
+        For a file that is not in storage yet (a fresh upload), the stamped
+        buffer replaces the pending upload and is written by the normal
+        ``FileField`` save. For a file already in storage, the stamped copy
+        is stored under a new name and the previous file is only deleted
+        after the surrounding transaction commits, so a rollback never leaves
+        the row pointing at a missing file.
+
+        Whether the file is already stamped is read from the stamp marker in
+        the document information, without touching the pages. Stored files
+        stamped before the marker existed are recognised by their text once
+        and upgraded with a marker-only revision.
+
+        Returns:
+            str: Name of the previous stored file when it was replaced,
+            otherwise None.
         """
-        self.document_pdf.seek(0)
+        self.document_pdf.open("rb")
         existing_pdf = PdfReader(self.document_pdf)
-        output = PdfWriter()
-
-        packet = BytesIO()
-        can = canvas.Canvas(packet, pagesize=letter)
-        can.setFont("Helvetica", 8)
-        page_width, page_height = letter
-        can.drawString(page_width / 2, 10, f"Hash: {self.document_hash}")
-        can.drawString(page_width / 2, 25, f"ID: {self.unique_identifier}")
-        can.save()
-
-        packet.seek(0)
-        new_pdf = PdfReader(packet)
-
-        last_page = existing_pdf.pages[-1]
-        last_page_text = last_page.extract_text()
-        if (
-            f"Hash: {self.document_hash}" in last_page_text
-            and f"ID: {self.unique_identifier}" in last_page_text
+        if is_pdf_stamped(existing_pdf, self.document_hash, self.unique_identifier):
+            return None
+
+        if self.document_pdf._committed and has_legacy_stamp(
+            existing_pdf, self.document_hash, self.unique_identifier
         ):
-            return
+            write_pdf = mark_pdf_stamped
+        else:
+            write_pdf = stamp_pdf
+        output = open_spooled_pdf()
+        try:
+            write_pdf(
+                existing_pdf,
+                self.document_pdf,
+                output,
+                self.document_hash,
+                self.unique_identifier,
+            )
+        except Exception:
+            output.close()
+            raise
+
+        filename = os.path.basename(self.document_pdf.name)
+        if not self.document_pdf._committed:
+            self.document_pdf = File(output, name=filename)
+            return None
 
-        for page_num in range(len(existing_pdf.pages)):
-            page = existing_pdf.pages[page_num]
-            if page_num == len(existing_pdf.pages) - 1:
-                page.merge_page(new_pdf.pages[0])
-            output.add_page(page)
+        storage = self.document_pdf.storage
+        previous_name = self.document_pdf.name
+        try:
+            self.document_pdf.save(filename, File(output), save=False)
+        finally:
+            output.close()
+        transaction.on_commit(lambda: storage.delete(previous_name))
+        return previous_name
+
+
+class DocumentBlob(models.Model):
+    """Model counting the references to a content-addressed document file.
+
+    Attributes:
+        name (str): Storage name of the file.
+        sha256 (str): SHA-256 of the file content.
+        size (int): Size of the file in bytes.
+        refcount (int): Number of saves not yet released by a delete.
+        created_at (datetime): Date and time the file was first stored.
+        referenced_at (datetime): Date and time of the last save taking a
+            reference, which garbage collection leaves alone for a while.
+    """
+
+    name = models.CharField(max_length=255, primary_key=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    referenced_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Document Blob"
+        verbose_name_plural = "Document Blobs"
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
 
-        output_stream = BytesIO()
-        output.write(output_stream)
-        output_stream.seek(0)
 
-        temp_filename = os.path.join("", f"temp_{uuid.uuid4().hex}.pdf")
-        with open(temp_filename, "wb") as f:
-            f.write(output_stream.read())
+class CompanyChainHead(models.Model):
+    """Model for the head of the document hash chain of a company.
 
-        self.document_pdf.save(
-            os.path.basename(self.document_pdf.name), open(temp_filename, "rb")
+    Every new document of a company links to the hash of the previous one
+    through ``document_hash_previous``. This row holds the latest hash, so
+    linking a document is a single update of one row instead of a search
+    through the company's documents.
+
+    Attributes:
+        company (OneToOneField): The company the chain belongs to.
+        head_hash (str): Hash of the latest document of the company.
+        previous_hash (str): Head before the latest document was added.
+        length (int): Number of documents linked into the chain.
+        updated_at (datetime): Date and time the head last moved.
+    """
+
+    company = models.OneToOneField(
+        Company,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="document_chain_head",
+    )
+    head_hash = models.CharField(max_length=64, null=True, blank=True)
+    previous_hash = models.CharField(max_length=64, null=True, blank=True)
+    length = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Company Chain Head"
+        verbose_name_plural = "Company Chain Heads"
+
+    def __str__(self):
+        return f"{self.company_id}: {self.head_hash}"
+
+    @staticmethod
+    def latest_document_hash(company_id):
+        """Return the hash of the newest document of a company, or None."""
+        return (
+            Document.objects.filter(company_id=company_id)
+            .order_by("-id")
+            .values_list("document_hash", flat=True)
+            .first()
         )
 
-        os.remove(temp_filename)
+    @classmethod
+    def advance(cls, company_id, document_hash):
+        """Make ``document_hash`` the head of a company's chain.
+
+        The old head is moved to ``previous_hash`` by the same UPDATE that
+        sets the new one, since the right-hand sides of an UPDATE see the
+        row as it was. Concurrent inserts are therefore serialized on the
+        head row and can never link to the same predecessor. Must run in the
+        transaction inserting the document.
+
+        The head of a company that has none yet is seeded from its newest
+        document.
+
+        Args:
+            company_id (int): ID of the company.
+            document_hash (str): Hash of the document being inserted.
+
+        Returns:
+            str: Hash of the previous head, or None for the first document.
+        """
+        heads = cls.objects.filter(company_id=company_id)
+        if not heads.update(
+            previous_hash=models.F("head_hash"),
+            head_hash=document_hash,
+            length=models.F("length") + 1,
+            updated_at=timezone.now(),
+        ):
+            cls.objects.get_or_create(
+                company_id=company_id,
+                defaults={
+                    "head_hash": cls.latest_document_hash(company_id),
+                    "length": Document.objects.filter(company_id=company_id).count(),
+                },
+            )
+            return cls.advance(company_id, document_hash)
+        return heads.values_list("previous_hash", flat=True).get()
+
+
+class DocumentJob(models.Model):
+    """Model for a document upload waiting to be processed in the background.
+
+    The uploaded PDF is staged as is; a worker process stamps it and creates
+    the ``Document`` outside of the HTTP request.
+
+    Attributes:
+        status (str): One of queued, running, done or failed.
+        employee (ForeignKey): Employee of the document to create.
+        company (ForeignKey): Company of the document to create.
+        issued_date (Date): Issue date of the document to create.
+        is_signed (bool): Whether the document to create is signed.
+        staged_pdf (FileField): The uploaded, not yet stamped, PDF.
+        content_sha256 (str): SHA-256 of the upload, computed while receiving it.
+        submitted_by (ForeignKey): User who uploaded the document, the only
+            one besides staff who can follow the job.
+        document (ForeignKey): The created document, once done.
+        error (str): Error message of a failed job.
+        attempts (int): Number of times a worker picked up the job.
+        created_at (datetime): Date and time the job was queued.
+        started_at (datetime): Date and time of the last pick-up.
+        finished_at (datetime): Date and time the job finished.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED
+    )
+    employee = models.ForeignKey(Employee, on_delete=models.CASCADE)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    issued_date = models.DateField(null=False)
+    is_signed = models.BooleanField(default=False)
+    staged_pdf = models.FileField(upload_to="Documents/jobs/", null=False)
+    content_sha256 = models.CharField(max_length=64, blank=True)
+    submitted_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="document_jobs",
+    )
+    document = models.ForeignKey(
+        Document, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [models.Index(fields=["status", "id"])]
+        verbose_name = "Document Job"
+        verbose_name_plural = "Document Jobs"
+
+    def __str__(self):
+        return f"Job {self.pk} ({self.status})"
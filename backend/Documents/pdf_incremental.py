@@ -0,0 +1,354 @@
+"""Append-only (incremental update) writing of PDF revisions.
+
+An incremental update leaves the original bytes of a PDF untouched and
+appends a small revision holding only the new and changed objects, a
+cross-reference section for them and a trailer pointing back at the
+previous one (PDF 32000-1:2008, section 7.5.6). Stamping a document this way
+costs as much as the overlay, not as much as the document.
+"""
+
+import re
+import shutil
+from io import BytesIO
+
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+    create_string_object,
+)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+STARTXREF_TAIL_SIZE = 2048
+OVERLAY_XOBJECT_PREFIX = "/VxOverlay"
+
+
+class IncrementalUpdateError(Exception):
+    """Raised when a PDF cannot be updated in place and must be rewritten."""
+
+
+def _find_startxref(source):
+    """Locate the offset of the last cross-reference section of a PDF.
+
+    Args:
+        source: Seekable binary file object with the original PDF.
+
+    Returns:
+        tuple: ``(startxref, size, is_stream)`` where ``size`` is the length
+        of the original file and ``is_stream`` tells whether the last
+        cross-reference section is a cross-reference stream.
+
+    Raises:
+        IncrementalUpdateError: If no usable ``startxref`` can be found.
+    """
+    source.seek(0, 2)
+    size = source.tell()
+    source.seek(max(0, size - STARTXREF_TAIL_SIZE))
+    tail = source.read()
+    match = None
+    for match in re.finditer(rb"startxref\s+(\d+)", tail):
+        pass
+    if match is None:
+        raise IncrementalUpdateError("No startxref entry found.")
+    startxref = int(match.group(1))
+    if startxref >= size:
+        raise IncrementalUpdateError("startxref points past the end of file.")
+    source.seek(startxref)
+    is_stream = not source.read(4).startswith(b"xref")
+    return startxref, size, is_stream
+
+
+def _content_data(contents):
+    """Return the decoded bytes of a page ``/Contents`` entry."""
+    contents = contents.get_object()
+    if isinstance(contents, ArrayObject):
+        return b"\n".join(part.get_object().get_data() for part in contents)
+    return contents.get_data()
+
+
+class IncrementalUpdate:
+    """A pending revision of an existing PDF.
+
+    Objects are collected with :meth:`add_object`, :meth:`update_object` and
+    :meth:`import_object` and serialized by :meth:`write`, which copies the
+    original file in chunks and appends the revision.
+
+    Attributes:
+        reader (PdfReader): Reader over the original PDF.
+        source: Seekable binary file object with the original bytes.
+        source_size (int): Length of the original bytes.
+    """
+
+    def __init__(self, reader, source):
+        if reader.is_encrypted:
+            raise IncrementalUpdateError("Encrypted PDFs are rewritten instead.")
+        self.reader = reader
+        self.source = source
+        self._startxref, self.source_size, self._xref_is_stream = _find_startxref(
+            source
+        )
+        self._next_idnum = self._first_free_idnum(reader)
+        self._objects = {}
+        self._trailer_updates = {}
+
+    @staticmethod
+    def _first_free_idnum(reader):
+        # Trailers rebuilt from cross-reference streams may lack /Size.
+        known = [idnum for entries in reader.xref.values() for idnum in entries]
+        known.extend(reader.xref_objStm)
+        size = int(reader.trailer.get("/Size", 0))
+        return max([size, *(idnum + 1 for idnum in known)])
+
+    def _reserve(self):
+        ref = IndirectObject(self._next_idnum, 0, self.reader)
+        self._next_idnum += 1
+        return ref
+
+    def add_object(self, obj):
+        """Add a new object to the revision.
+
+        Args:
+            obj: The PyPDF2 object to add.
+
+        Returns:
+            IndirectObject: Reference to the new object.
+        """
+        ref = self._reserve()
+        self._objects[ref.idnum] = (ref.generation, obj)
+        return ref
+
+    def update_object(self, ref, obj):
+        """Replace an object of the original file in the revision.
+
+        Args:
+            ref (IndirectObject): Reference of the object being replaced.
+            obj: The new value of the object.
+        """
+        self._objects[ref.idnum] = (ref.generation, obj)
+
+    def set_trailer(self, key, ref):
+        """Point a trailer entry (e.g. ``/Info``) at an object of the revision."""
+        self._trailer_updates[NameObject(key)] = ref
+
+    def import_object(self, obj, memo=None):
+        """Copy an object from another PDF into the revision.
+
+        Indirect objects are copied once and renumbered; references between
+        them are rewritten to the new numbers.
+
+        Args:
+            obj: Object read from a different PdfReader.
+            memo (dict, optional): Mapping of already imported object numbers.
+
+        Returns:
+            The copied object, or a reference to it for indirect objects.
+        """
+        if memo is None:
+            memo = {}
+        if isinstance(obj, IndirectObject):
+            if obj.idnum not in memo:
+                ref = self._reserve()
+                memo[obj.idnum] = ref
+                copy = self.import_object(obj.get_object(), memo)
+                self._objects[ref.idnum] = (0, copy)
+            return memo[obj.idnum]
+        if isinstance(obj, StreamObject):
+            copy = (
+                EncodedStreamObject()
+                if isinstance(obj, EncodedStreamObject)
+                else DecodedStreamObject()
+            )
+            copy._data = obj._data
+            for key, value in obj.items():
+                copy[NameObject(key)] = self.import_object(value, memo)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for key, value in obj.items():
+                if key != "/Parent":
+                    copy[NameObject(key)] = self.import_object(value, memo)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.import_object(value, memo) for value in obj)
+        return obj
+
+    def _add_content_stream(self, data):
+        stream = DecodedStreamObject()
+        stream.set_data(data)
+        return self.add_object(stream)
+
+    def overlay_page(self, page, overlay):
+        """Draw ``overlay`` on top of ``page`` without rewriting its content.
+
+        The overlay becomes a Form XObject; the page gets a replacement
+        dictionary whose ``/Contents`` wraps the original streams in ``q``/``Q``
+        and then paints the form.
+
+        Args:
+            page (PageObject): Page of :attr:`reader` to draw on.
+            overlay (PageObject): Page of another PDF to draw.
+        """
+        if page.indirect_reference is None:
+            raise IncrementalUpdateError("Page has no object number.")
+
+        form = DecodedStreamObject()
+        form.set_data(_content_data(overlay["/Contents"]))
+        form = form.flate_encode()
+        form[NameObject("/Type")] = NameObject("/XObject")
+        form[NameObject("/Subtype")] = NameObject("/Form")
+        form[NameObject("/BBox")] = ArrayObject(
+            NumberObject(int(value)) for value in overlay.mediabox
+        )
+        if "/Resources" in overlay:
+            form[NameObject("/Resources")] = self.import_object(overlay["/Resources"])
+        form_ref = self.add_object(form)
+
+        page_dict = DictionaryObject(page)
+        resources = DictionaryObject(
+            page_dict.get("/Resources", DictionaryObject()).get_object()
+        )
+        xobjects = DictionaryObject(
+            resources.get("/XObject", DictionaryObject()).get_object()
+        )
+        form_name = OVERLAY_XOBJECT_PREFIX
+        while form_name in xobjects:
+            form_name += "x"
+        xobjects[NameObject(form_name)] = form_ref
+        resources[NameObject("/XObject")] = xobjects
+        page_dict[NameObject("/Resources")] = resources
+
+        contents = ArrayObject([self._add_content_stream(b"q\n")])
+        if "/Contents" in page_dict:
+            original = page_dict.raw_get("/Contents")
+            if isinstance(original.get_object(), ArrayObject):
+                contents.extend(original.get_object())
+            else:
+                contents.append(original)
+        contents.append(
+            self._add_content_stream(f"\nQ\nq {form_name} Do Q\n".encode("latin-1"))
+        )
+        page_dict[NameObject("/Contents")] = contents
+        self.update_object(page.indirect_reference, page_dict)
+
+    def update_info(self, entries):
+        """Add entries to the document information dictionary.
+
+        Existing entries are kept; the dictionary is written as part of the
+        revision.
+
+        Args:
+            entries (dict): Mapping of ``/Key`` names to text values.
+        """
+        info = DictionaryObject()
+        existing = None
+        if "/Info" in self.reader.trailer:
+            existing = self.reader.trailer.raw_get("/Info")
+        if existing is not None:
+            info.update(existing.get_object())
+        for key, value in entries.items():
+            info[NameObject(key)] = create_string_object(str(value))
+        if isinstance(existing, IndirectObject):
+            self.update_object(existing, info)
+        else:
+            self.set_trailer("/Info", self.add_object(info))
+
+    def _trailer_dict(self):
+        trailer = DictionaryObject()
+        for key in ("/Root", "/Info", "/ID"):
+            if key in self.reader.trailer:
+                trailer[NameObject(key)] = self.reader.trailer.raw_get(key)
+        trailer.update(self._trailer_updates)
+        trailer[NameObject("/Prev")] = NumberObject(self._startxref)
+        return trailer
+
+    @staticmethod
+    def _subsections(idnums):
+        start = previous = idnums[0]
+        for idnum in idnums[1:]:
+            if idnum != previous + 1:
+                yield start, previous - start + 1
+                start = idnum
+            previous = idnum
+        yield start, previous - start + 1
+
+    def build_revision(self):
+        """Serialize the revision that follows the original bytes.
+
+        Returns:
+            bytes: The appended revision, starting with a line break.
+        """
+        base = self.source_size
+        buffer = BytesIO()
+        buffer.write(b"\n")
+        offsets = {}
+        for idnum in sorted(self._objects):
+            generation, obj = self._objects[idnum]
+            offsets[idnum] = (base + buffer.tell(), generation)
+            buffer.write(f"{idnum} {generation} obj\n".encode("latin-1"))
+            obj.write_to_stream(buffer, None)
+            buffer.write(b"\nendobj\n")
+
+        trailer = self._trailer_dict()
+        if self._xref_is_stream:
+            xref_ref = self._reserve()
+            xref_offset = base + buffer.tell()
+            offsets[xref_ref.idnum] = (xref_offset, 0)
+            idnums = sorted(offsets)
+            width = max(4, (xref_offset.bit_length() + 7) // 8)
+            data = b"".join(
+                b"\x01"
+                + offsets[idnum][0].to_bytes(width, "big")
+                + offsets[idnum][1].to_bytes(2, "big")
+                for idnum in idnums
+            )
+            xref = DecodedStreamObject()
+            xref.set_data(data)
+            xref.update(trailer)
+            xref[NameObject("/Type")] = NameObject("/XRef")
+            xref[NameObject("/Size")] = NumberObject(self._next_idnum)
+            xref[NameObject("/W")] = ArrayObject(
+                [NumberObject(1), NumberObject(width), NumberObject(2)]
+            )
+            xref[NameObject("/Index")] = ArrayObject(
+                NumberObject(value)
+                for section in self._subsections(idnums)
+                for value in section
+            )
+            buffer.write(f"{xref_ref.idnum} 0 obj\n".encode("latin-1"))
+            xref.write_to_stream(buffer, None)
+            buffer.write(b"\nendobj\n")
+        else:
+            xref_offset = base + buffer.tell()
+            idnums = sorted(offsets)
+            buffer.write(b"xref\n")
+            for start, count in self._subsections(idnums):
+                buffer.write(f"{start} {count}\n".encode("latin-1"))
+                for idnum in range(start, start + count):
+                    offset, generation = offsets[idnum]
+                    entry = f"{offset:010d} {generation:05d} n\r\n"
+                    buffer.write(entry.encode("latin-1"))
+            trailer[NameObject("/Size")] = NumberObject(self._next_idnum)
+            buffer.write(b"trailer\n")
+            trailer.write_to_stream(buffer, None)
+            buffer.write(b"\n")
+        buffer.write(f"startxref\n{xref_offset}\n%%EOF\n".encode("latin-1"))
+        return buffer.getvalue()
+
+    def write(self, output):
+        """Write the original PDF followed by the revision to ``output``.
+
+        The original bytes are copied in fixed-size chunks, so memory use
+        does not depend on the size of the document.
+
+        Args:
+            output: Writable binary file object.
+        """
+        revision = self.build_revision()
+        self.source.seek(0)
+        shutil.copyfileobj(self.source, output, COPY_CHUNK_SIZE)
+        output.write(revision)
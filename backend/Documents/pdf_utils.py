@@ -1,19 +1,433 @@
-from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2 import PdfReader, PdfWriter, PageObject
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    RectangleObject,
+)
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from io import BytesIO
-from django.http import HttpResponse
+from django.conf import settings
+from voxlyne.responses import segmented_response
+from .pdf_incremental import IncrementalUpdate, IncrementalUpdateError
+from functools import lru_cache
+import logging
+import tempfile
 
+# Stamped output is kept in memory up to this size, then spilled to a
+# temporary file in the system temp directory (removed on close).
+STAMP_SPOOL_MAX_SIZE = getattr(
+    settings, "DOCUMENT_STAMP_SPOOL_MAX_SIZE", 8 * 1024 * 1024
+)
+# "incremental" appends the overlay as a new PDF revision and keeps the
+# original bytes untouched; "rewrite" re-serializes every page.
+STAMP_MODE = getattr(settings, "DOCUMENT_STAMP_MODE", "incremental")
+# Number of compiled stamp templates (one per page geometry) kept in memory.
+STAMP_TEMPLATE_CACHE_SIZE = getattr(
+    settings, "DOCUMENT_STAMP_TEMPLATE_CACHE_SIZE", 64
+)
 
-def create_pdf_with_metadata(
-    document, company_name, employee_name, employee_id, duration, position, company_logo
+# Size (points) the company logo is drawn at in the certificate header.
+CERTIFICATE_LOGO_SIZE = (100, 50)
+
+# Document information entries recording the stamp in machine-readable form.
+STAMP_VERSION = 1
+STAMP_INFO_HASH = "/VoxlyneStampHash"
+STAMP_INFO_IDENTIFIER = "/VoxlyneStampIdentifier"
+STAMP_INFO_VERSION = "/VoxlyneStampVersion"
+# Length of the untouched original when the stamp was appended incrementally.
+STAMP_INFO_SOURCE_SIZE = "/VoxlyneSourceSize"
+
+
+def open_spooled_pdf():
+    """Return an anonymous, self-deleting buffer for stamped PDF output.
+
+    Returns:
+        SpooledTemporaryFile: A binary buffer that rolls over to disk once it
+        grows beyond ``STAMP_SPOOL_MAX_SIZE``.
+    """
+    return tempfile.SpooledTemporaryFile(
+        max_size=STAMP_SPOOL_MAX_SIZE, mode="w+b", suffix=".pdf"
+    )
+
+
+def stamp_marker(document_hash, unique_identifier):
+    """Build the document information entries that record a stamp.
+
+    Args:
+        document_hash (str): The document hash printed in the stamp.
+        unique_identifier (str): The identifier printed in the stamp.
+
+    Returns:
+        dict: Information dictionary entries for the stamp.
+    """
+    return {
+        STAMP_INFO_HASH: document_hash,
+        STAMP_INFO_IDENTIFIER: unique_identifier,
+        STAMP_INFO_VERSION: str(STAMP_VERSION),
+    }
+
+
+def read_stamp_marker(reader):
+    """Read the stamp entries from the document information dictionary.
+
+    Only the trailer and the information dictionary are read, so the cost
+    does not depend on the number or content of the pages.
+
+    Args:
+        reader (PdfReader): Reader over the PDF to inspect.
+
+    Returns:
+        dict: The stamp entries, or None if the PDF carries no marker.
+    """
+    info = reader.trailer.get("/Info")
+    if info is None:
+        return None
+    info = info.get_object()
+    if STAMP_INFO_HASH not in info:
+        return None
+    return {
+        key: str(info[key])
+        for key in (
+            STAMP_INFO_HASH,
+            STAMP_INFO_IDENTIFIER,
+            STAMP_INFO_VERSION,
+            STAMP_INFO_SOURCE_SIZE,
+        )
+        if key in info
+    }
+
+
+def is_pdf_stamped(reader, document_hash, unique_identifier):
+    """Check whether a PDF carries the stamp marker for a document.
+
+    Args:
+        reader (PdfReader): Reader over the PDF to inspect.
+        document_hash (str): The document hash printed in the stamp.
+        unique_identifier (str): The identifier printed in the stamp.
+
+    Returns:
+        bool: True if the marker matches the hash and identifier.
+    """
+    marker = read_stamp_marker(reader)
+    return (
+        marker is not None
+        and marker.get(STAMP_INFO_HASH) == document_hash
+        and marker.get(STAMP_INFO_IDENTIFIER) == unique_identifier
+    )
+
+
+def has_legacy_stamp(reader, document_hash, unique_identifier):
+    """Check for a stamp drawn before stamps carried a marker.
+
+    This extracts the text of the last page, which is slow; it is only
+    meant for files stored before the marker was introduced.
+
+    Args:
+        reader (PdfReader): Reader over the PDF to inspect.
+        document_hash (str): The document hash printed in the stamp.
+        unique_identifier (str): The identifier printed in the stamp.
+
+    Returns:
+        bool: True if both stamp lines are present on the last page.
+    """
+    last_page_text = reader.pages[-1].extract_text()
+    return (
+        f"Hash: {document_hash}" in last_page_text
+        and f"ID: {unique_identifier}" in last_page_text
+    )
+
+
+def _escape_pdf_text(text):
+    """Escape a value for use inside a PDF literal string."""
+    escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return escaped.encode("latin-1", errors="replace")
+
+
+def _direct_copy(obj):
+    """Return ``obj`` with every indirect reference resolved in place."""
+    if isinstance(obj, IndirectObject):
+        return _direct_copy(obj.get_object())
+    if isinstance(obj, DictionaryObject):
+        return DictionaryObject(
+            {NameObject(key): _direct_copy(value) for key, value in obj.items()}
+        )
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(_direct_copy(value) for value in obj)
+    return obj
+
+
+class OverlayTemplate:
+    """A compiled overlay for one page geometry.
+
+    reportlab runs once per template to set up the page, font and
+    resources. :meth:`render` then only formats the per-document text
+    lines into the compiled content stream, centring each one with the
+    font metrics. The page rotation is compensated with a transformation
+    baked into the content, so the overlay reads upright and sits at the
+    bottom of the page as displayed.
+
+    Attributes:
+        box (tuple): ``(x0, y0, x1, y1)`` of the visible page box.
+        rotation (int): Page rotation in degrees (0, 90, 180 or 270).
+        width (float): Width of the page as displayed.
+        lines (list): ``(y, format string)`` pairs of the text lines.
+        resources (DictionaryObject): Direct resources used by the content.
+    """
+
+    def __init__(self, box, rotation, font_name, font_size, lines):
+        self.box = box
+        self.rotation = rotation
+        self.font_name = font_name
+        self.font_size = font_size
+        self.lines = lines
+        x0, y0, x1, y1 = box
+        width, height = x1 - x0, y1 - y0
+        if rotation in (90, 270):
+            width, height = height, width
+        self.width = width
+        matrix = {
+            0: (1, 0, 0, 1, x0, y0),
+            90: (0, 1, -1, 0, x1, y0),
+            180: (-1, 0, 0, -1, x1, y1),
+            270: (0, -1, 1, 0, x0, y1),
+        }[rotation]
+
+        packet = BytesIO()
+        can = canvas.Canvas(packet, pagesize=(width, height), pageCompression=0)
+        can.setFont(font_name, font_size)
+        can.save()
+        packet.seek(0)
+        page = PdfReader(packet).pages[0]
+        self.resources = _direct_copy(page["/Resources"])
+        self.font_resource = next(
+            key
+            for key, font in self.resources["/Font"].items()
+            if font["/BaseFont"] == f"/{font_name}"
+        )
+
+        cm = " ".join(f"{value:g}" for value in matrix)
+        self._header = (
+            f"q {cm} cm\n".encode("latin-1") + page.get_contents().get_data()
+        )
+
+    def render(self, **values):
+        """Build an overlay page with the text lines filled in.
+
+        Args:
+            **values: Values for the fields of the line format strings.
+
+        Returns:
+            PageObject: A new overlay page matching the template geometry.
+        """
+        parts = [self._header]
+        for y, line in self.lines:
+            text = line.format(**values)
+            x = (self.width - stringWidth(text, self.font_name, self.font_size)) / 2
+            parts.append(
+                f"\nBT {self.font_resource} {self.font_size} Tf "
+                f"{x:.2f} {y} Td (".encode("latin-1")
+                + _escape_pdf_text(text)
+                + b") Tj ET"
+            )
+        parts.append(b"\nQ\n")
+
+        stream = DecodedStreamObject()
+        stream.set_data(b"".join(parts))
+        page = PageObject.create_blank_page(width=1, height=1)
+        page[NameObject("/MediaBox")] = RectangleObject(self.box)
+        page[NameObject("/Resources")] = self.resources
+        page[NameObject("/Contents")] = stream
+        return page
+
+
+@lru_cache(maxsize=STAMP_TEMPLATE_CACHE_SIZE)
+def get_stamp_template(box, rotation):
+    """Return the hash/ID stamp template for a page geometry.
+
+    Templates are compiled on first use and kept in an LRU cache, so
+    reportlab only runs for page sizes and rotations not seen recently.
+
+    Args:
+        box (tuple): ``(x0, y0, x1, y1)`` of the visible page box.
+        rotation (int): Page rotation in degrees.
+
+    Returns:
+        OverlayTemplate: The compiled template.
+    """
+    return OverlayTemplate(
+        box,
+        rotation,
+        "Helvetica",
+        8,
+        [(10, "Hash: {document_hash}"), (25, "ID: {unique_identifier}")],
+    )
+
+
+def build_stamp_overlay(page, document_hash, unique_identifier):
+    """Build the two-line hash/ID stamp for a given page.
+
+    Args:
+        page (PageObject): The page the stamp will be drawn on; its visible
+            box (CropBox, defaulting to the MediaBox) and rotation select
+            the template.
+        document_hash (str): The document hash to print.
+        unique_identifier (str): The document identifier to print.
+
+    Returns:
+        PageObject: The overlay page, ready to be merged.
+    """
+    box = tuple(round(float(value), 2) for value in page.cropbox)
+    rotation = page.rotation // 90 * 90 % 360
+    template = get_stamp_template(box, rotation)
+    return template.render(
+        document_hash=document_hash, unique_identifier=unique_identifier
+    )
+
+
+def _incremental_update(reader, source, overlay, metadata, record_source_size):
+    """Prepare the revision drawing ``overlay`` on the last page of a PDF.
+
+    Returns:
+        IncrementalUpdate: The pending revision, or None if the PDF cannot
+        be updated in place.
+    """
+    try:
+        update = IncrementalUpdate(reader, source)
+        if overlay is not None:
+            update.overlay_page(reader.pages[-1], overlay)
+        if record_source_size:
+            metadata = {
+                **(metadata or {}),
+                STAMP_INFO_SOURCE_SIZE: update.source_size,
+            }
+        if metadata:
+            update.update_info(metadata)
+    except IncrementalUpdateError as e:
+        logging.info(f"Incremental update not possible, rewriting PDF: {e}")
+        return None
+    return update
+
+
+def _rewrite_pdf(reader, output, overlay, metadata):
+    """Copy every page of a PDF to ``output``, drawing ``overlay`` on the last."""
+    writer = PdfWriter()
+    last_page_num = len(reader.pages) - 1
+    for page_num, page in enumerate(reader.pages):
+        if page_num == last_page_num and overlay is not None:
+            page.merge_page(overlay)
+        writer.add_page(page)
+    if metadata:
+        if reader.metadata:
+            writer.add_metadata(reader.metadata)
+        writer.add_metadata(metadata)
+    writer.write(output)
+    output.flush()
+    output.seek(0)
+
+
+def overlay_last_page(
+    reader, source, output, overlay, mode=None, metadata=None, record_source_size=False
 ):
-    """Create a PDF with the specified metadata and save it to the output path."""
-    # Leer el PDF original
-    document.document_pdf.seek(0)
-    existing_pdf = PdfReader(document.document_pdf)
-    output = PdfWriter()
+    """Write a copy of a PDF with ``overlay`` drawn on its last page.
+
+    In ``"incremental"`` mode the original bytes are copied unchanged and a
+    small revision with the overlay is appended. PDFs that cannot be updated
+    in place (e.g. encrypted ones) fall back to ``"rewrite"``, which copies
+    every page into a new file.
+
+    Args:
+        reader (PdfReader): Reader over the source PDF.
+        source: Seekable binary file object with the source PDF bytes.
+        output: Writable binary file object receiving the result.
+        overlay (PageObject): Page to draw on top of the last page, or None
+            to only update the document information.
+        mode (str, optional): ``"incremental"`` or ``"rewrite"``. Defaults
+            to ``DOCUMENT_STAMP_MODE``.
+        metadata (dict, optional): Entries to add to the document
+            information dictionary.
+        record_source_size (bool): Also record the length of the untouched
+            original (``STAMP_INFO_SOURCE_SIZE``) when writing incrementally.
+    """
+    if (mode or STAMP_MODE) == "incremental":
+        update = _incremental_update(
+            reader, source, overlay, metadata, record_source_size
+        )
+        if update is not None:
+            update.write(output)
+            output.flush()
+            output.seek(0)
+            return
+    _rewrite_pdf(reader, output, overlay, metadata)
+
+
+def stamp_pdf(reader, source, output, document_hash, unique_identifier, mode=None):
+    """Write a stamped copy of a PDF to ``output``.
 
+    The hash/ID overlay is drawn on the last page only and the stamp is
+    recorded in the document information (see :func:`stamp_marker`). When
+    the stamp is appended incrementally, the size of the untouched original
+    is recorded as well. Output is written straight into ``output`` so
+    callers can hand it to a storage backend without an intermediate copy.
+
+    Args:
+        reader (PdfReader): Reader over the source PDF.
+        source: Seekable binary file object with the source PDF bytes.
+        output: Writable binary file object receiving the stamped PDF.
+        document_hash (str): The document hash to print.
+        unique_identifier (str): The document identifier to print.
+        mode (str, optional): Stamping mode, see :func:`overlay_last_page`.
+    """
+    overlay = build_stamp_overlay(reader.pages[-1], document_hash, unique_identifier)
+    metadata = stamp_marker(document_hash, unique_identifier)
+    overlay_last_page(
+        reader, source, output, overlay, mode, metadata, record_source_size=True
+    )
+
+
+def mark_pdf_stamped(
+    reader, source, output, document_hash, unique_identifier, mode=None
+):
+    """Write a copy of an already stamped PDF with the stamp marker added.
+
+    Used to upgrade files stamped before the marker existed without
+    drawing the stamp a second time.
+
+    Args:
+        reader (PdfReader): Reader over the source PDF.
+        source: Seekable binary file object with the source PDF bytes.
+        output: Writable binary file object receiving the result.
+        document_hash (str): The document hash printed in the stamp.
+        unique_identifier (str): The identifier printed in the stamp.
+        mode (str, optional): Stamping mode, see :func:`overlay_last_page`.
+    """
+    metadata = stamp_marker(document_hash, unique_identifier)
+    overlay_last_page(reader, source, output, None, mode, metadata)
+
+
+def render_certificate_overlay(
+    company_name, employee_name, employee_id, duration, position, company_logo=None
+):
+    """Render the text of an employment certificate as a one-page PDF.
+
+    The function only takes plain values, so it can run in a worker process.
+
+    Args:
+        company_name (str): Name of the issuing company.
+        employee_name (str): Full name of the employee.
+        employee_id (str): ID number of the employee.
+        duration (str): How long the employee worked at the company.
+        position (str): Position held by the employee.
+        company_logo (optional): Logo image (file name, file object or
+            ``ImageReader``) drawn in the header.
+
+    Returns:
+        PageObject: The rendered page, to be drawn over the document.
+    """
     # Crear un nuevo PDF con el texto
     packet = BytesIO()
     can = canvas.Canvas(packet, pagesize=letter)
@@ -22,7 +436,14 @@ def create_pdf_with_metadata(
 
     # Agregar logo de la empresa si está presente
     if company_logo:
-        can.drawImage(company_logo, 40, page_height - 100, width=100, height=50)
+        logo_width, logo_height = CERTIFICATE_LOGO_SIZE
+        can.drawImage(
+            company_logo,
+            40,
+            page_height - 100,
+            width=logo_width,
+            height=logo_height,
+        )
 
     # Agregar el contenido del documento
     can.drawString(
@@ -54,21 +475,90 @@ def create_pdf_with_metadata(
 
     # Mover al inicio del buffer
     packet.seek(0)
-    new_pdf = PdfReader(packet)
+    return PdfReader(packet).pages[0]
+
 
+def write_certificate(source, output, *args, **kwargs):
+    """Write an employment certificate over the last page of a document.
+
+    Args:
+        source: Seekable binary file object with the document PDF.
+        output: Writable binary file object for the certificate.
+        *args: Certificate values, see :func:`render_certificate_overlay`.
+        **kwargs: Certificate values, see :func:`render_certificate_overlay`.
+    """
+    source.seek(0)
+    existing_pdf = PdfReader(source)
+    overlay = render_certificate_overlay(*args, **kwargs)
     # Agregar el texto solo a la última página del PDF existente
-    for page_num in range(len(existing_pdf.pages)):
-        page = existing_pdf.pages[page_num]
-        if page_num == len(existing_pdf.pages) - 1:
-            page.merge_page(new_pdf.pages[0])
-        output.add_page(page)
+    overlay_last_page(existing_pdf, source, output, overlay)
+
 
-    # Guardar el PDF modificado en un archivo temporal
-    output_stream = BytesIO()
-    output.write(output_stream)
-    output_stream.seek(0)
+def certificate_segments(source, *args, mode=None, **kwargs):
+    """Build an employment certificate as response body segments.
+
+    In ``"incremental"`` mode nothing is written: the body is the original
+    document followed by the revision with the certificate text, so it can
+    be streamed as soon as that small revision is built. Otherwise the
+    certificate is written to a spooled temporary file.
+
+    Args:
+        source: Seekable binary file object with the document PDF.
+        *args: Certificate values, see :func:`render_certificate_overlay`.
+        mode (str, optional): Stamping mode, see :func:`overlay_last_page`.
+        **kwargs: Certificate values, see :func:`render_certificate_overlay`.
+
+    Returns:
+        list: ``bytes`` and ``(file, offset, length)`` segments, as taken by
+        ``voxlyne.responses.segmented_response``.
+    """
+    source.seek(0)
+    existing_pdf = PdfReader(source)
+    overlay = render_certificate_overlay(*args, **kwargs)
+    if (mode or STAMP_MODE) == "incremental":
+        update = _incremental_update(existing_pdf, source, overlay, None, False)
+        if update is not None:
+            revision = update.build_revision()
+            return [(source, 0, update.source_size), revision]
+
+    output = open_spooled_pdf()
+    _rewrite_pdf(existing_pdf, output, overlay, None)
+    size = output.seek(0, 2)
+    return [(output, 0, size)]
+
+
+def create_pdf_with_metadata(
+    document,
+    company_name,
+    employee_name,
+    employee_id,
+    duration,
+    position,
+    company_logo,
+    request=None,
+):
+    """Create a certificate PDF over a document and stream it as a download.
+
+    The response is streamed from the stored document in chunks and, for a
+    GET request, honours ``Range`` headers.
+
+    Returns:
+        StreamingHttpResponse: The certificate PDF.
+    """
+    source = document.document_pdf.open("rb")
+    segments = certificate_segments(
+        source,
+        company_name,
+        employee_name,
+        employee_id,
+        duration,
+        position,
+        company_logo,
+    )
+    files = [segment[0] for segment in segments if not isinstance(segment, bytes)]
+    if all(file is not source for file in files):
+        # The certificate was rewritten into a file of its own.
+        source.close()
 
     # Crear la respuesta HTTP con el PDF
-    response = HttpResponse(output_stream, content_type="application/pdf")
-    response["Content-Disposition"] = 'attachment; filename="generated_document.pdf"'
-    return response
+    return segmented_response(request, segments, filename="generated_document.pdf")
@@ -1,5 +1,7 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import Document, DocumentType
+from .certificates import certificate_spec
+from .models import CompanyChainHead, Document, DocumentJob, DocumentType
 from Employees.models import Employee
 from Companies.models import Company
 
@@ -29,7 +31,8 @@ class DocumentSerializer(serializers.ModelSerializer):
     """Serializer for the Document model.
 
     This serializer handles the conversion between Document model instances and JSON/dict data.
-    It includes validation for document hashes and handles relationships with employees and companies.
+    It handles relationships with employees and companies; the document hash
+    is generated when the document is created.
     """
 
     employee = serializers.PrimaryKeyRelatedField(queryset=Employee.objects.all())
@@ -39,27 +42,12 @@ class DocumentSerializer(serializers.ModelSerializer):
         model = Document
         fields = "__all__"
 
-    def validate_document_hash(self, value):
-        """Validate the uniqueness of the document hash.
-
-        Args:
-            value: The document hash to validate.
-
-        Returns:
-            str: The validated hash.
-
-        Raises:
-            ValidationError: If a document with this hash already exists.
-        """
-        if Document.objects.filter(document_hash=value).exists():
-            raise serializers.ValidationError("Document with this hash already exists.")
-        return value
-
     def create(self, validated_data):
         """Create and return a new Document instance.
 
         This method handles the creation of a new document, properly handling
-        employee and company relationships.
+        employee and company relationships. The document hash reuses the
+        digest the upload handler computed, if any.
 
         Args:
             validated_data (dict): The validated data from the request.
@@ -72,7 +60,9 @@ class DocumentSerializer(serializers.ModelSerializer):
         document = Document(
             employee=employee_data, company=company_data, **validated_data
         )
-        document.document_hash = document.generate_unique_document_hash()
+        # Hashed by the upload handler while the request body arrived.
+        upload_hash = getattr(validated_data.get("document_pdf"), "sha256", None)
+        document.document_hash = document.generate_unique_document_hash(upload_hash)
         document.save()
         return document
 
@@ -121,3 +111,121 @@ class DocumentSerializer(serializers.ModelSerializer):
             dict: The validated attributes.
         """
         return super().validate(attrs)
+
+
+class DocumentJobSerializer(serializers.ModelSerializer):
+    """Serializer for the status of a background document job.
+
+    Attributes:
+        id: ID of the job.
+        status: queued, running, done or failed.
+        document: ID of the created document, once done.
+        error: Error message of a failed job.
+    """
+
+    class Meta:
+        model = DocumentJob
+        fields = [
+            "id",
+            "status",
+            "document",
+            "error",
+            "attempts",
+            "created_at",
+            "started_at",
+            "finished_at",
+        ]
+        read_only_fields = fields
+
+
+class CompanyChainHeadSerializer(serializers.ModelSerializer):
+    """Serializer for the head of a company's document hash chain.
+
+    Attributes:
+        company: ID of the company.
+        head_hash: Hash of the latest document of the company.
+        length: Number of documents linked into the chain.
+        updated_at: Date and time the head last moved.
+    """
+
+    class Meta:
+        model = CompanyChainHead
+        fields = ["company", "head_hash", "length", "updated_at"]
+        read_only_fields = fields
+
+
+class CertificateRequestSerializer(serializers.Serializer):
+    """Serializer for one entry of a certificate batch.
+
+    Attributes:
+        document: ID of the document the certificate is written on.
+        employee: ID of the employee the certificate is about.
+        company: ID of the issuing company.
+        duration: How long the employee worked at the company.
+        position: Position held by the employee.
+    """
+
+    document = serializers.IntegerField()
+    employee = serializers.IntegerField()
+    company = serializers.IntegerField()
+    duration = serializers.CharField(max_length=50)
+    position = serializers.CharField(max_length=100)
+
+
+class CertificateBatchSerializer(serializers.Serializer):
+    """Serializer for a batch of employment certificates.
+
+    The referenced documents, employees and companies are loaded with one
+    query per model for the whole batch.
+    """
+
+    certificates = CertificateRequestSerializer(many=True, allow_empty=False)
+
+    def validate_certificates(self, value):
+        """Resolve the IDs of every entry, rejecting unknown ones.
+
+        Args:
+            value (list): The validated entries.
+
+        Returns:
+            list: The entries with model instances instead of IDs.
+
+        Raises:
+            ValidationError: If the batch is too large or an ID does not
+                exist.
+        """
+        if len(value) > settings.DOCUMENT_CERTIFICATE_BATCH_MAX:
+            raise serializers.ValidationError(
+                "A batch can hold at most "
+                f"{settings.DOCUMENT_CERTIFICATE_BATCH_MAX} certificates."
+            )
+        models = {"document": Document, "employee": Employee, "company": Company}
+        instances = {}
+        for field, model in models.items():
+            ids = {entry[field] for entry in value}
+            instances[field] = model.objects.in_bulk(ids)
+            missing = ids - instances[field].keys()
+            if missing:
+                raise serializers.ValidationError(
+                    f"Unknown {field} IDs: {sorted(missing)}"
+                )
+        return [
+            {
+                **entry,
+                **{field: instances[field][entry[field]] for field in models},
+            }
+            for entry in value
+        ]
+
+    def certificate_specs(self):
+        """Return the certificate specifications of the validated batch."""
+        return [
+            certificate_spec(
+                entry["document"],
+                entry["employee"],
+                entry["company"],
+                entry["duration"],
+                entry["position"],
+            )
+            for entry in self.validated_data["certificates"]
+        ]
@@ -0,0 +1,30 @@
+"""Signal receivers of the Documents app."""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import verification
+from .models import Document
+
+
+@receiver(post_save, sender=Document, dispatch_uid="documents_index_saved")
+def index_saved_document(sender, instance, **kwargs):
+    """Write the verification record of a saved document through."""
+    verification.store_on_commit(instance)
+
+
+@receiver(post_delete, sender=Document, dispatch_uid="documents_forget_deleted")
+def forget_deleted_document(sender, instance, **kwargs):
+    """Remove a deleted document, including cascades, from the index."""
+    verification.forget_on_commit(instance)
+
+
+@receiver(post_delete, sender=Document, dispatch_uid="documents_release_file")
+def release_deleted_document_file(sender, instance, **kwargs):
+    """Release the file reference of a deleted document once it commits."""
+    name = instance.document_pdf.name
+    if not name:
+        return
+    storage = instance.document_pdf.storage
+    transaction.on_commit(lambda: storage.delete(name))
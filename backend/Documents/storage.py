@@ -0,0 +1,107 @@
+"""Content-addressed storage for document files.
+
+Files are stored under the SHA-256 of their bytes, in nested directories
+named after the first characters of the digest::
+
+    Documents/blobs/3f/a2/3fa2...e9.pdf
+
+Saving bytes that are already stored writes nothing and returns the
+existing name. Every save counts as one reference (a ``DocumentBlob`` row)
+and every delete releases one; the file itself is removed with its last
+reference.
+"""
+
+import hashlib
+import os
+import re
+
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+_BLOB_NAME_RE = re.compile(r"(?:^|/)([0-9a-f]{64})(?:\.[^/]*)?$")
+
+
+def blob_digest(name):
+    """Return the SHA-256 a content-addressed name was derived from, or None."""
+    match = _BLOB_NAME_RE.search(name or "")
+    return match.group(1) if match else None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage keeping each distinct file once, by SHA-256.
+
+    Args:
+        prefix (str): Directory, relative to ``location``, holding the blobs.
+        depth (int): Number of nested two-character shard directories.
+        **kwargs: Passed to ``FileSystemStorage``.
+    """
+
+    def __init__(self, prefix="Documents/blobs", depth=2, **kwargs):
+        super().__init__(**kwargs)
+        self.prefix = prefix.strip("/")
+        self.depth = depth
+
+    def blob_name(self, digest, extension=""):
+        """Return the storage name of the blob with the given SHA-256."""
+        shards = [digest[2 * i : 2 * i + 2] for i in range(self.depth)]
+        return "/".join([self.prefix, *shards, digest + extension])
+
+    def _save(self, name, content):
+        sha256 = hashlib.sha256()
+        size = 0
+        for chunk in content.chunks():
+            sha256.update(chunk)
+            size += len(chunk)
+        digest = sha256.hexdigest()
+        name = self.blob_name(digest, os.path.splitext(name)[1].lower())
+
+        # Take the reference first, so a concurrent delete keeps the file.
+        self._add_reference(name, digest, size)
+        if not self.exists(name):
+            stored_name = super()._save(name, content)
+            if stored_name != name:
+                # Written concurrently by someone else; keep a single copy.
+                super().delete(stored_name)
+        return name
+
+    def _add_reference(self, name, digest, size):
+        from .models import DocumentBlob
+
+        blobs = DocumentBlob.objects.filter(name=name)
+        now = timezone.now()
+        if blobs.update(refcount=F("refcount") + 1, referenced_at=now):
+            return
+        try:
+            with transaction.atomic():
+                DocumentBlob.objects.create(
+                    name=name, sha256=digest, size=size, refcount=1, referenced_at=now
+                )
+        except IntegrityError:
+            blobs.update(refcount=F("refcount") + 1, referenced_at=now)
+
+    def delete(self, name):
+        """Release one reference to ``name``, removing the file with the last.
+
+        Names outside the blob layout (e.g. files stored before the
+        migration) are deleted directly.
+        """
+        from .models import DocumentBlob
+
+        if blob_digest(name) is None:
+            return super().delete(name)
+        blobs = DocumentBlob.objects.filter(name=name)
+        if blobs.filter(refcount__gt=1).update(refcount=F("refcount") - 1):
+            return
+        blobs.delete()
+        super().delete(name)
+
+
+def document_storage():
+    """Return the storage configured for document files.
+
+    Used as the ``storage`` of ``Document.document_pdf``; the backend is
+    the ``"documents"`` entry of ``settings.STORAGES``.
+    """
+    return storages["documents"]
@@ -1,3 +1,470 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PyPDF2 import PdfReader
+from rest_framework.test import APIClient
+from reportlab.pdfgen import canvas
+
+from Accounts.models import User
+from Companies.models import Company
+from Documents.duplicates import document_hashes
+from Documents.integrity import FILE_OK, FILE_UNREADABLE, verify_stored_file
+from Documents.jobs import claim_next_job, process_job, requeue_stale_jobs
+from Documents.models import Document, DocumentBlob, DocumentJob
+from Documents.pdf_utils import (
+    STAMP_INFO_IDENTIFIER,
+    STAMP_INFO_SOURCE_SIZE,
+    build_stamp_overlay,
+    is_pdf_stamped,
+    overlay_last_page,
+    read_stamp_marker,
+)
+from Documents.storage import document_storage
+from Employees.models import Employee
+from voxlyne.db.testing import QueryPlanMixin
+
+LOCAL_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "tiered": {
+        "BACKEND": "voxlyne.cache_backends.TieredCache",
+        "OPTIONS": {"L2": "default"},
+    },
+}
+
+
+def make_pdf(text="Certificate", pages=1):
+    """Return the bytes of a small PDF."""
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer)
+    for page in range(pages):
+        pdf.drawString(100, 700, f"{text} {page}")
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class DocumentTestCase(TestCase):
+    """Documents of one employee, with their files in a temporary directory."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.media_root = media_root
+        # Redis is not required by the tests.
+        patcher = mock.patch.object(document_hashes, "shared", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.company = Company.objects.create(
+            name="Acme", address="Main St", phone="1", email="acme@example.com", nit="1"
+        )
+        self.employee = Employee.objects.create(
+            name="Ada",
+            surname="Lovelace",
+            employee_id=1,
+            email="ada@example.com",
+            phone_number="1",
+            date_of_birth=datetime.date(1990, 1, 1),
+            current_company=self.company,
+            position="Engineer",
+            start_date=datetime.date(2020, 1, 1),
+            end_date=datetime.date(2023, 1, 1),
+            department="Otros",
+            subcategory="Otros",
+        )
+
+    def create_document(self, content=None, **fields):
+        document = Document(
+            employee=self.employee,
+            company=self.company,
+            issued_date=datetime.date(2024, 1, 1),
+            document_pdf=SimpleUploadedFile(
+                "certificate.pdf", content or make_pdf(), "application/pdf"
+            ),
+            **fields,
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+        return document
+
+
+class DocumentQueryPlanTests(QueryPlanMixin, TestCase):
+    """The hot document queries are served by the company/ID index."""
+
+    def setUp(self):
+        self.index = Document._meta.indexes[0].name
+
+    def test_company_page(self):
+        self.assertIndexed(Document.get_documents_by_company(1)[:100], self.index)
+
+    def test_company_page_after_id(self):
+        self.assertIndexed(
+            Document.get_documents_by_company(1, after_id=500)[:100], self.index
+        )
+
+    def test_latest_document_hash(self):
+        # The query of CompanyChainHead.latest_document_hash().
+        self.assertIndexed(
+            Document.objects.filter(company_id=1)
+            .order_by("-id")
+            .values_list("document_hash", flat=True)[:1],
+            self.index,
+        )
+
+    def test_filtered_index_scan_is_reported(self):
+        # Walks the whole company/ID index to avoid a sort, filtering each row.
+        queryset = Document.objects.filter(is_signed=True).order_by("company", "id")
+        with self.assertRaises(AssertionError):
+            self.assertIndexed(queryset)
+
+
+class DuplicateDetectionTests(DocumentTestCase):
+    """Stored content is recognized through the duplicate filter."""
+
+    def test_same_content_gets_random_hash(self):
+        content = make_pdf()
+        first = self.create_document(content)
+        second = self.create_document(content)
+        self.assertEqual(first.document_hash, hashlib.sha256(content).hexdigest())
+        self.assertFalse(first.hash_randomized)
+        self.assertTrue(second.hash_randomized)
+        self.assertNotEqual(second.document_hash, first.document_hash)
+
+    def test_import_skips_stored_content(self):
+        stored = make_pdf("Stored")
+        new = make_pdf("New")
+        self.create_document(stored)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, content in [
+            ("a.pdf", stored),
+            ("b.pdf", new),
+            ("c.pdf", new),
+            ("notes.txt", b"not a PDF"),
+        ]:
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(content)
+
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                "import_documents",
+                directory,
+                employee=self.employee.pk,
+                company=self.company.pk,
+                issued_date="2024-02-01",
+                stdout=output,
+            )
+        self.assertIn(
+            "1 documents imported, 2 already stored, 0 failed", output.getvalue()
+        )
+        self.assertEqual(Document.objects.count(), 2)
+
+
+class StoredFileVerificationTests(DocumentTestCase):
+    """Any file that can't be read is reported, not raised."""
+
+    def verify(self, document, name=None):
+        return verify_stored_file(
+            document.document_pdf.storage,
+            name or document.document_pdf.name,
+            document.document_hash,
+            document.unique_identifier,
+            document.hash_randomized,
+        )
+
+    def test_stamped_document(self):
+        self.assertEqual(self.verify(self.create_document()), (FILE_OK, None))
+
+    def test_directory(self):
+        document = self.create_document()
+        os.mkdir(os.path.join(self.media_root, "folder.pdf"))
+        result, detail = self.verify(document, "folder.pdf")
+        self.assertEqual(result, FILE_UNREADABLE)
+        self.assertIn("IsADirectoryError", detail)
+
+    def test_malformed_pdf(self):
+        document = self.create_document()
+        with mock.patch(
+            "Documents.integrity.PdfReader", side_effect=AssertionError("bad xref")
+        ):
+            result, detail = self.verify(document)
+        self.assertEqual(result, FILE_UNREADABLE)
+        self.assertIn("bad xref", detail)
+
+
+class CompanyDocumentListTests(DocumentTestCase):
+    """The documents of a company are read page by page through the cursor."""
+
+    def setUp(self):
+        super().setUp()
+        self.ids = [self.create_document(make_pdf(f"Page {i}")).pk for i in range(5)]
+        self.url = reverse("company-documents", args=[self.company.pk])
+
+    def get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_cursor_round_trip(self):
+        seen = []
+        page = self.get(limit=2)
+        while True:
+            seen.extend(record["id"] for record in page["results"])
+            if page["next_cursor"] is None:
+                break
+            page = self.get(limit=2, cursor=page["next_cursor"])
+        self.assertEqual(seen, self.ids)
+
+    def test_last_page(self):
+        page = self.get(limit=2, cursor=self.ids[2])
+        self.assertEqual([record["id"] for record in page["results"]], self.ids[3:])
+        self.assertIsNone(page["next_cursor"])
+        # A page ending exactly on the last document has no next page either.
+        page = self.get(limit=5)
+        self.assertEqual(len(page["results"]), 5)
+        self.assertIsNone(page["next_cursor"])
+
+    def test_unpaginated_list(self):
+        records = self.get(paginate="false", limit=2)
+        self.assertEqual([record["id"] for record in records], self.ids)
+        self.assertEqual(records[0]["company"], self.company.pk)
+
+
+class StampingTests(DocumentTestCase):
+    """Documents are stamped once, however often they are saved."""
+
+    def read_stored(self, document):
+        with document.document_pdf.open("rb") as f:
+            return f.read()
+
+    def stamp_count(self, content):
+        reader = PdfReader(BytesIO(content))
+        return reader.pages[-1].extract_text().count("Hash:")
+
+    def test_saving_again_keeps_the_file(self):
+        document = self.create_document()
+        name = document.document_pdf.name
+        content = self.read_stored(document)
+
+        document = Document.objects.get(pk=document.pk)
+        document.is_signed = True
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+
+        self.assertEqual(document.document_pdf.name, name)
+        self.assertEqual(self.read_stored(document), content)
+        self.assertEqual(self.stamp_count(content), 1)
+
+    def test_stamp_is_appended_to_the_upload(self):
+        upload = make_pdf("Original", pages=3)
+        document = self.create_document(upload)
+        content = self.read_stored(document)
+
+        # The uploaded bytes are kept as they are, so the hash can be checked.
+        self.assertEqual(content[: len(upload)], upload)
+        marker = read_stamp_marker(PdfReader(BytesIO(content)))
+        self.assertEqual(int(marker[STAMP_INFO_SOURCE_SIZE]), len(upload))
+        self.assertEqual(
+            document.document_hash, hashlib.sha256(content[: len(upload)]).hexdigest()
+        )
+        self.assertEqual(len(PdfReader(BytesIO(content)).pages), 3)
+        self.assertEqual(self.stamp_count(content), 1)
+
+    def test_marker_identifies_the_document(self):
+        document = self.create_document()
+        reader = PdfReader(BytesIO(self.read_stored(document)))
+        self.assertTrue(
+            is_pdf_stamped(reader, document.document_hash, document.unique_identifier)
+        )
+        self.assertFalse(
+            is_pdf_stamped(reader, document.document_hash, "another-identifier")
+        )
+
+    def test_legacy_stamp_gets_a_marker_only(self):
+        document = self.create_document()
+        # A file stamped before the marker existed: the text, no marker.
+        source = BytesIO(make_pdf("Legacy"))
+        reader = PdfReader(source)
+        legacy = BytesIO()
+        overlay_last_page(
+            reader,
+            source,
+            legacy,
+            build_stamp_overlay(
+                reader.pages[-1], document.document_hash, document.unique_identifier
+            ),
+        )
+        name = document.document_pdf.storage.save(
+            "legacy.pdf", ContentFile(legacy.getvalue())
+        )
+        Document.objects.filter(pk=document.pk).update(document_pdf=name)
+
+        document = Document.objects.get(pk=document.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+        self.assertNotEqual(document.document_pdf.name, name)
+        content = self.read_stored(document)
+        self.assertEqual(
+            read_stamp_marker(PdfReader(BytesIO(content)))[STAMP_INFO_IDENTIFIER],
+            document.unique_identifier,
+        )
+        self.assertEqual(self.stamp_count(content), 1)
+
+
+class BlobReferenceTests(DocumentTestCase):
+    """Stored files are shared by content and deleted with their last reference."""
+
+    def setUp(self):
+        super().setUp()
+        self.storage = document_storage()
+
+    def test_same_content_is_stored_once(self):
+        content = make_pdf("Blob")
+        first = self.storage.save("a.pdf", ContentFile(content))
+        second = self.storage.save("b.pdf", ContentFile(content))
+        self.assertEqual(first, second)
+        self.assertEqual(DocumentBlob.objects.get(name=first).refcount, 2)
+
+        self.storage.delete(first)
+        self.assertTrue(self.storage.exists(first))
+        self.assertEqual(DocumentBlob.objects.get(name=first).refcount, 1)
+        self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+        self.assertFalse(DocumentBlob.objects.filter(name=first).exists())
+
+    def test_deleting_a_document_releases_its_file(self):
+        document = self.create_document()
+        name = document.document_pdf.name
+        self.assertEqual(DocumentBlob.objects.get(name=name).refcount, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            document.delete()
+        self.assertFalse(DocumentBlob.objects.filter(name=name).exists())
+        self.assertFalse(self.storage.exists(name))
+
+    def test_failed_insert_keeps_shared_files(self):
+        document = self.create_document()
+        name = document.document_pdf.name
+        DocumentBlob.objects.filter(name=name).update(refcount=2)
+        with mock.patch(
+            "Documents.models.CompanyChainHead.advance",
+            side_effect=RuntimeError("insert failed"),
+        ):
+            with self.assertRaises(RuntimeError):
+                self.create_document(make_pdf("Other"))
+        self.assertEqual(DocumentBlob.objects.get(name=name).refcount, 2)
+
+    def test_garbage_collection_spares_recent_blobs(self):
+        # Stored, but referenced by no document.
+        orphan = self.storage.save("orphan.pdf", ContentFile(b"%PDF-orphan"))
+
+        call_command("migrate_document_storage", "--gc", stdout=StringIO())
+        self.assertTrue(self.storage.exists(orphan))
+
+        call_command(
+            "migrate_document_storage", "--gc", "--gc-grace", "0", stdout=StringIO()
+        )
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertFalse(DocumentBlob.objects.filter(name=orphan).exists())
+
+
+class DocumentJobTests(DocumentTestCase):
+    """Queued uploads are handed out once and picked up again if abandoned."""
+
+    def create_job(self, content=None):
+        return DocumentJob.objects.create(
+            employee=self.employee,
+            company=self.company,
+            issued_date=datetime.date(2024, 1, 1),
+            staged_pdf=SimpleUploadedFile("upload.pdf", content or make_pdf()),
+        )
+
+    def test_jobs_are_claimed_once_in_order(self):
+        first, second = self.create_job(), self.create_job()
+        self.assertEqual(claim_next_job(), first.pk)
+        self.assertEqual(claim_next_job(), second.pk)
+        self.assertIsNone(claim_next_job())
+        first.refresh_from_db()
+        self.assertEqual(first.status, DocumentJob.STATUS_RUNNING)
+        self.assertEqual(first.attempts, 1)
+
+    def test_job_claimed_by_another_worker_is_skipped(self):
+        first, second = self.create_job(), self.create_job()
+        first_of = QuerySet.first
+        raced = []
+
+        def first_then_lose_the_race(queryset):
+            job_id = first_of(queryset)
+            if not raced:
+                # Another worker claims the job between our read and update.
+                raced.append(job_id)
+                DocumentJob.objects.filter(pk=job_id).update(
+                    status=DocumentJob.STATUS_RUNNING
+                )
+            return job_id
+
+        with mock.patch.object(QuerySet, "first", first_then_lose_the_race):
+            self.assertEqual(claim_next_job(), second.pk)
+        self.assertEqual(raced, [first.pk])
+        first.refresh_from_db()
+        self.assertEqual(first.attempts, 0)
+
+    def test_stale_jobs_are_requeued(self):
+        job = self.create_job()
+        claim_next_job()
+        self.assertEqual(requeue_stale_jobs(stale_after=3600), 0)
+        DocumentJob.objects.filter(pk=job.pk).update(
+            started_at=timezone.now() - datetime.timedelta(hours=2)
+        )
+        self.assertEqual(requeue_stale_jobs(stale_after=3600), 1)
+        self.assertEqual(claim_next_job(), job.pk)
+
+    def test_processed_job_creates_the_document(self):
+        content = make_pdf("Queued")
+        job = self.create_job(content)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_job(claim_next_job()), DocumentJob.STATUS_DONE)
+        job.refresh_from_db()
+        self.assertEqual(
+            job.document.document_hash, hashlib.sha256(content).hexdigest()
+        )
+
+    def test_failed_job_is_recorded(self):
+        job = self.create_job(b"not a PDF")
+        with self.assertLogs("Documents.jobs", "ERROR"):
+            status = process_job(claim_next_job())
+        self.assertEqual(status, DocumentJob.STATUS_FAILED)
+        job.refresh_from_db()
+        self.assertEqual(job.status, DocumentJob.STATUS_FAILED)
+        self.assertTrue(job.error)
+
+    def test_status_is_shown_to_its_submitter_only(self):
+        owner = User.objects.create_user(username="owner", email="o@example.com")
+        other = User.objects.create_user(username="other", email="x@example.com")
+        job = self.create_job()
+        DocumentJob.objects.filter(pk=job.pk).update(submitted_by=owner)
+        url = reverse("document-job-detail", args=[job.pk])
+
+        client = APIClient()
+        self.assertEqual(client.get(url).status_code, 401)
+        client.force_authenticate(other)
+        self.assertEqual(client.get(url).status_code, 404)
+        client.force_authenticate(owner)
+        self.assertEqual(client.get(url).status_code, 200)
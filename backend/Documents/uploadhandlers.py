@@ -0,0 +1,60 @@
+import hashlib
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+
+
+class HashingUploadHandlerMixin:
+    """Compute the SHA-256 of an upload while its chunks arrive.
+
+    The hex digest is attached to the resulting ``UploadedFile`` as
+    ``sha256``, so the document hash never needs another pass over the
+    file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(
+    HashingUploadHandlerMixin, MemoryFileUploadHandler
+):
+    """In-memory upload handler that hashes small uploads."""
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+
+class HashingTemporaryFileUploadHandler(
+    HashingUploadHandlerMixin, TemporaryFileUploadHandler
+):
+    """Temporary-file upload handler that hashes large uploads."""
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+
+class HashingUploadMixin:
+    """View mixin that installs the hashing upload handlers.
+
+    The handlers must be in place before the request body is parsed, so
+    they are set while the DRF request is being initialized.
+    """
+
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = [
+            HashingMemoryFileUploadHandler(request),
+            HashingTemporaryFileUploadHandler(request),
+        ]
+        return super().initialize_request(request, *args, **kwargs)
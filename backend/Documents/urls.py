@@ -1,11 +1,52 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DocumentViewSet, DocumentTypeViewSet
+from .views import (
+    CertificateBatchProgressView,
+    CertificateBatchView,
+    CompanyChainHeadView,
+    DocumentJobDetailView,
+    DocumentTypeViewSet,
+    DocumentViewSet,
+    document_by_copy,
+    document_by_hash,
+    document_detail,
+    get_documents_by_company,
+)
 
 router = DefaultRouter()
 router.register(r"", DocumentViewSet)
 router.register(r"types", DocumentTypeViewSet)
 
 urlpatterns = [
+    path(
+        "certificates/batch/", CertificateBatchView.as_view(), name="certificate-batch"
+    ),
+    path(
+        "certificates/batch/<str:batch_id>/",
+        CertificateBatchProgressView.as_view(),
+        name="certificate-batch-progress",
+    ),
+    path(
+        "companies/<int:company_id>/chain-head/",
+        CompanyChainHeadView.as_view(),
+        name="company-chain-head",
+    ),
+    path(
+        "companies/<int:company_id>/documents/",
+        get_documents_by_company,
+        name="company-documents",
+    ),
+    path(
+        "jobs/<int:pk>/", DocumentJobDetailView.as_view(), name="document-job-detail"
+    ),
+    path(
+        "verify/hash/<str:document_hash>/",
+        document_by_hash,
+        name="document-verify-hash",
+    ),
+    path(
+        "verify/copy/<str:copy_id>/", document_by_copy, name="document-verify-copy"
+    ),
+    path("verify/<str:identifier>/", document_detail, name="document-verify"),
     path("", include(router.urls)),
 ]
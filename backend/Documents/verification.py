@@ -0,0 +1,271 @@
+"""Cache-backed index of documents for public verification.
+
+Verifiers look a document up by its identifier, its hash or its copy ID.
+Each of the three keys maps, in the cache backend, to the same compact
+record of the document. Records are written through when a document is
+saved and removed when it is deleted, once the transaction commits, so a
+change such as signing a document is visible to the next lookup. A lookup
+missing the cache reads the record with one indexed query and stores it
+with ``cache.add``, which never replaces a record written by a save. Keys
+of deleted documents briefly hold a tombstone for the same reason, so a
+lookup racing with the delete cannot put the record back.
+
+A write that fails leaves its keys dirty: lookups in this process read
+them from the database, and a background thread writes them again until
+the cache takes them, so an outdated record is not served for
+``VERIFICATION_CACHE_TIMEOUT``.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .storage import document_storage
+
+logger = logging.getLogger(__name__)
+
+VERIFICATION_CACHE_KEY = "Documents:verify:{}:{}"
+# Safety net for records whose invalidation was lost (e.g. cache outage).
+VERIFICATION_CACHE_TIMEOUT = getattr(
+    settings, "DOCUMENT_VERIFICATION_CACHE_TIMEOUT", 24 * 60 * 60
+)
+VERIFICATION_TOMBSTONE = "deleted"
+VERIFICATION_TOMBSTONE_TIMEOUT = 5 * 60
+# Seconds between attempts to write dirty keys again, doubling up to the
+# maximum, and the number of dirty keys kept.
+REPAIR_INTERVAL = 1
+REPAIR_MAX_INTERVAL = 60
+MAX_DIRTY_KEYS = 10000
+
+# Lookup kinds and the unique field each one searches.
+LOOKUP_FIELDS = {
+    "identifier": "unique_identifier",
+    "hash": "document_hash",
+    "copy": "copy_id",
+}
+RECORD_FIELDS = (
+    "id",
+    "employee_id",
+    "company_id",
+    "document_hash",
+    "document_pdf",
+    "document_hash_previous",
+    "issued_date",
+    "unique_identifier",
+    "is_signed",
+    "copy_id",
+)
+
+
+def verification_keys(unique_identifier, document_hash, copy_id):
+    """Return the cache keys a document is indexed under."""
+    values = {
+        "identifier": unique_identifier,
+        "hash": document_hash,
+        "copy": copy_id,
+    }
+    return [
+        VERIFICATION_CACHE_KEY.format(kind, value)
+        for kind, value in values.items()
+        if value
+    ]
+
+
+def build_record(values):
+    """Build a verification record from a dict of ``RECORD_FIELDS``."""
+    issued_date = values["issued_date"]
+    return {
+        "id": values["id"],
+        "employee": values["employee_id"],
+        "company": values["company_id"],
+        "document_hash": values["document_hash"],
+        "document_pdf": values["document_pdf"],
+        "document_hash_previous": values["document_hash_previous"],
+        "issued_date": (
+            issued_date.isoformat()
+            if hasattr(issued_date, "isoformat")
+            else issued_date
+        ),
+        "unique_identifier": values["unique_identifier"],
+        "is_signed": values["is_signed"],
+        "copy_id": values["copy_id"],
+    }
+
+
+def document_record(document):
+    """Build the verification record of a document instance."""
+    values = {field: getattr(document, field) for field in RECORD_FIELDS}
+    values["document_pdf"] = document.document_pdf.name
+    return build_record(values)
+
+
+def public_record(record):
+    """Return a record as sent to verifiers, with the file as a URL."""
+    url = document_storage().url(record["document_pdf"])
+    return {**record, "document_pdf": url}
+
+
+class _DirtyKeys:
+    """Keys whose last write failed, with the value still to be written.
+
+    Past ``MAX_DIRTY_KEYS`` every key counts as dirty until anything
+    written before has expired from the cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.all_dirty_until = None
+        self.repairer = None
+
+    def add(self, values, timeout):
+        with self.lock:
+            if len(self.values) + len(values) > MAX_DIRTY_KEYS:
+                logger.error("Too many unindexed documents, bypassing the index")
+                self.values.clear()
+                self.all_dirty_until = time.monotonic() + VERIFICATION_CACHE_TIMEOUT
+            else:
+                for key, value in values.items():
+                    self.values[key] = (value, timeout)
+            if self.repairer is None or not self.repairer.is_alive():
+                self.repairer = threading.Thread(
+                    target=self.repair, name="verification-repair", daemon=True
+                )
+                self.repairer.start()
+
+    def discard(self, values):
+        """Forget keys whose latest value was written."""
+        with self.lock:
+            for key, value in values.items():
+                if key in self.values and self.values[key][0] == value:
+                    del self.values[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            if self.all_dirty_until is not None:
+                if time.monotonic() < self.all_dirty_until:
+                    return True
+                self.all_dirty_until = None
+            return key in self.values
+
+    def repair(self):
+        delay = REPAIR_INTERVAL
+        while True:
+            time.sleep(delay)
+            with self.lock:
+                pending = dict(self.values)
+            if not pending:
+                return
+            by_timeout = {}
+            for key, (value, timeout) in pending.items():
+                by_timeout.setdefault(timeout, {})[key] = value
+            try:
+                for timeout, values in by_timeout.items():
+                    cache.set_many(values, timeout=timeout)
+                    self.discard(values)
+            except Exception as e:
+                logger.warning("Verification index still unavailable: %s", e)
+                delay = min(delay * 2, REPAIR_MAX_INTERVAL)
+            else:
+                delay = REPAIR_INTERVAL
+
+
+_dirty = _DirtyKeys()
+
+
+def _write(values, timeout):
+    """Write index entries, leaving them dirty if the cache fails."""
+    try:
+        cache.set_many(values, timeout=timeout)
+    except Exception as e:
+        logger.warning("Could not update the verification index: %s", e)
+        _dirty.add(values, timeout)
+    else:
+        _dirty.discard(values)
+
+
+def store(record):
+    """Write a record under all of its keys."""
+    keys = verification_keys(
+        record["unique_identifier"], record["document_hash"], record["copy_id"]
+    )
+    _write({key: record for key in keys}, VERIFICATION_CACHE_TIMEOUT)
+
+
+def forget(unique_identifier, document_hash, copy_id):
+    """Replace the record of a document by a tombstone."""
+    keys = verification_keys(unique_identifier, document_hash, copy_id)
+    _write(
+        {key: VERIFICATION_TOMBSTONE for key in keys}, VERIFICATION_TOMBSTONE_TIMEOUT
+    )
+
+
+def store_on_commit(document):
+    """Write the record of a saved document once the transaction commits."""
+    record = document_record(document)
+    transaction.on_commit(lambda: store(record))
+
+
+def forget_on_commit(document):
+    """Remove a deleted document from the index once the transaction commits."""
+    keys = (document.unique_identifier, document.document_hash, document.copy_id)
+    transaction.on_commit(lambda: forget(*keys))
+
+
+def reindex(document_ids):
+    """Write the records of documents changed without ``save()`` through.
+
+    Args:
+        document_ids (iterable): IDs of the documents, e.g. after a
+            queryset ``update()``.
+    """
+    from .models import Document
+
+    rows = Document.objects.filter(pk__in=list(document_ids)).values(*RECORD_FIELDS)
+    for values in rows:
+        store(build_record(values))
+
+
+def lookup(kind, value):
+    """Find the verification record of a document.
+
+    Args:
+        kind (str): One of ``LOOKUP_FIELDS``.
+        value (str): Identifier, hash or copy ID to look up.
+
+    Returns:
+        dict: The record, or None if no document matches.
+    """
+    from .models import Document
+
+    key = VERIFICATION_CACHE_KEY.format(kind, value)
+    if key in _dirty:
+        # The cache may still hold what the failed write should replace.
+        record = key = None
+    else:
+        try:
+            record = cache.get(key)
+        except Exception as e:
+            logger.warning("Verification index unavailable: %s", e)
+            record = key = None
+    if record is not None and record != VERIFICATION_TOMBSTONE:
+        return record
+
+    values = (
+        Document.objects.filter(**{LOOKUP_FIELDS[kind]: value})
+        .values(*RECORD_FIELDS)
+        .first()
+    )
+    if values is None:
+        return None
+    record = build_record(values)
+    if key is not None:
+        try:
+            cache.add(key, record, timeout=VERIFICATION_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning("Could not index document %s: %s", record["id"], e)
+    return record
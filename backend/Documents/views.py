@@ -1,21 +1,78 @@
 from django.db import IntegrityError, transaction
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
-from .models import Document, DocumentType
-from .serializers import DocumentSerializer, DocumentTypeSerializer
+from django.urls import reverse
+from .certificates import BatchProgress, stream_certificate_zip
+from .jobs import enqueue_document
+from .logos import company_logo_image
+from .models import CompanyChainHead, Document, DocumentJob, DocumentType
+from .serializers import (
+    CertificateBatchSerializer,
+    CompanyChainHeadSerializer,
+    DocumentJobSerializer,
+    DocumentSerializer,
+    DocumentTypeSerializer,
+)
 from rest_framework import generics, viewsets
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from .forms import DocumentForm
 from .pdf_utils import create_pdf_with_metadata
-from rest_framework.decorators import api_view, permission_classes
+from .uploadhandlers import HashingUploadMixin
+from . import verification
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
-from django.views.decorators.cache import cache_page
-from django.core.cache import cache
+from rest_framework.negotiation import BaseContentNegotiation
+from voxlyne.caching import CachedListMixin
+from voxlyne.responses import segmented_response
+import hashlib
+import json
+import os
 
 
 # Create your views here.
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """Content negotiation that doesn't reject clients asking for a PDF.
+
+    Views using it return the file as a plain Django response; the first
+    renderer is only used for error responses.
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
+
+class QueuedUploadMixin:
+    """View mixin that hands validated uploads to the background job queue."""
+
+    def queue_upload(self, serializer):
+        """Stage a validated upload and answer with its job.
+
+        Args:
+            serializer: A validated ``DocumentSerializer``.
+
+        Returns:
+            Response: 202 response with the job status and its URL.
+        """
+        user = self.request.user
+        job = enqueue_document(
+            serializer.validated_data,
+            submitted_by=user if user.is_authenticated else None,
+        )
+        location = reverse("document-job-detail", args=[job.pk])
+        return Response(
+            DocumentJobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": location},
+        )
+
+
 class DocumentTypeListCreateView(generics.ListCreateAPIView):
     """API endpoint to list and create document types.
 
@@ -57,7 +114,9 @@ class DocumentTypeDetailView(generics.RetrieveUpdateDestroyAPIView):
         return [IsAuthenticated()]
 
 
-class DocumentListCreateView(generics.ListCreateAPIView):
+class DocumentListCreateView(
+    HashingUploadMixin, QueuedUploadMixin, generics.ListCreateAPIView
+):
     """API view for listing and creating documents.
 
     This view provides endpoints for:
@@ -76,7 +135,12 @@ class DocumentListCreateView(generics.ListCreateAPIView):
     def post(self, request, *args, **kwargs):
         """Handle POST requests to create a document.
 
-        Creates a new document after validating the data and checking for duplicates.
+        Creates a new document after validating the data. Content already
+        stored gets a random hash (see ``Document.generate_unique_document_hash``);
+        a duplicate hash that still reaches the database is rejected by the
+        unique constraint.
+        With ``DOCUMENT_PROCESSING_ASYNC`` enabled the upload is queued instead
+        and the response is a 202 with the job status.
 
         Args:
             request: The HTTP request object containing the document data.
@@ -88,15 +152,11 @@ class DocumentListCreateView(generics.ListCreateAPIView):
         """
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
+        if settings.DOCUMENT_PROCESSING_ASYNC:
+            return self.queue_upload(serializer)
 
         try:
             with transaction.atomic():
-                document_hash = serializer.validated_data.get("document_hash")
-                if Document.objects.filter(document_hash=document_hash).exists():
-                    return Response(
-                        {"error": "Document with this hash already exists."},
-                        status=status.HTTP_400_BAD_REQUEST,
-                    )
                 self.perform_create(serializer)
         except IntegrityError:
             return Response(
@@ -110,7 +170,7 @@ class DocumentListCreateView(generics.ListCreateAPIView):
         )
 
 
-class DocumentDetailView(generics.RetrieveUpdateDestroyAPIView):
+class DocumentDetailView(HashingUploadMixin, generics.RetrieveUpdateDestroyAPIView):
     """API view for retrieving, updating, and deleting individual documents.
 
     This view provides endpoints for:
@@ -151,6 +211,9 @@ def create_document(request):
             duration = form.cleaned_data["duration"]
             position = form.cleaned_data["position"]
             company_logo = form.cleaned_data.get("company_logo")
+            if not company_logo:
+                # Default to the logo stored for the company.
+                company_logo = company_logo_image(company_name)
 
             # Generate the PDF with the provided data
             response = create_pdf_with_metadata(
@@ -161,6 +224,7 @@ def create_document(request):
                 duration,
                 position,
                 company_logo,
+                request=request,
             )
             return response
     else:
@@ -168,44 +232,148 @@ def create_document(request):
     return render(request, "create_document.html", {"form": form})
 
 
-@cache_page(60 * 15)
+class CertificateBatchView(APIView):
+    """API endpoint to generate employment certificates in bulk.
+
+    create:
+    Takes a list of (document, employee, company, duration, position)
+    entries and streams back a ZIP archive with one certificate per entry.
+    The ``X-Batch-Id`` response header names the batch whose progress is
+    reported by :class:`CertificateBatchProgressView`.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = CertificateBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        specs = serializer.certificate_specs()
+
+        progress = BatchProgress(len(specs))
+        progress.save("queued")
+        response = StreamingHttpResponse(
+            stream_certificate_zip(specs, progress), content_type="application/zip"
+        )
+        response["Content-Disposition"] = 'attachment; filename="certificates.zip"'
+        response["X-Batch-Id"] = progress.batch_id
+        return response
+
+
+class CertificateBatchProgressView(APIView):
+    """API endpoint to follow a certificate batch.
+
+    retrieve:
+    Returns the number of certificates rendered and failed so far.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, batch_id, *args, **kwargs):
+        progress = BatchProgress.get(batch_id)
+        if progress is None:
+            return Response(
+                {"error": "Batch not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(progress, status=status.HTTP_200_OK)
+
+
+def _encode_records(rows):
+    """Encode rows of ``RECORD_FIELDS`` as comma-separated JSON records."""
+    for count, values in enumerate(rows):
+        record = verification.public_record(verification.build_record(values))
+        yield ("," if count else "") + json.dumps(record)
+
+
+def _stream_document_page(rows, limit):
+    """Encode a page of documents as JSON, one row at a time.
+
+    ``rows`` holds one row more than the page when another page follows;
+    ``next_cursor`` is written after the rows.
+    """
+    yield '{"results": ['
+    yield from _encode_records(rows[:limit])
+    last_id = rows[limit - 1]["id"] if len(rows) > limit else None
+    yield '], "next_cursor": %s}' % json.dumps(
+        str(last_id) if last_id is not None else None
+    )
+
+
+def _stream_document_list(rows):
+    """Encode every document of a company as a bare JSON list."""
+    yield "["
+    yield from _encode_records(rows)
+    yield "]"
+
+
 @api_view(["GET"])
 @permission_classes([AllowAny])
 def get_documents_by_company(request, company_id):
-    """API view for retrieving all documents associated with a company.
+    """API view for listing the documents associated with a company.
+
+    Documents are returned in ID order, in pages of ``limit`` rows (at most
+    ``DOCUMENT_COMPANY_PAGE_MAX``, ``DOCUMENT_COMPANY_PAGE_SIZE`` by
+    default), as ``{"results": [...], "next_cursor": ...}``. Pass
+    ``next_cursor`` back as ``cursor`` to read the next page, until it is
+    null. With ``paginate=false`` the response is instead a bare list of
+    every document of the company, as it was before pagination. Only the
+    listed columns are read. The rows are fetched before the response is
+    returned, inside the request's transaction and database routing, and
+    only their encoding is streamed.
 
     Args:
         request: The HTTP request object.
         company_id: The ID of the company to get documents for.
 
     Returns:
-        Response: JSON response containing the list of documents.
+        Response: JSON response containing a page of documents, or all of
+        them.
     """
-    documents = Document.get_documents_by_company(company_id)
-    documents_data = [
-        {
-            "id": document.id,
-            "employee": document.employee.id,
-            "company": document.company.id,
-            "document_hash": document.document_hash,
-            "document_pdf": document.document_pdf.url,
-            "document_hash_previous": document.document_hash_previous,
-            "issued_date": document.issued_date,
-            "unique_identifier": document.unique_identifier,
-            "is_signed": document.is_signed,
-            "copy_id": document.copy_id,
-        }
-        for document in documents
-    ]
-    return Response(documents_data, status=status.HTTP_200_OK)
-
-
-@cache_page(60 * 15)
+    if request.query_params.get("paginate", "").lower() == "false":
+        documents = Document.get_documents_by_company(company_id)
+        rows = list(documents.values(*verification.RECORD_FIELDS))
+        return StreamingHttpResponse(
+            _stream_document_list(rows), content_type="application/json"
+        )
+
+    try:
+        after_id = request.query_params.get("cursor")
+        after_id = int(after_id) if after_id else None
+        limit = int(
+            request.query_params.get("limit", settings.DOCUMENT_COMPANY_PAGE_SIZE)
+        )
+    except ValueError:
+        return Response(
+            {"error": "cursor and limit must be integers."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    limit = max(1, min(limit, settings.DOCUMENT_COMPANY_PAGE_MAX))
+
+    documents = Document.get_documents_by_company(company_id, after_id)
+    # One row more than the page tells whether another page follows.
+    rows = list(documents.values(*verification.RECORD_FIELDS)[: limit + 1])
+    return StreamingHttpResponse(
+        _stream_document_page(rows, limit), content_type="application/json"
+    )
+
+
+def _verification_response(kind, value):
+    record = verification.lookup(kind, value)
+    if record is None:
+        return Response(
+            {"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND
+        )
+    return Response(verification.public_record(record), status=status.HTTP_200_OK)
+
+
 @api_view(["GET"])
 @permission_classes([AllowAny])
 def document_detail(request, identifier):
     """API view for retrieving a specific document by its identifier.
 
+    Answers come from the verification index (see
+    ``Documents.verification``), which is updated whenever a document
+    changes.
+
     Args:
         request: The HTTP request object.
         identifier: The unique identifier of the document.
@@ -213,27 +381,42 @@ def document_detail(request, identifier):
     Returns:
         Response: JSON response containing the document data or error message.
     """
-    document = Document.find_by_identifier(identifier)
-    if document is None:
-        return Response(
-            {"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND
-        )
-    document_data = {
-        "id": document.id,
-        "employee": document.employee.id,
-        "company": document.company.id,
-        "document_hash": document.document_hash,
-        "document_pdf": document.document_pdf.url,
-        "document_hash_previous": document.document_hash_previous,
-        "issued_date": document.issued_date,
-        "unique_identifier": document.unique_identifier,
-        "is_signed": document.is_signed,
-        "copy_id": document.copy_id,
-    }
-    return Response(document_data, status=status.HTTP_200_OK)
-
-
-class DocumentViewSet(viewsets.ModelViewSet):
+    return _verification_response("identifier", identifier)
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def document_by_hash(request, document_hash):
+    """API view for verifying a document by its hash.
+
+    Args:
+        request: The HTTP request object.
+        document_hash: The hash of the document.
+
+    Returns:
+        Response: JSON response containing the document data or error message.
+    """
+    return _verification_response("hash", document_hash)
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def document_by_copy(request, copy_id):
+    """API view for verifying a document by its copy ID.
+
+    Args:
+        request: The HTTP request object.
+        copy_id: The copy ID of the document.
+
+    Returns:
+        Response: JSON response containing the document data or error message.
+    """
+    return _verification_response("copy", copy_id)
+
+
+class DocumentViewSet(
+    HashingUploadMixin, CachedListMixin, QueuedUploadMixin, viewsets.ModelViewSet
+):
     """API endpoint to manage documents."""
 
     queryset = Document.objects.select_related('employee', 'company').all().order_by('id')
@@ -241,27 +424,99 @@ class DocumentViewSet(viewsets.ModelViewSet):
     renderer_classes = [JSONRenderer, BrowsableAPIRenderer]
     permission_classes = [AllowAny]
 
-    def list(self, request, *args, **kwargs):
-        """Handle GET list requests, checking cache first."""
-        cache_key = 'Documents:cache:viewset_list'
-        cached_data = cache.get(cache_key)
+    @action(
+        detail=True,
+        methods=["get"],
+        content_negotiation_class=IgnoreClientContentNegotiation,
+    )
+    def download(self, request, pk=None):
+        """Stream the stored PDF of a document in chunks.
+
+        Supports ``Range`` and ``If-Range``, so PDF viewers can fetch parts
+        of large documents and resume interrupted downloads.
+        """
+        document = self.get_object()
+        pdf = document.document_pdf
+        storage = pdf.storage
+        size = pdf.size
+        etag_source = f"{pdf.name}:{size}".encode()
+        etag = f'"{hashlib.sha256(etag_source).hexdigest()[:32]}"'
+        try:
+            last_modified = storage.get_modified_time(pdf.name).timestamp()
+        except (NotImplementedError, OSError):
+            last_modified = None
+        return segmented_response(
+            request,
+            [(storage.open(pdf.name, "rb"), 0, size)],
+            filename=os.path.basename(pdf.name),
+            as_attachment=False,
+            etag=etag,
+            last_modified=last_modified,
+        )
+
+    def create(self, request, *args, **kwargs):
+        """Handle POST requests, queueing the upload when processing is async."""
+        if not settings.DOCUMENT_PROCESSING_ASYNC:
+            return super().create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.queue_upload(serializer)
 
-        if cached_data:
-            print(f"Cache hit for {cache_key}")
-            return Response(cached_data)
 
-        print(f"Cache miss for {cache_key}")
-        response = super().list(request, *args, **kwargs)
+class DocumentJobDetailView(generics.RetrieveAPIView):
+    """API endpoint to follow a background document job.
 
-        if response.status_code == 200:
-            cache.set(cache_key, response.data, timeout=300)
+    retrieve:
+    Returns the status of the job and, once done, the created document.
+    Users only see the jobs they submitted; staff see every job.
+    """
 
-        return response
+    queryset = DocumentJob.objects.all()
+    serializer_class = DocumentJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.user.is_staff:
+            return queryset
+        return queryset.filter(submitted_by=self.request.user)
+
+
+class CompanyChainHeadView(APIView):
+    """API endpoint to read the head of a company's document hash chain.
+
+    retrieve:
+    Returns the hash of the latest document of the company, so auditors can
+    anchor a verification without listing the company's documents.
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, company_id, *args, **kwargs):
+        head = CompanyChainHead.objects.filter(company_id=company_id).first()
+        if head is not None:
+            return Response(CompanyChainHeadSerializer(head).data)
+        # No document was added since the head was introduced.
+        documents = Document.objects.filter(company_id=company_id)
+        if not documents.exists():
+            return Response(
+                {"error": "Company has no documents."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        return Response(
+            {
+                "company": company_id,
+                "head_hash": CompanyChainHead.latest_document_hash(company_id),
+                "length": documents.count(),
+                "updated_at": None,
+            }
+        )
 
 
-class DocumentTypeViewSet(viewsets.ModelViewSet):
+class DocumentTypeViewSet(CachedListMixin, viewsets.ModelViewSet):
     """API endpoint to manage document types."""
 
+    cache_alias = "tiered"
     queryset = DocumentType.objects.all()
     serializer_class = DocumentTypeSerializer
     renderer_classes = [JSONRenderer, BrowsableAPIRenderer]
@@ -0,0 +1,87 @@
+"""Entry points for document job worker processes.
+
+This module does not import models at load time, so it can be imported by
+a freshly spawned interpreter before Django is set up.
+"""
+
+
+def init_worker():
+    """Set up Django in a worker process.
+
+    Database connections inherited from the parent process are dropped so
+    every worker opens its own.
+    """
+    import django
+
+    django.setup()
+
+    from django.db import connections
+
+    connections.close_all()
+
+
+def run_job(job_id):
+    """Process one claimed document job in a worker process.
+
+    Args:
+        job_id (int): ID of the claimed job.
+
+    Returns:
+        tuple: ``(job_id, status)``.
+    """
+    from .jobs import process_job
+
+    return job_id, process_job(job_id)
+
+
+def render_certificate(spec):
+    """Render one employment certificate in a worker process.
+
+    Args:
+        spec (dict): Specification built by ``certificate_spec``.
+
+    Returns:
+        bytes: The certificate PDF.
+    """
+    from io import BytesIO
+
+    from .logos import logo_image
+    from .pdf_utils import write_certificate
+    from .storage import document_storage
+
+    logo = None
+    if spec["company_logo"]:
+        logo = logo_image(spec["company_logo"])
+    output = BytesIO()
+    with document_storage().open(spec["document_pdf"], "rb") as source:
+        write_certificate(
+            source,
+            output,
+            spec["company_name"],
+            spec["employee_name"],
+            spec["employee_id"],
+            spec["duration"],
+            spec["position"],
+            logo,
+        )
+    return output.getvalue()
+
+
+def verify_document_file(item):
+    """Verify the stored PDF of one document in a worker process.
+
+    Args:
+        item (tuple): ``(id, file name, document hash, unique identifier,
+            hash randomized)``.
+
+    Returns:
+        tuple: ``(id, result, detail)``, see ``verify_stored_file``.
+    """
+    from .integrity import verify_stored_file
+    from .storage import document_storage
+
+    document_id, name, document_hash, unique_identifier, hash_randomized = item
+    result, detail = verify_stored_file(
+        document_storage(), name, document_hash, unique_identifier, hash_randomized
+    )
+    return document_id, result, detail
@@ -40,5 +40,7 @@ class DocumentCopy(models.Model):
 
     class Meta:
         ordering = ["-issued_date"]
+        # Pages of the copy list, newest first, without sorting the table.
+        indexes = [models.Index(fields=["-issued_date"])]
         verbose_name = "Document Copy"
         verbose_name_plural = "Document Copies"
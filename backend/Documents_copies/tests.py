@@ -1,3 +1,13 @@
 from django.test import TestCase
 
-# Create your tests here.
+from Documents_copies.views import DocumentCopyListCreateView
+from voxlyne.db.testing import QueryPlanMixin
+
+
+class DocumentCopyQueryPlanTests(QueryPlanMixin, TestCase):
+    """Pages of the copy list are read in index order."""
+
+    def test_list_page(self):
+        queryset = DocumentCopyListCreateView.queryset
+        index = queryset.model._meta.indexes[0].name
+        self.assertIndexed(queryset[:10], index)
@@ -198,8 +198,12 @@ class Employee(models.Model):
 class EmploymentHistory(models.Model):
     """Template for storing employee work history."""
 
+    # Indexed together with the start date, see Meta.indexes.
     employee = models.ForeignKey(
-        Employee, on_delete=models.CASCADE, related_name="employment_history"
+        Employee,
+        on_delete=models.CASCADE,
+        related_name="employment_history",
+        db_index=False,
     )
     company_name = models.CharField(max_length=100)
     position = models.CharField(max_length=100)
@@ -209,6 +213,8 @@ class EmploymentHistory(models.Model):
 
     class Meta:
         ordering = ["-start_date"]
+        # The history of an employee in start date order, either way.
+        indexes = [models.Index(fields=["employee", "start_date"])]
         verbose_name = "Employment History"
         verbose_name_plural = "Employment Histories"
 
@@ -1,3 +1,14 @@
 from django.test import TestCase
 
-# Create your tests here.
+from Employees.models import EmploymentHistory
+from voxlyne.db.testing import QueryPlanMixin
+
+
+class EmploymentHistoryQueryPlanTests(QueryPlanMixin, TestCase):
+    """The history of an employee is read in index order."""
+
+    def test_employee_history(self):
+        self.assertIndexed(
+            EmploymentHistory.get_employee_history(7),
+            EmploymentHistory._meta.indexes[0].name,
+        )
@@ -4,11 +4,11 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from .models import EmploymentHistory
 from .serializers import EmploymentHistorySerializer
-from django.core.cache import cache
+from voxlyne.caching import CachedListMixin
 
 
 # Create your views here.
-class EmploymentHistoryListCreateView(generics.ListCreateAPIView):
+class EmploymentHistoryListCreateView(CachedListMixin, generics.ListCreateAPIView):
     """API endpoint to list and create employment histories.
 
     list:
@@ -26,26 +26,6 @@ class EmploymentHistoryListCreateView(generics.ListCreateAPIView):
             return [AllowAny()]
         return [IsAuthenticated()]
 
-    def list(self, request, *args, **kwargs):
-        """Handle GET list requests, checking cache first."""
-        cache_key = 'Employment_history:cache:list_view' # Updated key format
-        cached_data = cache.get(cache_key)
-
-        if cached_data:
-            print(f"Cache hit for {cache_key}")
-            # See comment in Companies/views.py regarding returning cached data directly
-            return Response(cached_data)
-
-        print(f"Cache miss for {cache_key}")
-        # Call the original list method
-        response = super().list(request, *args, **kwargs)
-
-        # Cache the data part of the response
-        if response.status_code == 200:
-            cache.set(cache_key, response.data, timeout=300)
-
-        return response
-
 
 class EmploymentHistoryDetailView(generics.RetrieveUpdateDestroyAPIView):
     """API endpoint to view, update, and delete employment histories.
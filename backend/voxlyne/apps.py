@@ -294,6 +294,9 @@ class VoxlyneConfig(AppConfig):
 
     def ready(self):
         """Called when Django apps are ready."""
+        # Connect the receivers that invalidate cached lists.
+        from . import caching  # noqa: F401
+
         # Only run this once to prevent duplicate messages
         if hasattr(VoxlyneConfig, '_initialization_complete') and VoxlyneConfig._initialization_complete:
             return
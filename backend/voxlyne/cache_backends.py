@@ -0,0 +1,712 @@
+"""Cache backends of the project.
+
+``ResilientRedisCache`` is the Redis backend behind ``default``. After a
+few connection errors in a row it stops calling Redis (the circuit opens)
+and serves a bounded in-process cache instead, while a background thread
+probes Redis and switches back once it answers. Keys written during the
+outage are deleted from Redis on recovery, so nothing stale is read back.
+
+``TieredCache`` keeps a small in-process LRU (L1) in front of another
+cache alias (L2, Redis in production). Reads are served from L1 when
+possible; writes go through to L2 and are announced on a Redis pub/sub
+channel, so every process drops its L1 copy of the key. Configure it as
+an extra alias::
+
+    CACHES["tiered"] = {
+        "BACKEND": "voxlyne.cache_backends.TieredCache",
+        "OPTIONS": {"L2": "default", "MAX_ENTRIES": 2048, "L1_TIMEOUT": 30},
+    }
+"""
+
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django_redis.cache import RedisCache
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "voxlyne:cache:invalidate"
+CLEAR_MESSAGE = "*"
+RECONNECT_DELAY = 5
+# Seconds the invalidation listener waits for a message per poll.
+LISTEN_POLL_INTERVAL = 1
+# Seconds of silence on the channel after which the listener pings Redis,
+# and reconnects if the ping gets no answer within as long again.
+LISTEN_PING_INTERVAL = 30
+
+# Errors meaning Redis could not be reached, as opposed to a bad command.
+REDIS_ERRORS = (ConnectionInterrupted, RedisConnectionError, RedisTimeoutError)
+
+# Circuit breaker per Redis cache alias, shared like the L1 state below.
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# L1 state per cache alias. Django creates a backend instance per thread;
+# the entries, counters and listener are shared by all of them.
+_states = {}
+_states_lock = threading.Lock()
+
+
+class LayerStats:
+    """Hit and miss counters of one cache layer."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class CircuitBreaker:
+    """Failure counter deciding whether Redis is called at all.
+
+    The circuit opens after ``threshold`` consecutive failures and closes
+    again once a probe succeeds. Keys written while it is open are kept,
+    up to ``max_dirty``, so they can be dropped from Redis on recovery.
+    """
+
+    def __init__(self, threshold, max_dirty):
+        self.threshold = threshold
+        self.max_dirty = max_dirty
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.failures = 0
+        self.open = False
+        self.opened_at = None
+        self.trips = 0
+        self.fallback_calls = 0
+        self.dirty = set()
+        self.dirty_overflow = False
+        self.prober = None
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self):
+        """Count a failure; return True if it opened the circuit."""
+        with self.lock:
+            self.failures += 1
+            if self.open or self.failures < self.threshold:
+                return False
+            self.open = True
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            return True
+
+    def mark_dirty(self, keys, version):
+        with self.lock:
+            if self.dirty_overflow:
+                return
+            self.dirty.update((key, version) for key in keys)
+            if len(self.dirty) > self.max_dirty:
+                self.dirty.clear()
+                self.dirty_overflow = True
+
+    def mark_cleared(self):
+        with self.lock:
+            self.dirty.clear()
+            self.dirty_overflow = True
+
+
+class ResilientRedisCache(RedisCache):
+    """Redis cache falling back to local memory while Redis is unreachable.
+
+    Use it with short ``SOCKET_CONNECT_TIMEOUT`` and ``SOCKET_TIMEOUT``
+    options, so the failures that open the circuit are quick. While the
+    circuit is open every operation goes to a ``LocMemCache`` of this
+    process. Its data is dropped on recovery, together with the Redis
+    copies of the keys it wrote (or the whole Redis cache if there were
+    more than ``MAX_DIRTY_KEYS``), because other processes may have written
+    them in the meantime.
+
+    Options (besides those of django-redis):
+        FAILURE_THRESHOLD (int): Consecutive connection errors opening the
+            circuit.
+        PROBE_INTERVAL (float): Seconds between probes while it is open.
+        FALLBACK_MAX_ENTRIES (int): Entries kept by the local cache.
+        MAX_DIRTY_KEYS (int): Keys written during an outage that are
+            remembered, one by one, for the recovery.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        options = params.get("OPTIONS", {})
+        self.probe_interval = options.get("PROBE_INTERVAL", 5)
+        self._fallback = LocMemCache(
+            f"resilient:{server}",
+            {
+                "TIMEOUT": params.get("TIMEOUT", 300),
+                "KEY_PREFIX": params.get("KEY_PREFIX", ""),
+                "VERSION": params.get("VERSION", 1),
+                "OPTIONS": {"MAX_ENTRIES": options.get("FALLBACK_MAX_ENTRIES", 10000)},
+            },
+        )
+        with _breakers_lock:
+            self._breaker = _breakers.setdefault(
+                server,
+                CircuitBreaker(
+                    options.get("FAILURE_THRESHOLD", 3),
+                    options.get("MAX_DIRTY_KEYS", 10000),
+                ),
+            )
+
+    @property
+    def available(self):
+        """Whether Redis is being used, i.e. the circuit is closed."""
+        breaker = self._breaker
+        if breaker.pid != os.getpid():
+            with breaker.lock:
+                if breaker.pid != os.getpid():
+                    # Forked: the probing thread did not carry over.
+                    breaker.reset()
+        return not breaker.open
+
+    def _call(self, method, *args, keys=(), version=None, write=False):
+        """Run a cache operation on Redis, or locally if Redis is down."""
+        breaker = self._breaker
+        if self.available:
+            try:
+                result = getattr(super(), method)(*args, version=version)
+            except REDIS_ERRORS as e:
+                self._failed(method, e)
+            else:
+                breaker.succeeded()
+                if breaker.dirty or breaker.dirty_overflow:
+                    # A write failed without opening the circuit.
+                    self._drop_dirty()
+                return result
+        breaker.fallback_calls += 1
+        if write:
+            breaker.mark_dirty(keys, version)
+        return getattr(self._fallback, method)(*args, version=version)
+
+    def _failed(self, method, error):
+        logger.warning("Redis cache error in %s: %s", method, error)
+        if self._breaker.failed():
+            logger.error("Redis cache unreachable, using local memory")
+            # Entries left by earlier single failures may be outdated.
+            self._fallback.clear()
+            self._start_prober()
+
+    def publish(self, channel, message):
+        """Publish a pub/sub message, unless the circuit is open.
+
+        Returns:
+            bool: Whether the message was sent.
+        """
+        if not self.available:
+            return False
+        try:
+            self.client.get_client(write=True).publish(channel, message)
+        except REDIS_ERRORS as e:
+            self._failed("publish", e)
+            return False
+        self._breaker.succeeded()
+        return True
+
+    def _start_prober(self):
+        breaker = self._breaker
+        with breaker.lock:
+            if breaker.prober is not None and breaker.prober.is_alive():
+                return
+            breaker.prober = threading.Thread(
+                target=self._probe, name="redis-cache-probe", daemon=True
+            )
+            breaker.prober.start()
+
+    def _probe(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.client.get_client(write=True).ping()
+                self._recover()
+            except REDIS_ERRORS:
+                continue
+            except Exception as e:
+                logger.warning("Redis cache probe failed: %s", e)
+                continue
+            return
+
+    def _drop_dirty(self):
+        """Delete the keys written only to the local cache from Redis."""
+        breaker = self._breaker
+        with breaker.lock:
+            dirty, breaker.dirty = breaker.dirty, set()
+            overflow, breaker.dirty_overflow = breaker.dirty_overflow, False
+        try:
+            if overflow:
+                super().clear()
+                return
+            by_version = {}
+            for key, version in dirty:
+                by_version.setdefault(version, []).append(key)
+            for version, keys in by_version.items():
+                super().delete_many(keys, version=version)
+        except Exception:
+            with breaker.lock:
+                breaker.dirty |= dirty
+                breaker.dirty_overflow |= overflow
+            raise
+
+    def _recover(self):
+        """Drop what changed during the outage from Redis, then close."""
+        breaker = self._breaker
+        while True:
+            self._drop_dirty()
+            with breaker.lock:
+                if not breaker.dirty and not breaker.dirty_overflow:
+                    self._fallback.clear()
+                    breaker.open = False
+                    breaker.failures = 0
+                    break
+        logger.warning(
+            "Redis cache reachable again after %.0fs",
+            time.monotonic() - breaker.opened_at,
+        )
+
+    def get(self, key, default=None, version=None):
+        return self._call("get", key, default, version=version)
+
+    def get_many(self, keys, version=None):
+        return self._call("get_many", keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self._call("has_key", key, version=version)
+
+    def ttl(self, key, version=None):
+        if self.available:
+            try:
+                return super().ttl(key, version=version)
+            except REDIS_ERRORS as e:
+                logger.warning("Redis cache error in ttl: %s", e)
+        # LocMemCache has no ttl(); read its expiry time instead.
+        fallback = self._fallback
+        expires = fallback._expire_info.get(
+            fallback.make_and_validate_key(key, version=version)
+        )
+        if expires is None:
+            return 0 if not fallback.has_key(key, version=version) else None
+        return max(0, round(expires - time.time()))
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._call(
+            "set", key, value, timeout, keys=[key], version=version, write=True
+        )
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._call(
+            "set_many", data, timeout, keys=list(data), version=version, write=True
+        )
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._call(
+            "add", key, value, timeout, keys=[key], version=version, write=True
+        )
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._call(
+            "touch", key, timeout, keys=[key], version=version, write=True
+        )
+
+    def delete(self, key, version=None):
+        return self._call(
+            "delete", key, keys=[key], version=version, write=True
+        )
+
+    def delete_many(self, keys, version=None):
+        return self._call(
+            "delete_many", keys, keys=keys, version=version, write=True
+        )
+
+    def incr(self, key, delta=1, version=None):
+        return self._call(
+            "incr", key, delta, keys=[key], version=version, write=True
+        )
+
+    def decr(self, key, delta=1, version=None):
+        return self._call(
+            "decr", key, delta, keys=[key], version=version, write=True
+        )
+
+    def clear(self):
+        if self.available:
+            try:
+                return super().clear()
+            except REDIS_ERRORS as e:
+                logger.warning("Redis cache error in clear: %s", e)
+        self._breaker.mark_cleared()
+        return self._fallback.clear()
+
+    def stats(self):
+        """Return the state of the circuit breaker.
+
+        Returns:
+            dict: Whether Redis is in use, the current failure streak, how
+            often the circuit opened and how many calls the local cache
+            served.
+        """
+        breaker = self._breaker
+        return {
+            "available": self.available,
+            "failures": breaker.failures,
+            "trips": breaker.trips,
+            "fallback_calls": breaker.fallback_calls,
+            "open_for": (
+                time.monotonic() - breaker.opened_at if breaker.open else None
+            ),
+        }
+
+
+class _L1State:
+    """Entries, counters and listener of one ``TieredCache`` alias."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.token = uuid.uuid4().hex
+        self.entries = OrderedDict()
+        # Bumped by every invalidation, so a value read from L2 before one
+        # is not put in L1 after it.
+        self.generation = 0
+        self.listening = False
+        self.listener = None
+        self.l1_stats = LayerStats()
+        self.l2_stats = LayerStats()
+
+
+class TieredCache(BaseCache):
+    """In-process LRU cache with a TTL in front of another cache alias.
+
+    L1 entries live at most ``L1_TIMEOUT`` seconds, also bounding how
+    stale an entry can get if an invalidation message is lost. L1 is only
+    used while the process listens to the invalidation channel, or when
+    L2 has no pub/sub (e.g. a per-process local memory cache in tests).
+    A value read from L2 is only put in L1 if no invalidation arrived
+    during the read, since it may predate that invalidation.
+
+    Options:
+        L2 (str): Alias of the cache behind L1. Defaults to ``"default"``.
+        MAX_ENTRIES (int): Entries kept in L1.
+        L1_TIMEOUT (int): Seconds an entry is kept in L1.
+        CHANNEL (str): Redis pub/sub channel for invalidations.
+    """
+
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, name, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.l2_alias = options.get("L2", "default")
+        self.l1_timeout = options.get("L1_TIMEOUT", 30)
+        self.channel = options.get("CHANNEL", INVALIDATION_CHANNEL)
+        with _states_lock:
+            # ``name`` is the LOCATION, usually empty for this backend.
+            self._state = _states.setdefault((name, self.l2_alias), _L1State())
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def _redis(self):
+        """Return the Redis client of L2, or None if L2 is not Redis."""
+        try:
+            from django_redis import get_redis_connection
+
+            return get_redis_connection(self.l2_alias)
+        except (ImportError, NotImplementedError):
+            return None
+
+    # L1
+
+    def _l1_enabled(self):
+        state = self._state
+        with state.lock:
+            if state.pid != os.getpid():
+                # Forked: neither the entries nor the listener carried over.
+                state.reset()
+            if state.listener is None:
+                self._start_listener()
+        return state.listening
+
+    def _l1_key(self, key, version):
+        return (key, self.version if version is None else version)
+
+    def _l1_get(self, l1_key):
+        state = self._state
+        with state.lock:
+            entry = state.entries.get(l1_key)
+            if entry is None:
+                return None
+            expires, pickled = entry
+            if expires <= time.monotonic():
+                del state.entries[l1_key]
+                return None
+            state.entries.move_to_end(l1_key)
+        return pickled
+
+    def _l1_generation(self):
+        with self._state.lock:
+            return self._state.generation
+
+    def _l1_set(self, l1_key, value, timeout, generation=None):
+        """Put a value in L1, unless invalidations happened since ``generation``."""
+        ttl = self.l1_timeout
+        timeout = self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+        if timeout is not None:
+            if timeout <= 0:
+                return self._l1_delete(l1_key)
+            ttl = min(ttl, timeout)
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        state = self._state
+        with state.lock:
+            if generation is not None and generation != state.generation:
+                return
+            state.entries[l1_key] = (time.monotonic() + ttl, pickled)
+            state.entries.move_to_end(l1_key)
+            while len(state.entries) > self._max_entries:
+                state.entries.popitem(last=False)
+
+    def _l1_delete(self, l1_key):
+        with self._state.lock:
+            self._state.generation += 1
+            self._state.entries.pop(l1_key, None)
+
+    def _l1_clear(self):
+        with self._state.lock:
+            self._state.generation += 1
+            self._state.entries.clear()
+
+    # Invalidation
+
+    def _start_listener(self):
+        state = self._state
+        client = self._redis()
+        if client is None:
+            # Nothing to listen to: L2 is local to this process as well.
+            state.listener = False
+            state.listening = True
+            return
+        state.listener = threading.Thread(
+            target=self._listen, args=(client,), name="tiered-cache", daemon=True
+        )
+        state.listener.start()
+
+    def _listen(self, client):
+        state = self._state
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                # Entries cached before subscribing may have missed messages.
+                self._l1_clear()
+                state.listening = True
+                last_seen = time.monotonic()
+                pinged_at = None
+                while True:
+                    # A quiet channel is normal: poll rather than block on a
+                    # read that times out with the socket timeout of L2.
+                    message = pubsub.get_message(timeout=LISTEN_POLL_INTERVAL)
+                    now = time.monotonic()
+                    if message is not None:
+                        last_seen = now
+                        pinged_at = None
+                        if message["type"] == "message":
+                            self._handle_message(message["data"])
+                    elif pinged_at is not None:
+                        if now - pinged_at >= LISTEN_PING_INTERVAL:
+                            raise RedisConnectionError("Ping not answered")
+                    elif now - last_seen >= LISTEN_PING_INTERVAL:
+                        pubsub.ping()
+                        pinged_at = now
+            except Exception as e:
+                logger.warning("Cache invalidation channel lost: %s", e)
+            finally:
+                state.listening = False
+                self._l1_clear()
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(RECONNECT_DELAY)
+
+    def _handle_message(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        token, _, payload = data.partition("|")
+        if token == self._state.token:
+            return
+        if payload == CLEAR_MESSAGE:
+            self._l1_clear()
+            return
+        version, _, key = payload.partition("|")
+        self._l1_delete(self._l1_key(key, int(version) if version else None))
+
+    def _publish(self, payload):
+        # Other processes drop the entry within L1_TIMEOUT regardless of
+        # whether the message gets through.
+        message = f"{self._state.token}|{payload}"
+        publish = getattr(self.l2, "publish", None)
+        if publish is not None:
+            # Goes through the circuit breaker of ResilientRedisCache, so an
+            # outage costs no connection timeout per write.
+            publish(self.channel, message)
+            return
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            client.publish(self.channel, message)
+        except Exception as e:
+            logger.warning("Could not publish cache invalidation: %s", e)
+
+    def _invalidate(self, key, version):
+        l1_key = self._l1_key(key, version)
+        self._l1_delete(l1_key)
+        self._publish(f"{l1_key[1]}|{key}")
+
+    # Cache API
+
+    def get(self, key, default=None, version=None):
+        l1_key = self._l1_key(key, version)
+        if self._l1_enabled():
+            pickled = self._l1_get(l1_key)
+            self._state.l1_stats.record(pickled is not None)
+            if pickled is not None:
+                return pickle.loads(pickled)
+        generation = self._l1_generation()
+        missing = object()
+        value = self.l2.get(key, missing, version=version)
+        self._state.l2_stats.record(value is not missing)
+        if value is missing:
+            return default
+        if self._state.listening:
+            self._l1_set(l1_key, value, self.l1_timeout, generation)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        remaining = []
+        enabled = self._l1_enabled()
+        for key in keys:
+            pickled = self._l1_get(self._l1_key(key, version)) if enabled else None
+            if enabled:
+                self._state.l1_stats.record(pickled is not None)
+            if pickled is not None:
+                found[key] = pickle.loads(pickled)
+            else:
+                remaining.append(key)
+        if remaining:
+            generation = self._l1_generation()
+            values = self.l2.get_many(remaining, version=version)
+            for key in remaining:
+                self._state.l2_stats.record(key in values)
+            if self._state.listening:
+                for key, value in values.items():
+                    self._l1_set(
+                        self._l1_key(key, version), value, self.l1_timeout, generation
+                    )
+            found.update(values)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        generation = self._l1_generation()
+        self.l2.set(key, value, timeout=timeout, version=version)
+        self._invalidate(key, version)
+        if self._l1_enabled():
+            # Only if the invalidation above is the only one since the write.
+            self._l1_set(self._l1_key(key, version), value, timeout, generation + 1)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout=timeout, version=version)
+        for key in data:
+            self._invalidate(key, version)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.l2.add(key, value, timeout=timeout, version=version)
+        if added:
+            self._invalidate(key, version)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.l2.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        deleted = self.l2.delete(key, version=version)
+        self._invalidate(key, version)
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        self.l2.delete_many(keys, version=version)
+        for key in keys:
+            self._invalidate(key, version)
+
+    def has_key(self, key, version=None):
+        if self._l1_enabled() and self._l1_get(self._l1_key(key, version)):
+            return True
+        return self.l2.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self.l2.incr(key, delta, version=version)
+        self._invalidate(key, version)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def clear(self):
+        self.l2.clear()
+        self._l1_clear()
+        self._publish(CLEAR_MESSAGE)
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
+
+    def stats(self):
+        """Return the hit and miss counters of both layers.
+
+        Returns:
+            dict: ``{"l1": {...}, "l2": {...}}``; L1 also reports its size
+            and whether it is coherent (listening for invalidations).
+        """
+        state = self._state
+        with state.lock:
+            entries = len(state.entries)
+        return {
+            "l1": {
+                **state.l1_stats.as_dict(),
+                "entries": entries,
+                "max_entries": self._max_entries,
+                "enabled": state.listening,
+            },
+            "l2": {**state.l2_stats.as_dict(), "alias": self.l2_alias},
+        }
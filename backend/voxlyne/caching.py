@@ -0,0 +1,366 @@
+"""Versioned caching of API list responses.
+
+Every model has a version counter in the cache, bumped by ``post_save``
+and ``post_delete`` (and ``m2m_changed``) once the write commits. A cached
+list is stored under a key made of the view, the normalized query string
+and the versions of every model its serializer reads, nested serializers
+included. Any write to one of those models changes the key, so stale
+entries are never read again and simply expire.
+
+Values are recomputed by :func:`get_or_compute`, which keeps concurrent
+requests from recomputing the same key at once (single flight), refreshes
+hot keys a little before they expire (probabilistic early expiration, the
+"XFetch" algorithm) and serves the previous value while one request
+refreshes it (stale-while-revalidate). The previous value only covers
+expiry: after a write the list has a new key, with no previous value, so
+requests wait for the one computing it instead of seeing outdated data.
+
+Cached lists are always computed from the primary database: a list read
+from a replica that is behind would be stored under the key of the new
+versions and outlive the replica's lag.
+
+Lists are cached as rendered bytes with their content type and a strong
+ETag, so a hit is sent as is, and a client sending the ETag back in
+``If-None-Match`` gets a 304 without a body.
+"""
+
+import hashlib
+import logging
+import math
+import random
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from rest_framework import serializers
+
+from voxlyne.db.routers import primary_reads
+
+logger = logging.getLogger(__name__)
+
+MODEL_VERSION_KEY = "voxlyne:cache_version:{}"
+LIST_CACHE_KEY = "voxlyne:list:{}:{}:{}"
+# Seconds a cached list is kept; writes invalidate it before that.
+LIST_CACHE_TIMEOUT = getattr(settings, "LIST_CACHE_TIMEOUT", 60 * 60)
+# Seconds an expired value may still be served while it is recomputed.
+LIST_CACHE_STALE_TIMEOUT = getattr(settings, "LIST_CACHE_STALE_TIMEOUT", 5 * 60)
+# Cache alias holding the model versions, read on every cached list request.
+VERSION_CACHE_ALIAS = getattr(settings, "LIST_CACHE_VERSION_ALIAS", "default")
+
+RECOMPUTE_LOCK_KEY = "{}:lock"
+# Longest a recomputation may hold its lock.
+RECOMPUTE_LOCK_TIMEOUT = 30
+# Longest a request waits for a value another request is computing.
+RECOMPUTE_WAIT = 2.0
+RECOMPUTE_POLL_INTERVAL = 0.05
+# XFetch aggressiveness; larger values refresh earlier.
+EARLY_REFRESH_BETA = 1.0
+
+
+def _initial_version():
+    # Larger than any version handed out before the counter was lost.
+    return int(time.time() * 1000)
+
+
+def model_versions(models):
+    """Return the current version of each model, creating missing counters.
+
+    Args:
+        models (iterable): Model classes.
+
+    Returns:
+        list: Versions, in the order of ``models``.
+    """
+    cache = caches[VERSION_CACHE_ALIAS]
+    keys = [MODEL_VERSION_KEY.format(model._meta.label_lower) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_model_version(model):
+    """Invalidate every cached list that reads ``model``."""
+    key = MODEL_VERSION_KEY.format(model._meta.label_lower)
+    try:
+        cache = caches[VERSION_CACHE_ALIAS]
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), timeout=None)
+    except Exception as e:
+        logger.warning("Could not bump the cache version of %s: %s", key, e)
+
+
+def _is_tracked(model):
+    # Only the project's own apps; Django's bookkeeping tables (sessions,
+    # migrations, tokens...) never appear in a cached list.
+    app_config = getattr(model._meta, "app_config", None)
+    return app_config is not None and str(app_config.path).startswith(
+        str(settings.BASE_DIR)
+    )
+
+
+def _bump_on_commit(model):
+    if _is_tracked(model):
+        transaction.on_commit(lambda: bump_model_version(model))
+
+
+@receiver(post_save, dispatch_uid="voxlyne_caching_saved")
+@receiver(post_delete, dispatch_uid="voxlyne_caching_deleted")
+def model_changed(sender, **kwargs):
+    """Bump the version of a model written through the ORM."""
+    _bump_on_commit(sender)
+
+
+@receiver(m2m_changed, dispatch_uid="voxlyne_caching_m2m")
+def relation_changed(sender, instance, action, model, **kwargs):
+    """Bump the versions of both sides of a changed many-to-many relation."""
+    if action.startswith("post_"):
+        _bump_on_commit(type(instance))
+        _bump_on_commit(model)
+
+
+def _should_refresh(envelope, now, beta):
+    """Tell whether a value is due for (early) recomputation.
+
+    Each request draws an exponentially distributed head start scaled by
+    how long the value took to compute, so the first refresh of a hot key
+    usually happens shortly before it expires, by a single request.
+    """
+    head_start = envelope["delta"] * beta * -math.log(1.0 - random.random())
+    return now + head_start >= envelope["expires"]
+
+
+def get_or_compute(
+    key,
+    compute,
+    timeout,
+    stale_timeout=LIST_CACHE_STALE_TIMEOUT,
+    beta=EARLY_REFRESH_BETA,
+    cache_alias="default",
+):
+    """Return the cached value of ``key``, computing it at most once at a time.
+
+    The value is stored in an envelope with its expiry time and the time
+    it took to compute. Once a request decides the value must be refreshed
+    it takes a lock with ``cache.add``; requests that don't get the lock
+    keep serving the previous value, or wait up to ``RECOMPUTE_WAIT``
+    seconds when there is none (always the case for a new key, e.g. a new
+    model version). If the cache fails the value is computed without it,
+    or returned without being stored.
+
+    Args:
+        key (str): Cache key.
+        compute (callable): Returns the value, or None for a value that
+            must not be cached.
+        timeout (int): Seconds the value is fresh.
+        stale_timeout (int): Seconds an expired value may still be served
+            while it is recomputed.
+        beta (float): Early refresh factor, 0 to disable.
+        cache_alias (str): Cache the value is kept in.
+
+    Returns:
+        The value.
+    """
+    cache = caches[cache_alias]
+    lock_key = RECOMPUTE_LOCK_KEY.format(key)
+    try:
+        envelope = cache.get(key)
+        if envelope is not None and not _should_refresh(envelope, time.time(), beta):
+            return envelope["value"]
+        locked = cache.add(lock_key, 1, timeout=RECOMPUTE_LOCK_TIMEOUT)
+    except Exception as e:
+        logger.warning("Cache unavailable for %s: %s", key, e)
+        return compute()
+
+    if not locked:
+        if envelope is not None:
+            # Another request is refreshing it; the previous value will do.
+            return envelope["value"]
+        deadline = time.monotonic() + RECOMPUTE_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(RECOMPUTE_POLL_INTERVAL)
+            try:
+                envelope = cache.get(key)
+            except Exception:
+                break
+            if envelope is not None:
+                return envelope["value"]
+        logger.debug("Gave up waiting for %s", key)
+        return compute()
+
+    try:
+        started = time.monotonic()
+        value = compute()
+        delta = time.monotonic() - started
+        if value is not None:
+            try:
+                cache.set(
+                    key,
+                    {"value": value, "expires": time.time() + timeout, "delta": delta},
+                    timeout=timeout + stale_timeout,
+                )
+            except Exception as e:
+                logger.warning("Could not cache %s: %s", key, e)
+        return value
+    finally:
+        try:
+            cache.delete(lock_key)
+        except Exception as e:
+            logger.warning("Could not release %s: %s", lock_key, e)
+
+
+def serializer_models(serializer_class):
+    """Return the models a serializer reads, following nested serializers.
+
+    Args:
+        serializer_class: A ``ModelSerializer`` subclass.
+
+    Returns:
+        list: Model classes, without duplicates.
+    """
+    models = []
+    pending = [serializer_class()]
+    while pending:
+        serializer = pending.pop()
+        if isinstance(serializer, serializers.ListSerializer):
+            serializer = serializer.child
+        meta = getattr(serializer, "Meta", None)
+        model = getattr(meta, "model", None)
+        if model is None or model in models:
+            continue
+        models.append(model)
+        pending.extend(
+            field
+            for field in serializer.fields.values()
+            if isinstance(field, serializers.BaseSerializer)
+        )
+    return models
+
+
+def render_entry(view, request, response):
+    """Render a list response into a cache entry.
+
+    Returns:
+        dict: ``body`` (text), ``content_type`` and ``etag``, or None if
+        the response can't be cached.
+    """
+    response.accepted_renderer = request.accepted_renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = view.get_renderer_context()
+    try:
+        body = response.rendered_content.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    return {
+        "body": body,
+        "content_type": response["Content-Type"],
+        "etag": '"{}"'.format(hashlib.sha256(body.encode()).hexdigest()[:32]),
+    }
+
+
+def entry_response(request, entry):
+    """Return a cache entry as a response, or a 304 if the client has it."""
+    response = HttpResponse(entry["body"], content_type=entry["content_type"])
+    response["ETag"] = entry["etag"]
+    return get_conditional_response(
+        request._request, etag=entry["etag"], response=response
+    )
+
+
+def normalized_query(request):
+    """Return the query string of a request with parameters in a fixed order."""
+    items = sorted(
+        (key, value)
+        for key in request.query_params
+        for value in request.query_params.getlist(key)
+    )
+    return urlencode(items)
+
+
+class CachedListMixin:
+    """View mixin caching the rendered body of ``list`` responses.
+
+    The cache key is built from the view, the request host, the negotiated
+    media type and normalized query (so every page and filter is cached
+    on its own) and the versions of ``cache_models``. These default to the
+    models read by the view's serializer, nested serializers included.
+    Lists are recomputed through :func:`get_or_compute`, so only one
+    request at a time rebuilds a list. The browsable API is never cached,
+    as its pages embed the user and a CSRF token.
+
+    Attributes:
+        cache_models (tuple): Models whose writes invalidate the list.
+        cache_timeout (int): Seconds a list is fresh.
+        cache_stale_timeout (int): Seconds an expired list may still be
+            served while it is rebuilt.
+        cache_alias (str): Cache the lists are kept in; small, hot lists
+            can use the in-process ``"tiered"`` cache.
+    """
+
+    cache_alias = "default"
+    cache_models = None
+    cache_timeout = LIST_CACHE_TIMEOUT
+    cache_stale_timeout = LIST_CACHE_STALE_TIMEOUT
+
+    def get_cache_models(self):
+        if self.cache_models is None:
+            type(self).cache_models = tuple(
+                serializer_models(self.get_serializer_class())
+            )
+        return self.cache_models
+
+    def get_list_cache_key(self, request):
+        view = f"{type(self).__module__}.{type(self).__qualname__}"
+        versions = model_versions(self.get_cache_models())
+        query = "{} {}?{}".format(
+            request.accepted_media_type,
+            request.get_host(),
+            normalized_query(request),
+        )
+        return LIST_CACHE_KEY.format(
+            view,
+            ".".join(str(version) for version in versions),
+            hashlib.sha256(query.encode()).hexdigest(),
+        )
+
+    def list(self, request, *args, **kwargs):
+        """Handle GET list requests, checking the cache first."""
+        if getattr(request.accepted_renderer, "format", None) == "api":
+            return super().list(request, *args, **kwargs)
+        try:
+            cache_key = self.get_list_cache_key(request)
+        except Exception as e:
+            logger.warning("List cache unavailable: %s", e)
+            return super().list(request, *args, **kwargs)
+
+        computed = {}
+
+        def compute():
+            logger.debug("Computing %s", cache_key)
+            with primary_reads():
+                response = super(CachedListMixin, self).list(request, *args, **kwargs)
+            computed["response"] = response
+            if response.status_code != 200:
+                return None
+            return render_entry(self, request, response)
+
+        entry = get_or_compute(
+            cache_key,
+            compute,
+            self.cache_timeout,
+            self.cache_stale_timeout,
+            cache_alias=self.cache_alias,
+        )
+        if entry is None:
+            return computed["response"]
+        return entry_response(request, entry)
@@ -0,0 +1,73 @@
+"""Database helpers shared by the project's engines and middleware.
+
+Transactions opened by the ORM start in the mode of the current context
+when one is set: ``DEFERRED`` for requests that only read, so they don't
+wait for each other, and ``IMMEDIATE`` for requests that write, so they
+take the write lock up front instead of failing when upgrading to it.
+"""
+
+import contextvars
+import threading
+from contextlib import contextmanager
+
+DEFERRED = "DEFERRED"
+IMMEDIATE = "IMMEDIATE"
+
+_transaction_mode = contextvars.ContextVar("transaction_mode", default=None)
+
+
+def current_transaction_mode():
+    """Return the transaction mode set for the current context, or None."""
+    return _transaction_mode.get()
+
+
+@contextmanager
+def transaction_mode(mode):
+    """Start the transactions opened inside the block in ``mode``.
+
+    Args:
+        mode (str): ``DEFERRED`` or ``IMMEDIATE``; None restores the mode
+            configured for the database.
+    """
+    token = _transaction_mode.set(mode)
+    try:
+        yield
+    finally:
+        _transaction_mode.reset(token)
+
+
+class ConnectionStats:
+    """Counters of the physical connections of one database alias.
+
+    Attributes:
+        opened (int): Connections opened.
+        reused (int): Requests served by a connection kept from an earlier
+            one (``CONN_MAX_AGE``) that passed its health check.
+        health_check_failures (int): Kept connections found broken and
+            replaced.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.health_check_failures = 0
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        return {
+            "opened": self.opened,
+            "reused": self.reused,
+            "health_check_failures": self.health_check_failures,
+        }
+
+
+_connection_stats = {}
+
+
+def connection_stats(alias):
+    """Return the ``ConnectionStats`` of a database alias in this process."""
+    return _connection_stats.setdefault(alias, ConnectionStats())
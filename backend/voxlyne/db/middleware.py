@@ -0,0 +1,210 @@
+"""Middleware choosing the database, transaction mode and retries of requests."""
+
+import hashlib
+import logging
+from io import BytesIO
+
+import jwt
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from voxlyne.db import DEFERRED, IMMEDIATE, transaction_mode
+from voxlyne.db.retry import RetryBudget, is_lock_error, record
+from voxlyne.db.routers import (
+    REPLICA_PIN_SECONDS,
+    REPLICAS,
+    disallow_replica_reads,
+    replica_reads,
+)
+
+logger = logging.getLogger(__name__)
+
+REPLICA_PIN_KEY = "voxlyne:db_pin:{}"
+
+READ_ONLY_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# Response fields holding the JWTs a client authenticates with afterwards.
+TOKEN_FIELDS = ("access", "refresh", "token")
+
+
+class TransactionModeMiddleware:
+    """Run read-only requests in deferred transactions.
+
+    With ``ATOMIC_REQUESTS`` every request runs in a transaction. Requests
+    with a safe method open it ``DEFERRED``, taking no lock until they
+    write; the rest open it ``IMMEDIATE`` and wait for the write lock
+    before running the view. Needs the ``voxlyne.db.sqlite3`` engine.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = DEFERRED if request.method in READ_ONLY_METHODS else IMMEDIATE
+        with transaction_mode(mode):
+            return self.get_response(request)
+
+
+class DatabaseRetryMiddleware:
+    """Run requests again when they fail because the database is locked.
+
+    Only requests that are safe to repeat are retried: those with a
+    read-only method and those whose view is marked with
+    ``retry_on_db_lock``. The attempt runs in its own ``ATOMIC_REQUESTS``
+    transaction, which is rolled back before the retry. Lock errors of
+    other requests, or once the retries are exhausted, get a 503 with
+    ``Retry-After`` instead of a 500.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        attempts = None
+        while True:
+            request._db_lock_error = None
+            response = self.get_response(request)
+            if request._db_lock_error is None:
+                if attempts is not None:
+                    attempts.succeeded()
+                return response
+            endpoint = self._endpoint(request)
+            if not getattr(request, "_db_retry_safe", False):
+                record(endpoint, lock_errors=1, not_retryable=1)
+                return response
+            if attempts is None:
+                attempts = RetryBudget(endpoint, **request._db_retry_options)
+            if not attempts.failed():
+                return response
+            if hasattr(request, "_body"):
+                # Let the view read the body again.
+                request._stream = BytesIO(request._body)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._db_retry_safe = request.method in READ_ONLY_METHODS or getattr(
+            view_func, "db_retry_safe", False
+        )
+        request._db_retry_options = getattr(view_func, "db_retry_options", {})
+
+    def process_exception(self, request, exception):
+        if not is_lock_error(exception):
+            return None
+        request._db_lock_error = exception
+        response = HttpResponse(
+            "Database busy, please retry.", status=503, content_type="text/plain"
+        )
+        response["Retry-After"] = "1"
+        return response
+
+    def _endpoint(self, request):
+        match = request.resolver_match
+        if match is None:
+            return request.path_info
+        return match.view_name or match.route
+
+
+class ReplicaRoutingMiddleware:
+    """Serve read-only requests from the read replicas.
+
+    A client that sends a write is pinned to the primary for
+    ``REPLICA_PIN_SECONDS``, so it reads its own writes. A client is known
+    by several identities: its ``Authorization`` header, the user of its
+    token, its session cookie and its address. A write pins all of them,
+    including those only known from the response, such as the tokens
+    returned by a login or the user a session belongs to, and a read is
+    served by the primary if any of them is pinned. Pins are kept in the
+    cache so every worker sees them; while the cache falls back to local
+    memory every read goes to the primary. Views marked with
+    ``use_primary`` always read the primary.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not REPLICAS:
+            return self.get_response(request)
+        read_only = request.method in READ_ONLY_METHODS
+        identities = self._request_identities(request)
+        with replica_reads(read_only and not self._pinned(identities)) as state:
+            response = self.get_response(request)
+        if state.wrote or not read_only:
+            self._pin(identities | self._response_identities(request, response))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, "use_primary", False):
+            disallow_replica_reads()
+
+    def _request_identities(self, request):
+        identities = set()
+        authorization = request.headers.get("Authorization")
+        if authorization:
+            identities.add(f"auth:{authorization}")
+            _, _, token = authorization.partition(" ")
+            user_id = _token_user_id(token)
+            if user_id is not None:
+                identities.add(f"user:{user_id}")
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if session_key:
+            identities.add(f"session:{session_key}")
+        address = request.META.get("REMOTE_ADDR")
+        if address:
+            identities.add(f"address:{address}")
+        return identities
+
+    def _response_identities(self, request, response):
+        """Return the identities the client will use after this response."""
+        identities = set()
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            identities.add(f"user:{user.pk}")
+        data = getattr(response, "data", None)
+        if isinstance(data, dict):
+            # Tokens handed out by a login, a registration or a refresh.
+            for field in TOKEN_FIELDS:
+                user_id = _token_user_id(data.get(field))
+                if user_id is not None:
+                    identities.add(f"user:{user_id}")
+        session = response.cookies.get(settings.SESSION_COOKIE_NAME)
+        if session is not None and session.value:
+            identities.add(f"session:{session.value}")
+        return identities
+
+    def _key(self, identity):
+        return REPLICA_PIN_KEY.format(hashlib.sha256(identity.encode()).hexdigest())
+
+    def _pinned(self, identities):
+        if not getattr(cache, "available", True):
+            # Pins written by other workers are out of reach.
+            return True
+        try:
+            return bool(cache.get_many([self._key(i) for i in identities]))
+        except Exception as e:
+            logger.warning("Replica pins unavailable, reading the primary: %s", e)
+            return True
+
+    def _pin(self, identities):
+        try:
+            cache.set_many(
+                {self._key(i): 1 for i in identities}, timeout=REPLICA_PIN_SECONDS
+            )
+        except Exception as e:
+            logger.warning("Could not pin a client to the primary: %s", e)
+
+
+def _token_user_id(token):
+    """Return the user ID claimed by a JWT, or None.
+
+    The signature is not checked: the ID only decides which database a
+    request reads, and a forged one at worst sends it to the primary.
+    """
+    if not isinstance(token, str) or token.count(".") != 2:
+        return None
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return None
+    return claims.get(jwt_settings.USER_ID_CLAIM)
@@ -0,0 +1,207 @@
+"""Retries of work that failed because SQLite was locked.
+
+Only work that can safely run twice is retried: requests with a safe
+method, and functions or views marked with :func:`retry_on_db_lock`.
+Attempts are spaced with "full jitter" exponential backoff (a random
+delay up to a cap doubling on each attempt), so competing writers spread
+out instead of waking up together, and stop once the time budget of the
+unit of work is spent. Outcomes are counted per endpoint.
+"""
+
+import logging
+import random
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Retries after the first attempt.
+DB_LOCK_RETRIES = getattr(settings, "DB_LOCK_RETRIES", 3)
+# Cap of the first backoff delay, in seconds; doubles on each retry.
+DB_LOCK_RETRY_DELAY = getattr(settings, "DB_LOCK_RETRY_DELAY", 0.05)
+DB_LOCK_RETRY_MAX_DELAY = getattr(settings, "DB_LOCK_RETRY_MAX_DELAY", 1.0)
+# Seconds after which a unit of work is not retried any more.
+DB_LOCK_RETRY_BUDGET = getattr(settings, "DB_LOCK_RETRY_BUDGET", 3.0)
+
+LOCK_ERROR_MESSAGES = ("database is locked", "database table is locked")
+
+
+def is_lock_error(error):
+    """Tell whether an exception means the database was locked."""
+    return isinstance(error, OperationalError) and any(
+        message in str(error).lower() for message in LOCK_ERROR_MESSAGES
+    )
+
+
+def backoff_delay(
+    retry, base_delay=DB_LOCK_RETRY_DELAY, max_delay=DB_LOCK_RETRY_MAX_DELAY
+):
+    """Return a random delay before retry number ``retry`` (from 1)."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (retry - 1)))
+
+
+class RetryStats:
+    """Lock errors and retries of one endpoint.
+
+    Attributes:
+        lock_errors (int): Attempts that failed with a lock error.
+        retries (int): Attempts run again after one.
+        recovered (int): Units of work that succeeded after a retry.
+        exhausted (int): Units of work given up once out of retries or
+            time budget.
+        not_retryable (int): Lock errors in work not marked as safe to
+            run again.
+        waited (float): Seconds spent in backoff.
+    """
+
+    FIELDS = (
+        "lock_errors",
+        "retries",
+        "recovered",
+        "exhausted",
+        "not_retryable",
+        "waited",
+    )
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record(endpoint, **counts):
+    """Add ``counts`` to the retry counters of ``endpoint``."""
+    with _stats_lock:
+        stats = _stats.setdefault(endpoint, RetryStats())
+        for field, count in counts.items():
+            setattr(stats, field, getattr(stats, field) + count)
+
+
+def retry_stats():
+    """Return the retry counters of every endpoint in this process."""
+    with _stats_lock:
+        return {endpoint: stats.as_dict() for endpoint, stats in _stats.items()}
+
+
+class RetryBudget:
+    """Retry bookkeeping of one unit of work.
+
+    Args:
+        endpoint (str): Name the outcome is counted under.
+        max_retries (int): Retries after the first attempt.
+        base_delay (float): Cap of the first backoff delay.
+        max_delay (float): Cap of any backoff delay.
+        budget (float): Seconds, from now, after which no retry starts.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        max_retries=DB_LOCK_RETRIES,
+        base_delay=DB_LOCK_RETRY_DELAY,
+        max_delay=DB_LOCK_RETRY_MAX_DELAY,
+        budget=DB_LOCK_RETRY_BUDGET,
+    ):
+        self.endpoint = endpoint
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = time.monotonic() + budget
+        self.retries = 0
+
+    def failed(self):
+        """Count a lock error and wait before the next attempt.
+
+        Returns:
+            bool: True if the work should run again, False if it must be
+            given up.
+        """
+        record(self.endpoint, lock_errors=1)
+        delay = backoff_delay(self.retries + 1, self.base_delay, self.max_delay)
+        if (
+            self.retries >= self.max_retries
+            or time.monotonic() + delay > self.deadline
+        ):
+            record(self.endpoint, exhausted=1)
+            logger.error(
+                "Database locked, giving up %s after %d retries",
+                self.endpoint,
+                self.retries,
+            )
+            return False
+        self.retries += 1
+        logger.warning(
+            "Database locked, retrying %s (%d/%d) in %.3fs",
+            self.endpoint,
+            self.retries,
+            self.max_retries,
+            delay,
+        )
+        time.sleep(delay)
+        record(self.endpoint, retries=1, waited=delay)
+        return True
+
+    def succeeded(self):
+        if self.retries:
+            record(self.endpoint, recovered=1)
+
+
+def retry_on_db_lock(
+    max_retries=DB_LOCK_RETRIES,
+    delay=DB_LOCK_RETRY_DELAY,
+    budget=DB_LOCK_RETRY_BUDGET,
+):
+    """Mark a function as safe to run again when the database is locked.
+
+    Use it for work that only writes to the database, so that running it
+    twice has no other effect (no mail sent, no file written). Outside a
+    transaction the function runs in ``atomic()`` and is retried here.
+    Inside one (e.g. with ``ATOMIC_REQUESTS``) retrying it alone can't
+    help, since the enclosing transaction has failed too; the error is
+    raised and, for a view, ``DatabaseRetryMiddleware`` runs the whole
+    request again.
+
+    Args:
+        max_retries (int): Retries after the first attempt.
+        delay (float): Cap of the first backoff delay, in seconds.
+        budget (float): Seconds after which no retry starts.
+    """
+
+    def decorator(func):
+        endpoint = f"{func.__module__}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if connection.in_atomic_block:
+                return func(*args, **kwargs)
+            attempts = RetryBudget(endpoint, max_retries, delay, budget=budget)
+            while True:
+                try:
+                    with transaction.atomic():
+                        result = func(*args, **kwargs)
+                except OperationalError as e:
+                    if not is_lock_error(e) or not attempts.failed():
+                        raise
+                else:
+                    attempts.succeeded()
+                    return result
+
+        wrapper.db_retry_safe = True
+        wrapper.db_retry_options = {
+            "max_retries": max_retries,
+            "base_delay": delay,
+            "budget": budget,
+        }
+        return wrapper
+
+    return decorator
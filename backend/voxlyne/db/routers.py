@@ -0,0 +1,214 @@
+"""Routing of reads to replicas, with read-your-writes stickiness.
+
+Reads go to a replica only inside a context that allows it, which
+``ReplicaRoutingMiddleware`` opens for read-only requests. Everything
+else (writes, requests that write, management commands, background jobs)
+uses the primary, so code that reads and then writes never acts on a
+stale replica.
+
+A client that wrote is pinned to the primary for ``REPLICA_PIN_SECONDS``,
+never less than ``REPLICA_MAX_LAG``, so its next reads see its own writes
+despite replication lag. Replicas
+are health checked every ``REPLICA_HEALTH_INTERVAL`` seconds and left out
+of rotation while they fail, or while the last ``sync_replica`` of a
+SQLite replica is older than ``REPLICA_MAX_LAG`` seconds.
+"""
+
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+# Aliases of the read replicas in settings.DATABASES.
+REPLICAS = getattr(settings, "DATABASE_REPLICAS", [])
+REPLICA_HEALTH_INTERVAL = getattr(settings, "REPLICA_HEALTH_INTERVAL", 5)
+# Seconds since the last sync after which a SQLite replica is too stale.
+REPLICA_MAX_LAG = getattr(settings, "REPLICA_MAX_LAG", 60)
+# A shorter pin would send a writer back to a replica that may not have
+# its write yet.
+REPLICA_PIN_SECONDS = max(
+    getattr(settings, "REPLICA_PIN_SECONDS", REPLICA_MAX_LAG), REPLICA_MAX_LAG
+)
+
+
+class _ReadState:
+    """Where the reads of the current context go."""
+
+    def __init__(self, replicas_allowed):
+        self.replicas_allowed = replicas_allowed
+        self.wrote = False
+
+
+_read_state = contextvars.ContextVar("read_state", default=None)
+
+
+@contextmanager
+def replica_reads(allowed=True):
+    """Let reads inside the block go to a replica.
+
+    The first write inside the block sends the reads that follow it to
+    the primary.
+
+    Yields:
+        _ReadState: ``wrote`` tells, after the block, whether it wrote.
+    """
+    state = _ReadState(allowed)
+    token = _read_state.set(state)
+    try:
+        yield state
+    finally:
+        _read_state.reset(token)
+
+
+def use_primary(view_func):
+    """Mark a view whose reads must always go to the primary.
+
+    For views with a read-only method that write, since they would
+    otherwise save rows read from a replica.
+    """
+    view_func.use_primary = True
+    return view_func
+
+
+def sync_marker_path(database_name):
+    """Return the file whose mtime tells when a SQLite replica was synced.
+
+    The replica file itself can't tell: in WAL mode, a copy made while
+    readers are connected only writes the ``-wal`` file.
+    """
+    return f"{database_name}-synced"
+
+
+def replica_lag(connection):
+    """Return the seconds since a SQLite replica was last synced."""
+    name = connection.settings_dict["NAME"]
+    try:
+        synced_at = os.path.getmtime(sync_marker_path(name))
+    except FileNotFoundError:
+        # Never synced by sync_replica: go by the files themselves.
+        synced_at = max(
+            os.path.getmtime(path)
+            for path in (name, f"{name}-wal")
+            if os.path.exists(path)
+        )
+    return time.time() - synced_at
+
+
+@contextmanager
+def primary_reads():
+    """Send the reads inside the block to the primary.
+
+    For results that outlive the request, such as cached lists, which
+    must not be filled from a replica that is behind.
+    """
+    state = _read_state.get()
+    if state is None:
+        yield
+        return
+    allowed = state.replicas_allowed
+    state.replicas_allowed = False
+    try:
+        yield
+    finally:
+        state.replicas_allowed = allowed
+
+
+def disallow_replica_reads():
+    """Send the remaining reads of the current context to the primary."""
+    state = _read_state.get()
+    if state is not None:
+        state.replicas_allowed = False
+
+
+class ReplicaHealth:
+    """Health of the replicas, checked at most every ``interval`` seconds."""
+
+    def __init__(self, interval=REPLICA_HEALTH_INTERVAL, max_lag=REPLICA_MAX_LAG):
+        self.interval = interval
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def healthy(self, replicas):
+        """Return the replicas currently fit to serve reads."""
+        now = time.monotonic()
+        result = []
+        for alias in replicas:
+            with self._lock:
+                checked_at, ok = self._checked.get(alias, (None, False))
+                due = checked_at is None or now - checked_at >= self.interval
+                if due:
+                    # Others keep the last verdict while this one checks.
+                    self._checked[alias] = (now, ok)
+            if due:
+                ok = self.check(alias)
+                with self._lock:
+                    self._checked[alias] = (time.monotonic(), ok)
+            if ok:
+                result.append(alias)
+        return result
+
+    def check(self, alias):
+        """Tell whether a replica answers and is recent enough."""
+        connection = connections[alias]
+        try:
+            if connection.vendor == "sqlite":
+                lag = replica_lag(connection)
+                if lag > self.max_lag:
+                    logger.warning("Replica %s is %.0fs behind", alias, lag)
+                    return False
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except Exception as e:
+            logger.warning("Replica %s failed its health check: %s", alias, e)
+            connection.close()
+            return False
+        return True
+
+    def status(self):
+        with self._lock:
+            return {alias: ok for alias, (_, ok) in self._checked.items()}
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    """Send reads to a healthy replica when the context allows it.
+
+    Only models of the primary are routed: every alias in
+    ``DATABASE_REPLICAS`` holds a copy of ``default``. Migrations only run
+    on ``default``; replicas are copies of it.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _read_state.get()
+        if state is None or not state.replicas_allowed or state.wrote:
+            return DEFAULT_DB_ALIAS
+        replicas = replica_health.healthy(REPLICAS)
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _read_state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in REPLICAS
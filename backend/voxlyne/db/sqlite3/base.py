@@ -0,0 +1,73 @@
+"""SQLite engine with configurable pragmas and per-context transaction modes.
+
+Use it as ``ENGINE = "voxlyne.db.sqlite3"``. Besides the options of
+Django's SQLite backend it reads ``OPTIONS["pragmas"]``, a dict of pragmas
+run on every new connection, e.g. ``{"journal_mode": "WAL"}``. In WAL mode
+readers don't block the writer nor each other.
+
+Pragmas, like the SQL functions Django registers, are set up once per
+physical connection, so they are not repeated on requests reusing a
+connection kept by ``CONN_MAX_AGE``. With ``CONN_HEALTH_CHECKS`` a kept
+connection runs ``SELECT 1`` before its first query of each request and
+is replaced if that fails. ``connection_stats()`` counts both.
+
+Transactions start in the mode set with :func:`voxlyne.db.transaction_mode`
+(see ``TransactionModeMiddleware``), falling back to the configured
+``transaction_mode``. A ``DEFERRED`` transaction that later writes must
+upgrade its lock; if another connection wrote in the meantime SQLite fails
+at once with "database is locked", without waiting for ``timeout``.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+from voxlyne.db import connection_stats, current_transaction_mode
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        pragmas = kwargs.pop("pragmas", {})
+        for name in pragmas:
+            if not name.isidentifier():
+                raise ImproperlyConfigured(
+                    f"settings.DATABASES[{self.alias!r}]['OPTIONS']['pragmas'] "
+                    f"has an invalid pragma name {name!r}."
+                )
+        self.pragmas = pragmas
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        connection_stats(self.alias).increment("opened")
+        return conn
+
+    def is_usable(self):
+        try:
+            self.connection.execute("SELECT 1")
+        except self.Database.Error:
+            return False
+        return True
+
+    def close_if_health_check_failed(self):
+        checking = (
+            self.connection is not None
+            and self.health_check_enabled
+            and not self.health_check_done
+        )
+        super().close_if_health_check_failed()
+        if checking:
+            stats = connection_stats(self.alias)
+            if self.connection is None:
+                stats.increment("health_check_failures")
+            else:
+                stats.increment("reused")
+
+    def _start_transaction_under_autocommit(self):
+        mode = current_transaction_mode() or self.transaction_mode
+        if mode is None:
+            self.cursor().execute("BEGIN")
+        else:
+            self.cursor().execute(f"BEGIN {mode}")
@@ -0,0 +1,98 @@
+"""Test helpers checking how SQLite plans the project's hot queries."""
+
+from django.db import connections
+
+# Plan steps that mean the query doesn't use an index as intended.
+FULL_SCAN = "SCAN"
+TEMP_SORT = "USE TEMP B-TREE"
+
+
+def query_plan(queryset):
+    """Return the steps of the SQLite query plan of a queryset.
+
+    Returns:
+        list: The ``detail`` column of ``EXPLAIN QUERY PLAN``, e.g.
+        ``"SEARCH documents_document USING INDEX ... (company_id=?)"``.
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def filtered_tables(queryset):
+    """Return the tables, and their aliases, a queryset has conditions on."""
+    query = queryset.query
+    tables = set()
+    nodes = [query.where]
+    while nodes:
+        node = nodes.pop()
+        for child in getattr(node, "children", ()):
+            alias = getattr(getattr(child, "lhs", None), "alias", None)
+            if alias is None:
+                nodes.append(child)
+            elif alias in query.alias_map:
+                tables.update((alias, query.alias_map[alias].table_name))
+    return tables
+
+
+def _scanned_table(step):
+    # "SCAN t ..." in recent SQLite versions, "SCAN TABLE t ..." before.
+    words = step.split()
+    if words[1] == "TABLE":
+        del words[1]
+    return words[1]
+
+
+def plan_problems(plan, filtered=()):
+    """Return the steps of a plan that scan or sort instead of searching.
+
+    A scan along an index is fine for a table the query reads in full,
+    e.g. to avoid a sort, but not for a table in ``filtered``: there the
+    index must be searched for the condition.
+
+    Args:
+        plan (list): Steps from :func:`query_plan`.
+        filtered (iterable): Tables (or aliases) the query has conditions on.
+    """
+    filtered = set(filtered)
+    return [
+        step
+        for step in plan
+        if TEMP_SORT in step
+        or (
+            step.startswith(FULL_SCAN)
+            and (
+                " INDEX " not in f"{step} " or _scanned_table(step) in filtered
+            )
+        )
+    ]
+
+
+class QueryPlanMixin:
+    """``TestCase`` mixin asserting that queries are served by an index."""
+
+    def assertIndexed(self, queryset, index=None):
+        """Fail if a queryset scans a table or sorts in a temporary B-tree.
+
+        Tables the query has conditions on must be searched; a scan of
+        their whole index fails too.
+
+        Args:
+            queryset: The query to check.
+            index (str): Name of an index the plan must use, if given.
+        """
+        plan = query_plan(queryset)
+        problems = plan_problems(plan, filtered_tables(queryset))
+        self.assertFalse(
+            problems,
+            "Query is not served by an index:\n  {}\nPlan:\n  {}".format(
+                queryset.query, "\n  ".join(plan)
+            ),
+        )
+        if index is not None:
+            self.assertTrue(
+                any(index in step for step in plan),
+                "Query doesn't use index {}:\n  {}".format(index, "\n  ".join(plan)),
+            )
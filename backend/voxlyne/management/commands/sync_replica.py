@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from voxlyne.db.routers import sync_marker_path
+
+
+class Command(BaseCommand):
+    """Copy the primary SQLite database into its read replicas.
+
+    Uses SQLite's online backup API, so the primary stays writable during
+    the copy and readers of a replica see either the previous copy or the
+    new one. Each copy touches the replica's ``-synced`` marker file, and a
+    replica whose marker is older than ``REPLICA_MAX_LAG`` seconds is taken
+    out of rotation, so run this with ``--every`` (or from a scheduler)
+    more often than that.
+    """
+
+    help = "Copy the primary SQLite database into the read replicas."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            action="append",
+            dest="replicas",
+            help="Replica alias to refresh; defaults to all DATABASE_REPLICAS.",
+        )
+        parser.add_argument(
+            "--every",
+            type=float,
+            default=None,
+            help="Keep running, copying every given number of seconds.",
+        )
+        parser.add_argument(
+            "--pages",
+            type=int,
+            default=-1,
+            help="Pages copied per step; -1 copies everything in one step.",
+        )
+
+    def handle(self, *args, **options):
+        replicas = options["replicas"] or getattr(settings, "DATABASE_REPLICAS", [])
+        if not replicas:
+            raise CommandError("No replica configured (DATABASE_REPLICAS).")
+        for alias in [DEFAULT_DB_ALIAS, *replicas]:
+            if alias not in connections.settings:
+                raise CommandError(f"Unknown database {alias!r}.")
+            if connections[alias].vendor != "sqlite":
+                raise CommandError(f"Database {alias!r} is not SQLite.")
+
+        while True:
+            for alias in replicas:
+                started = time.monotonic()
+                self.sync(alias, options["pages"])
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"Replica {alias} synced in "
+                        f"{time.monotonic() - started:.2f}s."
+                    )
+                )
+            if options["every"] is None:
+                return
+            time.sleep(options["every"])
+
+    def sync(self, alias, pages):
+        primary = connections[DEFAULT_DB_ALIAS].settings_dict
+        replica = connections[alias].settings_dict
+        timeout = primary["OPTIONS"].get("timeout", 5)
+        started = time.time()
+        source = sqlite3.connect(primary["NAME"], timeout=timeout)
+        target = sqlite3.connect(replica["NAME"], timeout=timeout)
+        try:
+            source.backup(target, pages=pages, sleep=0.01)
+        finally:
+            target.close()
+            source.close()
+        # The copy holds the primary as of the start of the backup.
+        marker = sync_marker_path(replica["NAME"])
+        with open(marker, "a"):
+            pass
+        os.utime(marker, (started, started))
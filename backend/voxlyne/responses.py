@@ -0,0 +1,251 @@
+"""Streaming file responses with HTTP byte-range support.
+
+A response body is described as a list of segments, each either ``bytes``
+or a ``(file, offset, length)`` tuple over a seekable binary file. Bodies
+made of several parts, such as an original PDF followed by an appended
+revision, can so be served without ever being joined, and any byte range
+of them can be sent on request (RFC 9110, sections 13.1.5 and 14).
+"""
+
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.static import was_modified_since
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when a requested byte range lies outside the body."""
+
+
+def parse_range_header(header, size):
+    """Parse a ``Range`` header holding a single byte range.
+
+    Headers that are malformed or ask for several ranges are ignored, as
+    the specification allows, and the whole body is sent instead.
+
+    Args:
+        header (str): Value of the ``Range`` header, or None.
+        size (int): Length of the body.
+
+    Returns:
+        tuple: Inclusive ``(start, end)`` offsets, or None to send everything.
+
+    Raises:
+        RangeNotSatisfiable: If the range starts past the end of the body.
+    """
+    match = _RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1)
+
+
+def if_range_matches(request, etag, last_modified):
+    """Tell whether the ``If-Range`` precondition of a request holds.
+
+    Only strong validators match: an entity tag compared byte for byte, or
+    a date equal to the ``Last-Modified`` time of the body.
+
+    Args:
+        request: The HTTP request.
+        etag (str): Strong entity tag of the body, quoted, or None.
+        last_modified (int): Modification time as a timestamp, or None.
+
+    Returns:
+        bool: True when there is no ``If-Range`` header or it matches.
+    """
+    value = request.headers.get("If-Range")
+    if not value:
+        return True
+    if value.startswith(('"', "W/")):
+        return etag is not None and value == etag and not value.startswith("W/")
+    date = parse_http_date_safe(value)
+    return (
+        date is not None
+        and last_modified is not None
+        and date == int(last_modified)
+    )
+
+
+def _segment_length(segment):
+    return len(segment) if isinstance(segment, bytes) else segment[2]
+
+
+def close_segments(segments):
+    """Close the files referenced by a list of segments."""
+    for segment in segments:
+        if not isinstance(segment, bytes):
+            segment[0].close()
+
+
+class SegmentStream:
+    """Iterator over a byte range of a list of segments.
+
+    Files are read in chunks of ``STREAM_CHUNK_SIZE`` and closed by
+    :meth:`close`, which Django calls once the response is finished.
+    """
+
+    def __init__(self, segments, start, end):
+        self.segments = segments
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        position = 0
+        remaining = self.end - self.start + 1
+        for segment in self.segments:
+            length = _segment_length(segment)
+            if remaining <= 0:
+                break
+            if position + length <= self.start:
+                position += length
+                continue
+            skip = max(0, self.start - position)
+            count = min(length - skip, remaining)
+            remaining -= count
+            position += length
+            if isinstance(segment, bytes):
+                yield segment[skip : skip + count]
+                continue
+            file, offset, _ = segment
+            file.seek(offset + skip)
+            while count > 0:
+                chunk = file.read(min(STREAM_CHUNK_SIZE, count))
+                if not chunk:
+                    raise OSError("File ended before the expected length.")
+                count -= len(chunk)
+                yield chunk
+
+    def close(self):
+        close_segments(self.segments)
+
+
+def segmented_response(
+    request,
+    segments,
+    content_type="application/pdf",
+    filename=None,
+    as_attachment=True,
+    etag=None,
+    last_modified=None,
+):
+    """Stream a body made of segments, honouring ``Range`` and ``If-Range``.
+
+    Ranges are only served for GET and HEAD requests; anything else gets
+    the whole body.
+
+    Args:
+        request: The HTTP request, or None when ranges don't apply.
+        segments (list): Body segments, see the module documentation.
+        content_type (str): Media type of the body.
+        filename (str, optional): File name for ``Content-Disposition``.
+        as_attachment (bool): Whether the file is offered as a download.
+        etag (str, optional): Strong entity tag of the body, quoted.
+        last_modified (int, optional): Modification time as a timestamp.
+
+    Returns:
+        HttpResponseBase: A 200, 206 or 416 response.
+    """
+    size = sum(_segment_length(segment) for segment in segments)
+    byte_range = None
+    if (
+        request is not None
+        and request.method in ("GET", "HEAD")
+        and if_range_matches(request, etag, last_modified)
+    ):
+        try:
+            byte_range = parse_range_header(request.headers.get("Range"), size)
+        except RangeNotSatisfiable:
+            close_segments(segments)
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            response["Accept-Ranges"] = "bytes"
+            return response
+
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(
+        SegmentStream(segments, start, end),
+        status=206 if byte_range else 200,
+        content_type=content_type,
+    )
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if etag:
+        response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    if filename:
+        disposition = "attachment" if as_attachment else "inline"
+        response["Content-Disposition"] = f'{disposition}; filename="{filename}"'
+    return response
+
+
+def serve_ranged(request, path, document_root=None):
+    """Serve a file below ``document_root`` with byte-range support.
+
+    Drop-in replacement for ``django.views.static.serve`` (to be passed as
+    ``view`` to ``static()``) for media files opened by PDF viewers, which
+    fetch large documents in ranges.
+
+    Args:
+        request: The HTTP request.
+        path (str): Path of the file relative to ``document_root``.
+        document_root (str): Directory the files are served from.
+
+    Returns:
+        HttpResponseBase: The file, a part of it or a 304 response.
+
+    Raises:
+        Http404: If the file does not exist or is a directory.
+    """
+    path = posixpath.normpath(path).lstrip("/")
+    fullpath = Path(safe_join(document_root, path))
+    if not fullpath.is_file():
+        raise Http404(f"“{path}” does not exist")
+    stat = fullpath.stat()
+    if not was_modified_since(
+        request.headers.get("If-Modified-Since"), stat.st_mtime
+    ):
+        return HttpResponseNotModified()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    content_type, encoding = mimetypes.guess_type(str(fullpath))
+    response = segmented_response(
+        request,
+        [(fullpath.open("rb"), 0, stat.st_size)],
+        content_type=content_type or "application/octet-stream",
+        as_attachment=False,
+        etag=etag,
+        last_modified=stat.st_mtime,
+    )
+    if encoding:
+        response["Content-Encoding"] = encoding
+    return response
@@ -63,6 +63,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "voxlyne.db.middleware.TransactionModeMiddleware",
+    "voxlyne.db.middleware.ReplicaRoutingMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -70,7 +72,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "Accounts.middleware.DatabaseRetryMiddleware",
+    "voxlyne.db.middleware.DatabaseRetryMiddleware",
     "debug_toolbar.middleware.DebugToolbarMiddleware",
 ]
 
@@ -103,19 +105,61 @@ WSGI_APPLICATION = "voxlyne.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        # SQLite con pragmas configurables; las solicitudes de solo lectura
+        # usan transacciones DEFERRED (ver TransactionModeMiddleware)
+        "ENGINE": "voxlyne.db.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
         "OPTIONS": {
             "timeout": 20,  # Tiempo de espera en segundos antes de lanzar timeout
-            "isolation_level": "IMMEDIATE",  # Nivel de aislamiento más estricto
+            # Modo de las transacciones fuera de una solicitud (comandos, tareas)
+            "transaction_mode": "IMMEDIATE",
+            # Sentencias preparadas que guarda cada conexión
+            "cached_statements": 256,
+            "pragmas": {
+                # WAL: los lectores no bloquean al escritor ni entre sí
+                "journal_mode": "WAL",
+                # Seguro con WAL; solo se sincroniza en los checkpoints
+                "synchronous": "NORMAL",
+                "cache_size": -20000,  # 20 MB de caché de páginas por conexión
+                "mmap_size": 256 * 1024 * 1024,
+                "temp_store": "MEMORY",
+            },
         },
         "ATOMIC_REQUESTS": True,  # Cada solicitud HTTP se ejecuta en una transacción
+        # Reutilizar la conexión entre solicitudes (segundos) y comprobarla
+        # antes de usarla en cada solicitud
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
-# Configuración de conexiones concurrentes
-DATABASE_ROUTERS = []
-CONN_MAX_AGE = 0  # Desactivar conexiones persistentes en desarrollo
+# Réplica de solo lectura (opcional): una copia SQLite mantenida con
+# "python manage.py sync_replica --every 10"
+DATABASE_REPLICA_PATH = os.environ.get("DATABASE_REPLICA_PATH")
+if DATABASE_REPLICA_PATH:
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "NAME": DATABASE_REPLICA_PATH,
+        "ATOMIC_REQUESTS": False,
+        # En las pruebas la réplica es la misma base de datos de pruebas
+        "TEST": {"MIRROR": "default"},
+    }
+
+# Configuración de conexiones concurrentes: las solicitudes de lectura van a
+# las réplicas; quien escribe lee del primario durante REPLICA_PIN_SECONDS
+DATABASE_ROUTERS = ["voxlyne.db.routers.ReplicaRouter"]
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+REPLICA_HEALTH_INTERVAL = 5  # Segundos entre comprobaciones de cada réplica
+REPLICA_MAX_LAG = 60  # Antigüedad máxima de la copia (segundos)
+# Nunca menor que REPLICA_MAX_LAG: una réplica puede ir así de atrasada
+REPLICA_PIN_SECONDS = REPLICA_MAX_LAG
+
+# Reintentos cuando SQLite está bloqueado (solo solicitudes de lectura y
+# vistas marcadas con retry_on_db_lock), con espera aleatoria creciente
+DB_LOCK_RETRIES = 3
+DB_LOCK_RETRY_DELAY = 0.05  # Espera máxima del primer reintento (segundos)
+DB_LOCK_RETRY_MAX_DELAY = 1.0
+DB_LOCK_RETRY_BUDGET = 3.0  # Tiempo total tras el cual no se reintenta
 
 
 # Password validation
@@ -221,6 +265,72 @@ REST_FRAMEWORK = {
 MEDIA_URL = ""
 MEDIA_ROOT = os.path.join(BASE_DIR, "")
 
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+    # PDFs de documentos: se guardan por su SHA-256 en subdirectorios
+    # (Documents/blobs/ab/cd/<sha256>.pdf) y una sola vez por contenido
+    "documents": {
+        "BACKEND": "Documents.storage.ContentAddressedStorage",
+        "OPTIONS": {"prefix": "Documents/blobs", "depth": 2},
+    },
+}
+
+# Configuración del sellado de PDFs
+# Tamaño máximo (bytes) que se mantiene en memoria antes de pasar a disco temporal
+DOCUMENT_STAMP_SPOOL_MAX_SIZE = int(
+    os.environ.get("DOCUMENT_STAMP_SPOOL_MAX_SIZE", 8 * 1024 * 1024)
+)
+# "incremental": añade el sello como una revisión nueva sin tocar los bytes originales
+# "rewrite": vuelve a serializar todas las páginas del PDF
+DOCUMENT_STAMP_MODE = os.environ.get("DOCUMENT_STAMP_MODE", "incremental")
+# Plantillas de sello compiladas (una por geometría de página) que se mantienen en memoria
+DOCUMENT_STAMP_TEMPLATE_CACHE_SIZE = 64
+
+# Procesamiento de documentos en segundo plano
+# Si está activo, la subida responde 202 con un trabajo y el sellado lo hace
+# "python manage.py process_document_jobs"
+DOCUMENT_PROCESSING_ASYNC = (
+    os.environ.get("DOCUMENT_PROCESSING_ASYNC", "False") == "True"
+)
+# Procesos del pool de trabajadores (None = número de CPUs)
+DOCUMENT_JOB_WORKERS = int(os.environ.get("DOCUMENT_JOB_WORKERS", 0)) or None
+# Segundos tras los que un trabajo "running" sin terminar se vuelve a encolar
+DOCUMENT_JOB_STALE_AFTER = 15 * 60
+# Intentos de un trabajo que falla por la base de datos bloqueada antes de darlo por fallido
+DOCUMENT_JOB_MAX_ATTEMPTS = 5
+# Número máximo de certificados por lote en la API
+DOCUMENT_CERTIFICATE_BATCH_MAX = 1000
+# Procesos compartidos por todos los lotes de certificados de un proceso web
+# (None = número de CPUs)
+DOCUMENT_CERTIFICATE_WORKERS = (
+    int(os.environ.get("DOCUMENT_CERTIFICATE_WORKERS", 0)) or None
+)
+# Logos de empresa preparados para los certificados que se mantienen en memoria (bytes)
+DOCUMENT_LOGO_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Resolución (puntos por pulgada) a la que se escalan los logos
+DOCUMENT_LOGO_DPI = 300
+
+# Filtro de Bloom de hashes de documentos para detectar duplicados sin consultar la BD
+# Número de hashes para el que se dimensiona y tasa de falsos positivos esperada
+DOCUMENT_HASH_FILTER_CAPACITY = 1_000_000
+DOCUMENT_HASH_FILTER_ERROR_RATE = 0.001
+# Si está activo, el filtro vive en Redis y lo comparten todos los procesos
+DOCUMENT_HASH_FILTER_SHARED = (
+    os.environ.get("DOCUMENT_HASH_FILTER_SHARED", "True") == "True"
+)
+# Segundos que un filtro local (sin Redis) puede ir por detrás de la BD
+DOCUMENT_HASH_FILTER_REFRESH = 5
+# Segundos que se conserva un registro del índice de verificación sin ser reescrito
+DOCUMENT_VERIFICATION_CACHE_TIMEOUT = 24 * 60 * 60
+# Documentos por página al listar los de una empresa (por defecto y máximo)
+DOCUMENT_COMPANY_PAGE_SIZE = 500
+DOCUMENT_COMPANY_PAGE_MAX = 5000
+
 # Configuración de Tailwind
 TAILWIND_APP_NAME = "theme"
 INTERNAL_IPS = [
@@ -260,13 +370,40 @@ RECAPTCHA_REQUIRED_SCORE = os.environ.get('RECAPTCHA_REQUIRED_SCORE', 0.85)
 
 # Redis Cache Configuration
 CACHES = {
+    # Redis con cortacircuitos: tras varios fallos seguidos se usa una caché
+    # local en memoria hasta que Redis vuelve a responder
     'default': {
-        'BACKEND': 'django_redis.cache.RedisCache',
+        'BACKEND': 'voxlyne.cache_backends.ResilientRedisCache',
         'LOCATION': 'redis://127.0.0.1:6379/1',  # Using default Redis port
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
             "SERIALIZER": "django_redis.serializers.json.JSONSerializer",
-            "CONNECTION_POOL_KWARGS": {"decode_responses": False}
+            "CONNECTION_POOL_KWARGS": {"decode_responses": False},
+            # Tiempos de espera cortos (segundos) para detectar caídas rápido
+            'SOCKET_CONNECT_TIMEOUT': 0.25,
+            'SOCKET_TIMEOUT': 0.5,
+            'FAILURE_THRESHOLD': 3,
+            'PROBE_INTERVAL': 5,
+            'FALLBACK_MAX_ENTRIES': 10000,
+        }
+    },
+    # Caché en memoria de cada proceso (L1) delante de Redis, para datos casi
+    # estáticos; las invalidaciones se reparten entre procesos por pub/sub
+    'tiered': {
+        'BACKEND': 'voxlyne.cache_backends.TieredCache',
+        'OPTIONS': {
+            'L2': 'default',
+            'MAX_ENTRIES': 2048,
+            'L1_TIMEOUT': 30,
         }
     }
 }
+
+# Segundos que se conservan los listados de la API en caché; cualquier
+# escritura en los modelos que muestran los invalida antes
+LIST_CACHE_TIMEOUT = 60 * 60
+# Segundos durante los que un listado caducado se sigue sirviendo mientras
+# una sola petición lo recalcula
+LIST_CACHE_STALE_TIMEOUT = 5 * 60
+# Caché donde viven los contadores de versión de los modelos, leídos en cada listado
+LIST_CACHE_VERSION_ALIAS = 'tiered'
@@ -24,6 +24,7 @@ from rest_framework.permissions import AllowAny
 from Accounts.views import UserListCreateView, UserDetailView
 from .views import *
 from .api_docs import API_DESCRIPTIONS
+from .responses import serve_ranged
 import debug_toolbar
 
 urlpatterns = [
@@ -80,6 +81,8 @@ urlpatterns = [
                 path("employment-history/", include("Employment_history.urls")),
                 path("documents/", include("Documents.urls")),
                 path("documents-copies/", include("Documents_copies.urls")),
+                path("cache/stats/", cache_stats, name="cache-stats"),
+                path("db/stats/", database_stats, name="database-stats"),
             ]
         ),
     ),
@@ -96,7 +99,9 @@ if settings.DEBUG:
     urlpatterns = [
         path('__debug__/', include(debug_toolbar.urls)),
     ] + urlpatterns
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    urlpatterns += static(
+        settings.MEDIA_URL, view=serve_ranged, document_root=settings.MEDIA_ROOT
+    )
     urlpatterns += [
         path("api-auth/", include("rest_framework.urls")),
     ]
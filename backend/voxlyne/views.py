@@ -1,4 +1,14 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
 from django.shortcuts import render, get_object_or_404
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .db import connection_stats
+from .db.retry import retry_stats
+from .db.routers import replica_health
 
 
 def index(request):
@@ -24,3 +34,44 @@ def contact(request):
         "title": "Contact",
     }
     return render(request, "contact.html", context)
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """Report the state of the caches that keep statistics.
+
+    That is the hit and miss counters of the layered caches and the
+    circuit breaker of Redis. Both are per process.
+    """
+    stats = {
+        alias: caches[alias].stats()
+        for alias in settings.CACHES
+        if hasattr(caches[alias], "stats")
+    }
+    return Response(stats)
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def database_stats(request):
+    """Report the database connection and lock retry counters.
+
+    That is how often each alias opened or reused a connection, the lock
+    errors and retries of each endpoint and the last health check of each
+    replica. Counters are per process.
+    """
+    stats = {
+        alias: {
+            **connection_stats(alias).as_dict(),
+            "conn_max_age": connections[alias].settings_dict["CONN_MAX_AGE"],
+        }
+        for alias in settings.DATABASES
+    }
+    return Response(
+        {
+            "connections": stats,
+            "retries": retry_stats(),
+            "replicas": replica_health.status(),
+        }
+    )